@@ -22,6 +22,13 @@ module, a dependency is recorded.  The name can refer to a file in the
 current directory with a name like "a/b.h" if the current directory is
 "a".
 
+With `--recursive`, modules are discovered in every subdirectory too.
+File and module names are then paths relative to the current directory,
+such as "util/str.h" and "util/str".  An include is resolved first
+relative to the including file's directory (including the "a/b.h" form
+above, with "a" being that directory's name), then relative to the
+current directory.
+
 The script computes:
 
   - file-to-file dependencies
@@ -31,18 +38,151 @@ The script computes:
 
 The result is printed as a JSON object.
 
-The script first runs unit tests and an integration test using a
-hardcoded example.  If all pass, it analyzes the current directory and
-prints results.
+With `--conditional`, #include lines inside comments, and inside
+#if/#ifdef/#ifndef/#elif/#else blocks that are inactive given the
+macros defined with `-D NAME[=VALUE]`, are ignored.  Conditions that
+cannot be evaluated keep all their branches.  This is a lightweight
+directive scanner, not a full preprocessor.
+
+`--self-test` runs the unit tests and an integration test using a
+hardcoded example instead of analyzing anything.
+
+`--profile` prints, to stderr, the time spent in each phase of the run:
+discovery, reading, parsing, graph building, and serialization.
+
+With `--jobs N`, the files are read and scanned for #include lines by a
+pool of N worker processes.  The result is the same as the serial scan.
+
+With `--cache`, the includes found in each file are saved in a cache
+file along with the file's modification time, size, and content hash.
+On later runs, files whose time and size are unchanged are not read
+at all.  The default cache location is under $XDG_CACHE_HOME (or
+~/.cache), in a file named after the analyzed directory; `--cache-file
+FILE` uses FILE instead.
+
+With `--mmap`, each file is memory-mapped and its raw bytes searched
+for #include lines rather than being decoded and split into lines.
+`--include-region BYTES` (which implies `--mmap`) additionally stops
+the search of a file when BYTES bytes pass without another #include,
+on the assumption that a file's includes are near its top.  Neither
+applies with `--conditional`, which needs the whole text, and with
+`--cache` the whole file is still read to compute its hash.
+
+The output format is chosen with `--format`:
+
+  json     The JSON object, indented (the default).
+  compact  The same object without whitespace.
+  jsonl    JSON Lines: one record per file, then one per module, then
+           one per SCC in bottom-up order, each group written as soon
+           as it is computed.  See `stream_jsonl`.
+  binary   Integer node ids and edge arrays.  See `write_binary`.
+
+`--input FILE` reads the result of an earlier run, in any of those
+formats, instead of analyzing the current directory.
+
+Instead of the result, `--deps M`, `--rdeps M`, and `--impacted F` print
+the modules M transitively depends on, the modules that transitively
+depend on M, and the files that must be rebuilt when F changes.  These
+are answered by searching the graph; see `QueryEngine`.
+
+`--check RULES` checks the module graph against the layering rules in
+file RULES, such as "deny util/* app/*"; see `LayeringRules`.
+
+`--diff OLD NEW` compares two results and prints, as JSON, the file and
+module dependencies added and removed, and the SCCs (dependency cycles)
+that were merged or split.  OLD and NEW are each a result file written
+by this script or, if no such file exists, a git revision of the
+current directory, which is then analyzed.  See `diff_results`.
+
+`--daemon SOCKET` keeps running after the analysis.  It polls the
+directory for changes, updates the analysis incrementally, and sends
+the current result as compact JSON to each client that connects to the
+Unix socket SOCKET.  `--connect SOCKET` is such a client.
 """
 
+import argparse
+import array
+import concurrent.futures
+import contextlib
+import fnmatch
+import hashlib
 import os
+import posixpath
+import random
 import re
 import json
-from typing import Dict, List, Set, Tuple, Optional, Iterable
+import mmap
+import multiprocessing.util
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import time
+from typing import (
+  Any, BinaryIO, Callable, ContextManager, Dict, List, Set, Tuple, Optional,
+  Iterable, Iterator, TextIO
+)
 from collections import defaultdict
 
 
+# ----------------------------------------------------------------------
+# Profiling
+class Profiler:
+  """Accumulates the time spent in each phase of a run."""
+
+  def __init__(self) -> None:
+    # Map from phase name to seconds, in order of first use.
+    self.times: Dict[str, float] = {}
+
+  def add(self, phase: str, seconds: float) -> None:
+    """Add `seconds` to the time for `phase`."""
+    self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+  @contextlib.contextmanager
+  def phase(self, name: str) -> Iterator[None]:
+    """Context manager that adds the time spent in it to `name`."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, time.perf_counter() - start)
+
+  def report(self, out: TextIO, total: float) -> None:
+    """Print the times, given the `total` elapsed time of the run."""
+    width = max([len("total")] + [len(p) for p in self.times])
+    for p, t in self.times.items():
+      pct = 100.0 * t / total if total > 0 else 0.0
+      print(f"{p:<{width}}  {t:9.3f}s  {pct:5.1f}%", file=out)
+    print(f"{'total':<{width}}  {total:9.3f}s", file=out)
+
+
+# The active profiler, if `--profile` was given.
+profiler: Optional[Profiler] = None
+
+
+def profile_phase(name: str) -> ContextManager[None]:
+  """Time the enclosed code as phase `name`, if profiling."""
+  if profiler is None:
+    return contextlib.nullcontext()
+  return profiler.phase(name)
+
+
+def test_profiler() -> None:
+  """Unit test for Profiler."""
+  import io
+
+  p = Profiler()
+  with p.phase("a"):
+    pass
+  p.add("b", 1.0)
+  p.add("b", 0.5)
+  assert list(p.times) == ["a", "b"] and p.times["b"] == 1.5
+  out = io.StringIO()
+  p.report(out, 3.0)
+  assert out.getvalue().splitlines()[1].split() == ["b", "1.500s", "50.0%"]
+
+
 # ----------------------------------------------------------------------
 # File system abstraction
 class FileSystem:
@@ -52,11 +192,40 @@ class FileSystem:
     """Return the list of filenames in `path`."""
     return os.listdir(path)
 
+  def walk(self, path: str) -> List[str]:
+    """
+    Return the paths, relative to `path`, of all files in `path` and
+    its subdirectories.  Directories whose names start with "." are
+    skipped.
+    """
+    result: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+      rel = os.path.relpath(dirpath, path)
+      for f in filenames:
+        result.append(f if rel == "." else posixpath.join(
+          rel.replace(os.sep, "/"), f))
+    return sorted(result)
+
   def read(self, path: str) -> str:
     """Return the contents of file `path` as a string."""
     with open(path, "r", encoding="utf-8") as f:
       return f.read()
 
+  def close(self) -> None:
+    """Release any resources held for reading, such as processes."""
+    pass
+
+  def stat(self, path: str) -> Tuple[int, int]:
+    """
+    Return (modification time in ns, size in bytes) of file `path`.
+    Raise OSError if it does not exist or is a directory.
+    """
+    st = os.stat(path)
+    if stat.S_ISDIR(st.st_mode):
+      raise IsADirectoryError(path)
+    return st.st_mtime_ns, st.st_size
+
 
 class FakeFileSystem(FileSystem):
   """In-memory file system for testing."""
@@ -64,18 +233,58 @@ class FakeFileSystem(FileSystem):
   def __init__(self, files: Dict[str, str]):
     self._files = files
 
+    # Fake modification time of each file.  `write` advances it.
+    self._mtimes: Dict[str, int] = {f: 0 for f in files}
+
+    # Number of calls to `read`, so tests can check what was read.
+    self.read_count = 0
+
   def listdir(self, path: str) -> List[str]:
-    return sorted(self._files.keys())
+    prefix = self._dir_prefix(path)
+    names = set()
+    for f in self._files:
+      if f.startswith(prefix):
+        names.add(f[len(prefix):].split("/")[0])
+    return sorted(names)
+
+  def walk(self, path: str) -> List[str]:
+    prefix = self._dir_prefix(path)
+    return sorted(f[len(prefix):] for f in self._files
+                  if f.startswith(prefix))
+
+  @staticmethod
+  def _dir_prefix(path: str) -> str:
+    """Return the prefix of the keys of files within directory `path`."""
+    path = posixpath.normpath(path)
+    return "" if path == "." else path + "/"
 
   def read(self, path: str) -> str:
+    self.read_count += 1
     return self._files[path]
 
+  def stat(self, path: str) -> Tuple[int, int]:
+    return self._mtimes[path], len(self._files[path].encode("utf-8"))
+
+  def write(self, path: str, contents: str) -> None:
+    """Replace the contents of `path`, updating its modification time."""
+    self._files[path] = contents
+    self._mtimes[path] = self._mtimes.get(path, 0) + 1
+
 
 def test_fake_filesystem() -> None:
   """Unit test for FakeFileSystem."""
   fs = FakeFileSystem({"a.cc": "int main(){}", "b.h": "#pragma once"})
   assert "a.cc" in fs.listdir(".")
   assert fs.read("a.cc") == "int main(){}"
+  assert fs.stat("a.cc") == (0, 12)
+  fs.write("a.cc", "")
+  assert fs.stat("a.cc") == (1, 0)
+
+  fs = FakeFileSystem({"a.cc": "", "d/b.h": "", "d/e/c.h": ""})
+  assert fs.listdir(".") == ["a.cc", "d"]
+  assert fs.listdir("d") == ["b.h", "e"]
+  assert fs.walk(".") == ["a.cc", "d/b.h", "d/e/c.h"]
+  assert fs.walk("d") == ["b.h", "e/c.h"]
 
 
 # ----------------------------------------------------------------------
@@ -83,23 +292,45 @@ def test_fake_filesystem() -> None:
 MODULE_SUFFIXES = [".h", "-fwd.h", "-iface.h", ".cc", "-test.cc"]
 
 
-def discover_modules(fs: FileSystem, path: str) -> Dict[str, List[str]]:
+def discover_modules(
+  fs: FileSystem, path: str, recursive: bool = False
+) -> Dict[str, List[str]]:
   """
   Discover modules in `path`. A module is defined by a *.cc file (excluding *-test.cc).
   Returns a map from module name to its files.
+
+  If `recursive`, subdirectories are searched too, and module and file
+  names are paths relative to `path`.
   """
-  files = fs.listdir(path)
+  files: Iterable[str]
+  if recursive:
+    files = fs.walk(path)
+  else:
+    files = fs.listdir(path)
+  files = set(files)
   modules: Dict[str, List[str]] = {}
   for f in files:
     if f.endswith(".cc") and not f.endswith("-test.cc"):
       module = f[:-3]
-      module_files = []
-      for suff in MODULE_SUFFIXES:
-        fname = module + suff
-        if fname in files:
-          module_files.append(fname)
-      modules[module] = sorted(module_files)
-  return modules
+      modules[module] = module_files_in(module, files)
+  return dict(sorted(modules.items()))
+
+
+def module_files_in(module: str, files: Set[str]) -> List[str]:
+  """
+  Return the sorted files of `module` among `files`, or an empty list
+  if `module` is not a module there.
+  """
+  if module.endswith("-test") or module + ".cc" not in files:
+    return []
+  return sorted(module + suff for suff in MODULE_SUFFIXES
+                if module + suff in files)
+
+
+def module_candidates(fname: str) -> List[str]:
+  """Return the names of the modules `fname` could belong to."""
+  return [fname[:-len(suff)] for suff in MODULE_SUFFIXES
+          if fname.endswith(suff)]
 
 
 def test_discover_modules() -> None:
@@ -113,6 +344,27 @@ def test_discover_modules() -> None:
   mods = discover_modules(fs, ".")
   assert mods == {"foo": ["foo-test.cc", "foo.cc", "foo.h"], "bar": ["bar.cc"]}
 
+  fs = FakeFileSystem({
+    "main.cc": "",
+    "util/str.cc": "",
+    "util/str.h": "",
+    "util/sub/io.cc": "",
+  })
+  assert discover_modules(fs, ".") == {"main": ["main.cc"]}
+  mods = discover_modules(fs, ".", recursive=True)
+  assert mods == {
+    "main": ["main.cc"],
+    "util/str": ["util/str.cc", "util/str.h"],
+    "util/sub/io": ["util/sub/io.cc"],
+  }
+
+  files = {"a.cc", "a.h", "a-test.cc", "b.h"}
+  assert module_files_in("a", files) == ["a-test.cc", "a.cc", "a.h"]
+  assert module_files_in("b", files) == []
+  assert module_files_in("a-test", files) == []
+  assert module_candidates("a-test.cc") == ["a-test", "a"]
+  assert module_candidates("a-fwd.h") == ["a-fwd", "a"]
+
 
 # ----------------------------------------------------------------------
 # Dependency scanning
@@ -129,12 +381,138 @@ def parse_includes(text: str) -> List[str]:
   return results
 
 
+def read_and_parse(
+  fs: FileSystem, fname: str, macros: Optional["Macros"] = None
+) -> List[str]:
+  """
+  Return `extract_includes` of the contents of `fname`, timing the
+  reading and the parsing separately if profiling.  With a
+  `MappedFileSystem` and no `macros`, the file is scanned by
+  `MappedFileSystem.includes` instead.
+  """
+  if macros is None and isinstance(fs, MappedFileSystem):
+    with profile_phase("scanning"):
+      return fs.includes(fname)
+  if profiler is None:
+    return extract_includes(fs.read(fname), macros)
+  start = time.perf_counter()
+  text = fs.read(fname)
+  mid = time.perf_counter()
+  ret = extract_includes(text, macros)
+  profiler.add("reading", mid - start)
+  profiler.add("parsing", time.perf_counter() - mid)
+  return ret
+
+
 def test_parse_includes() -> None:
   """Unit test for parse_includes."""
   txt = '#include "a.h"\n # include "b.h" // comment\n#include <c>\n'
   assert parse_includes(txt) == ["a.h", "b.h"]
 
 
+# Bytes version of INCLUDE_RE for searching a whole file at once.  It
+# starts at the "#" rather than the start of the line because the regex
+# engine searches much faster for a pattern with a literal prefix;
+# `scan_include_bytes` checks what precedes the "#".  Only the part of
+# the line up to the closing quote is matched.
+INCLUDE_BYTES_RE = re.compile(
+  rb'#[ \t\f\v]*include[ \t\f\v]*"([^"\r\n]+)"')
+
+
+def scan_include_bytes(data: Any, region: int = 0) -> List[str]:
+  """
+  Return the quoted includes in `data`, a `bytes` or `mmap`, like
+  `parse_includes` does for text.
+
+  If `region` is positive, the search stops once `region` bytes pass,
+  from the start of `data` or the end of the previous include, without
+  an #include line starting.  Matches never straddle that limit since
+  the search always runs to the end of the line the limit falls in.
+  """
+  results: List[str] = []
+  size = len(data)
+  pos = 0
+
+  # Where the current region starts.
+  last = 0
+
+  while pos < size:
+    if region > 0:
+      limit = last + region
+      if limit >= size:
+        endpos = size
+      else:
+        endpos = data.find(b"\n", limit)
+        if endpos < 0:
+          endpos = size
+      m = INCLUDE_BYTES_RE.search(data, pos, endpos)
+    else:
+      m = INCLUDE_BYTES_RE.search(data, pos)
+    if m is None:
+      break
+    start = m.start()
+    line_start = data.rfind(b"\n", 0, start) + 1
+    if region > 0 and line_start > limit:
+      break
+    if not data[line_start:start].strip(b" \t\f\v"):
+      results.append(m.group(1).decode("utf-8"))
+      last = m.end()
+    pos = m.end()
+  return results
+
+
+class MappedFileSystem(FileSystem):
+  """
+  `FileSystem` whose `includes` memory-maps each file and searches its
+  bytes with `scan_include_bytes`, so the file is never decoded or
+  split into lines, and, with a `region`, not even paged in past its
+  include region.
+  """
+
+  def __init__(self, region: int = 0):
+    # `region` argument to `scan_include_bytes`; 0 searches whole files.
+    self.region = region
+
+  def includes(self, path: str) -> List[str]:
+    """Return the quoted includes in file `path`."""
+    with open(path, "rb") as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        # An empty file cannot be mapped.
+        return []
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return scan_include_bytes(mm, self.region)
+
+
+def test_scan_include_bytes() -> None:
+  """Unit test for scan_include_bytes and MappedFileSystem."""
+  import tempfile
+
+  txt = b'#include "a.h"\n # include "b.h" // comment\n#include <c>\n'
+  assert scan_include_bytes(txt) == ["a.h", "b.h"]
+  assert scan_include_bytes(b'x #include "a.h"\n\t#include "b.h"') == ["b.h"]
+
+  # The region restarts after each include.
+  txt = b'#include "a.h"\n' + b"int x;\n" * 10 + b'#include "b.h"\n'
+  assert scan_include_bytes(txt, 80) == ["a.h", "b.h"]
+  assert scan_include_bytes(txt, 60) == ["a.h"]
+  assert scan_include_bytes(txt[15:], 60) == []
+
+  # A line starting within the region is matched even if it ends
+  # outside of it.
+  assert scan_include_bytes(b'\n#include "long-name.h"', 2) == \
+    ["long-name.h"]
+  assert scan_include_bytes(b'\n     #include "a.h"', 2) == ["a.h"]
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fname = os.path.join(tmpdir, "a.cc")
+    with open(fname, "wb") as f:
+      f.write(txt)
+    assert MappedFileSystem().includes(fname) == ["a.h", "b.h"]
+    assert MappedFileSystem(60).includes(fname) == ["a.h"]
+    open(fname, "wb").close()
+    assert MappedFileSystem().includes(fname) == []
+
+
 def normalize_include(fname: str, cwd: str) -> Optional[str]:
   """
   Normalize an include filename. If it refers to a file in the current
@@ -157,22 +535,902 @@ def test_normalize_include() -> None:
   assert normalize_include("y/a.h", "x") is None
 
 
+class PathIndex:
+  """
+  Index of the analyzed files, used to resolve include names to files.
+
+  Resolutions are memoized by (including directory, include name), so
+  the string manipulation is done once per distinct pair, and each
+  further occurrence is a dictionary lookup.
+  """
+
+  def __init__(self, fnames: Iterable[str], root: str):
+    # Paths, relative to the root, of all files that can be included.
+    self.files: Set[str] = set(fnames)
+
+    # Name of the root directory, for `normalize_include`.
+    self.root_name = os.path.basename(os.path.abspath(root))
+
+    # Map from (directory of the including file, include name) to the
+    # file it resolves to, or None.
+    self._memo: Dict[Tuple[str, str], Optional[str]] = {}
+
+  def add(self, fname: str) -> None:
+    """Add `fname` to the indexed files."""
+    self.files.add(fname)
+    self._memo.clear()
+
+  def remove(self, fname: str) -> None:
+    """Remove `fname` from the indexed files."""
+    self.files.discard(fname)
+    self._memo.clear()
+
+  def resolve(self, from_file: str, inc: str) -> Optional[str]:
+    """
+    Return the file that `#include "inc"` in `from_file` refers to, or
+    None if it is not one of the indexed files.
+    """
+    d = posixpath.dirname(from_file)
+    key = (d, inc)
+    try:
+      return self._memo[key]
+    except KeyError:
+      pass
+    ret = self._resolve(d, inc)
+    self._memo[key] = ret
+    return ret
+
+  def _resolve(self, d: str, inc: str) -> Optional[str]:
+    """Resolve `inc` included from directory `d`, without memoization."""
+    # Relative to the including directory, possibly with a prefix that
+    # names that directory.
+    norm = normalize_include(inc, posixpath.basename(d) or self.root_name)
+    if norm is not None:
+      cand = posixpath.join(d, norm)
+      if cand in self.files:
+        return cand
+
+    if "/" in inc:
+      # A path relative to the including directory.
+      cand = posixpath.normpath(posixpath.join(d, inc))
+      if cand in self.files:
+        return cand
+
+      # A path relative to the root.
+      if inc in self.files:
+        return inc
+
+    return None
+
+
+def test_path_index() -> None:
+  """Unit test for PathIndex."""
+  idx = PathIndex(["a.h", "util/str.h", "util/sub/io.h", "app/a.h"], "src")
+  assert idx.resolve("a.cc", "a.h") == "a.h"
+  assert idx.resolve("a.cc", "src/a.h") == "a.h"
+  assert idx.resolve("a.cc", "other/a.h") is None
+  assert idx.resolve("a.cc", "util/str.h") == "util/str.h"
+  assert idx.resolve("app/main.cc", "a.h") == "app/a.h"
+  assert idx.resolve("app/main.cc", "app/a.h") == "app/a.h"
+  assert idx.resolve("app/main.cc", "util/str.h") == "util/str.h"
+  assert idx.resolve("app/main.cc", "../a.h") == "a.h"
+  assert idx.resolve("util/str.cc", "sub/io.h") == "util/sub/io.h"
+  assert idx.resolve("util/str.cc", "str.h") == "util/str.h"
+  assert idx.resolve("util/str.cc", "nonexist.h") is None
+  # Memoized: same answer again.
+  assert idx.resolve("util/x.cc", "str.h") == "util/str.h"
+
+  # Changing the files invalidates memoized answers.
+  idx.add("util/nonexist.h")
+  assert idx.resolve("util/str.cc", "nonexist.h") == "util/nonexist.h"
+  idx.remove("util/str.h")
+  assert idx.resolve("util/x.cc", "str.h") is None
+
+
+# ----------------------------------------------------------------------
+# Conditional compilation
+
+# Map from macro name to its definition.  For `extract_includes`, None
+# in place of the whole map means conditionals are not interpreted.
+Macros = Dict[str, str]
+
+
+def parse_macro_definitions(defs: Iterable[str]) -> Macros:
+  """
+  Parse command-line style definitions "NAME" or "NAME=VALUE".  As with
+  the compiler's -D, "NAME" alone defines NAME as 1.
+  """
+  macros: Macros = {}
+  for d in defs:
+    name, eq, value = d.partition("=")
+    macros[name] = value if eq else "1"
+  return macros
+
+
+# Tokens of a preprocessor #if expression.
+PP_TOKEN_RE = re.compile(r"""
+  \s*(?:
+    (0[xX][0-9a-fA-F]+(?:'[0-9a-fA-F]+)*
+     |[0-9]+(?:'[0-9]+)*)[uUlL]*        # 1: integer literal
+  | ([A-Za-z_]\w*)                      # 2: identifier
+  | (&&|\|\||==|!=|<=|>=|<<|>>|[-+*/%!~<>()&|^?:])   # 3: operator
+  )""", re.VERBOSE)
+
+
+class PPExpressionError(Exception):
+  """The #if expression cannot be evaluated."""
+  pass
+
+
+class PPExpressionEvaluator:
+  """
+  Evaluates the expression of an #if or #elif against a set of macros,
+  by recursive descent.  Identifiers that are not defined are 0, as in
+  the preprocessor.  Anything beyond integer arithmetic and `defined`
+  raises PPExpressionError, including function-like macros and macros
+  whose definitions are not integer expressions.
+  """
+
+  # Binary operators by precedence level, lowest first.
+  BINARY_LEVELS: List[List[str]] = [
+    ["||"], ["&&"], ["|"], ["^"], ["&"], ["==", "!="],
+    ["<", ">", "<=", ">="], ["<<", ">>"], ["+", "-"], ["*", "/", "%"],
+  ]
+
+  def __init__(self, macros: Macros, depth: int = 0):
+    self.macros = macros
+
+    # Nesting of macro expansions, to stop on recursive definitions.
+    self.depth = depth
+
+    self.tokens: List[Tuple[str, str]] = []
+    self.pos = 0
+
+  def evaluate(self, expr: str) -> int:
+    """Return the value of `expr`."""
+    self.tokens = self._tokenize(expr)
+    self.pos = 0
+    value = self._conditional()
+    if self.pos != len(self.tokens):
+      raise PPExpressionError(f"unexpected text in: {expr}")
+    return value
+
+  @staticmethod
+  def _tokenize(expr: str) -> List[Tuple[str, str]]:
+    """Split `expr` into (kind, text) tokens."""
+    tokens: List[Tuple[str, str]] = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+      m = PP_TOKEN_RE.match(expr, pos)
+      if not m:
+        raise PPExpressionError(f"cannot tokenize: {expr[pos:]}")
+      if m.group(1) is not None:
+        tokens.append(("int", m.group(1)))
+      elif m.group(2) is not None:
+        tokens.append(("id", m.group(2)))
+      else:
+        tokens.append(("op", m.group(3)))
+      pos = m.end()
+    return tokens
+
+  def _peek(self) -> Optional[str]:
+    if self.pos < len(self.tokens):
+      return self.tokens[self.pos][1]
+    return None
+
+  def _expect(self, text: str) -> None:
+    if self._peek() != text:
+      raise PPExpressionError(f"expected {text}")
+    self.pos += 1
+
+  def _conditional(self) -> int:
+    cond = self._binary(0)
+    if self._peek() != "?":
+      return cond
+    self.pos += 1
+    then_value = self._conditional()
+    self._expect(":")
+    else_value = self._conditional()
+    return then_value if cond else else_value
+
+  def _binary(self, level: int) -> int:
+    if level == len(self.BINARY_LEVELS):
+      return self._unary()
+    value = self._binary(level + 1)
+    while self._peek() in self.BINARY_LEVELS[level]:
+      op = self.tokens[self.pos][1]
+      self.pos += 1
+      rhs = self._binary(level + 1)
+      value = self._apply(op, value, rhs)
+    return value
+
+  # Semantics of the binary operators.  Division truncates, as in C.
+  BINARY_OPS: Dict[str, Callable[[int, int], int]] = {
+    "||": lambda a, b: int(bool(a) or bool(b)),
+    "&&": lambda a, b: int(bool(a) and bool(b)),
+    "|": lambda a, b: a | b,
+    "^": lambda a, b: a ^ b,
+    "&": lambda a, b: a & b,
+    "==": lambda a, b: int(a == b),
+    "!=": lambda a, b: int(a != b),
+    "<": lambda a, b: int(a < b),
+    ">": lambda a, b: int(a > b),
+    "<=": lambda a, b: int(a <= b),
+    ">=": lambda a, b: int(a >= b),
+    "<<": lambda a, b: a << b,
+    ">>": lambda a, b: a >> b,
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": lambda a, b: abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1),
+    "%": lambda a, b: a - b * (abs(a) // abs(b) *
+                               (1 if (a < 0) == (b < 0) else -1)),
+  }
+
+  @classmethod
+  def _apply(cls, op: str, a: int, b: int) -> int:
+    if op in ("/", "%") and b == 0:
+      raise PPExpressionError("division by zero")
+    return cls.BINARY_OPS[op](a, b)
+
+  def _unary(self) -> int:
+    tok = self._peek()
+    if tok == "!":
+      self.pos += 1
+      return int(not self._unary())
+    if tok == "-":
+      self.pos += 1
+      return -self._unary()
+    if tok == "+":
+      self.pos += 1
+      return self._unary()
+    if tok == "~":
+      self.pos += 1
+      return ~self._unary()
+    return self._primary()
+
+  def _primary(self) -> int:
+    if self.pos >= len(self.tokens):
+      raise PPExpressionError("unexpected end of expression")
+    kind, text = self.tokens[self.pos]
+    self.pos += 1
+
+    if kind == "int":
+      text = text.replace("'", "")
+      if text[:2] in ("0x", "0X"):
+        return int(text, 16)
+      if len(text) > 1 and text[0] == "0":
+        return int(text, 8)
+      return int(text)
+
+    if text == "(":
+      value = self._conditional()
+      self._expect(")")
+      return value
+
+    if text == "defined":
+      paren = self._peek() == "("
+      if paren:
+        self.pos += 1
+      if self.pos >= len(self.tokens) or self.tokens[self.pos][0] != "id":
+        raise PPExpressionError("expected identifier after defined")
+      name = self.tokens[self.pos][1]
+      self.pos += 1
+      if paren:
+        self._expect(")")
+      return int(name in self.macros)
+
+    if kind == "id":
+      if self._peek() == "(":
+        raise PPExpressionError(f"function-like macro: {text}")
+      if text in ("true", "false"):
+        # C++ keywords, which are not replaced by 0 like other names.
+        return int(text == "true")
+      if text not in self.macros:
+        return 0
+      if self.depth >= 20:
+        raise PPExpressionError(f"macro nesting too deep: {text}")
+      return PPExpressionEvaluator(self.macros, self.depth + 1).evaluate(
+        self.macros[text])
+
+    raise PPExpressionError(f"unexpected token: {text}")
+
+
+def evaluate_condition(expr: str, macros: Macros) -> Optional[bool]:
+  """
+  Return whether the #if expression `expr` is true given `macros`, or
+  None if that cannot be determined.
+  """
+  try:
+    return PPExpressionEvaluator(macros).evaluate(expr) != 0
+  except (PPExpressionError, ValueError, RecursionError):
+    return None
+
+
+def test_evaluate_condition() -> None:
+  """Unit test for evaluate_condition."""
+  macros = parse_macro_definitions(
+    ["A", "B=2", "C=B+1", "F(x)=x", "S=\"s\"", "U=undefined"])
+  assert macros["A"] == "1"
+  assert evaluate_condition("0", macros) is False
+  assert evaluate_condition("1", macros) is True
+  assert evaluate_condition("defined(A)", macros) is True
+  assert evaluate_condition("defined A && !defined(Z)", macros) is True
+  assert evaluate_condition("Z", macros) is False
+  assert evaluate_condition("B == 2 && C > 2", macros) is True
+  assert evaluate_condition("(B * 3 - 1) % 4 == 1", macros) is True
+  assert evaluate_condition("0x10 >> 4 == A", macros) is True
+  assert evaluate_condition("B ? 0 : 1", macros) is False
+  assert evaluate_condition("1 // comment", macros) is None
+  assert evaluate_condition("F(1)", macros) is None
+  assert evaluate_condition("S", macros) is None
+  assert evaluate_condition("U", macros) is False
+  assert evaluate_condition("1 +", macros) is None
+  assert evaluate_condition("1 / 0", macros) is None
+  assert evaluate_condition("R", {"R": "R"}) is None
+  assert evaluate_condition("-7 / 2 == -3 && -7 % 2 == -1", macros) is True
+  assert evaluate_condition("010 == 8", macros) is True
+  assert evaluate_condition("true", macros) is True
+  assert evaluate_condition("false || !true", macros) is False
+  assert evaluate_condition("1'000 == 1000 && 0x1'0 == 16", macros) is True
+
+
+# A preprocessor directive: 1: name, 2: the rest.
+DIRECTIVE_RE = re.compile(r'^\s*#\s*([A-Za-z_]\w*)\s*(.*)$', re.DOTALL)
+
+# The operand of #include "...".
+QUOTED_INCLUDE_RE = re.compile(r'^"([^"]+)"')
+
+# The operand of #define: 1: name, 2: "(" if function-like, 3: value.
+DEFINE_RE = re.compile(r'([A-Za-z_]\w*)(\()?\s*(.*)$', re.DOTALL)
+
+# Start of a comment or literal, for `strip_comments`.
+COMMENT_OR_LITERAL_RE = re.compile(r'/\*|//|"|\'')
+
+
+def is_digit_separator(line: str, quote: int) -> bool:
+  """
+  Return whether the ' at `line[quote]` is a C++14 digit separator,
+  as in 1'000, rather than the start of a character literal.  It is
+  one if it is inside a number: the run of word characters, dots, and
+  quotes before it starts with a digit.  (A prefix like u8'x' starts
+  with a letter instead.)
+  """
+  if quote == 0 or not (line[quote - 1].isalnum() or line[quote - 1] == "_"):
+    return False
+  start = quote
+  while start > 0 and (line[start - 1].isalnum() or
+                       line[start - 1] in "_.'"):
+    start -= 1
+  return line[start].isdigit()
+
+
+def strip_comments(line: str, in_comment: bool) -> Tuple[str, bool]:
+  """
+  Remove the comments from `line`, where `in_comment` says whether the
+  line starts inside a /* */ comment.  Each comment is replaced by a
+  space.  Returns the stripped line and whether it ends inside a
+  comment.
+  """
+  if not in_comment and "/" not in line:
+    return line, False
+
+  out: List[str] = []
+  pos = 0
+  n = len(line)
+  while pos < n:
+    if in_comment:
+      end = line.find("*/", pos)
+      if end < 0:
+        return "".join(out), True
+      pos = end + 2
+      in_comment = False
+      out.append(" ")
+      continue
+
+    m = COMMENT_OR_LITERAL_RE.search(line, pos)
+    if not m:
+      out.append(line[pos:])
+      break
+    out.append(line[pos:m.start()])
+    tok = m.group(0)
+    if tok == "/*":
+      in_comment = True
+      pos = m.end()
+    elif tok == "//":
+      break
+    elif tok == "'" and is_digit_separator(line, m.start()):
+      out.append(tok)
+      pos = m.end()
+    else:
+      # A string or character literal: copy it through the closing
+      # quote so comment markers inside it are not seen.
+      end = m.end()
+      while end < n and line[end] != tok:
+        end += 2 if line[end] == "\\" else 1
+      if end >= n:
+        # Unterminated, so not really a literal; keep scanning after
+        # the quote rather than ignoring the rest of the line.
+        out.append(tok)
+        pos = m.end()
+        continue
+      out.append(line[m.start():end + 1])
+      pos = end + 1
+  return "".join(out), in_comment
+
+
+def test_strip_comments() -> None:
+  """Unit test for strip_comments."""
+  assert strip_comments("a b", False) == ("a b", False)
+  assert strip_comments("a // b", False) == ("a ", False)
+  assert strip_comments("a /* b */ c", False) == ("a   c", False)
+  assert strip_comments("a /* b", False) == ("a ", True)
+  assert strip_comments("b */ c", True) == ("  c", False)
+  assert strip_comments("still", True) == ("", True)
+  assert strip_comments("n = 1'000; // x", False) == ("n = 1'000; ", False)
+  assert strip_comments("n = 0x1'f'f /**/", False) == ("n = 0x1'f'f  ", False)
+  assert strip_comments("c = u8'/'; // x", False) == ("c = u8'/'; ", False)
+  assert strip_comments("don't /* x", False) == ("don't ", True)
+  assert strip_comments('s = "/*"; // x', False) == ('s = "/*"; ', False)
+  assert strip_comments(r"c = '\''; /**/", False) == (r"c = '\'';  ", False)
+
+
+def parse_includes_conditional(text: str, macros: Macros) -> List[str]:
+  """
+  Like `parse_includes`, but skip #include lines that are in comments
+  or in conditional blocks that are inactive given `macros`.
+
+  #if, #ifdef, #ifndef, #elif, #else, and #endif are tracked, as are
+  #define and #undef within the file.  When a condition cannot be
+  evaluated (see `evaluate_condition`), every branch of that
+  conditional is treated as active, so its includes are kept.
+  """
+  # Definitions made by this file are local to it.
+  macros = dict(macros)
+  results: List[str] = []
+
+  # One entry per open conditional: [parent is active, current branch is
+  # active, some branch was taken, condition is unknown].
+  stack: List[List[bool]] = []
+  active = True
+
+  in_comment = False
+  lines = text.splitlines()
+  i = 0
+  while i < len(lines):
+    line, in_comment = strip_comments(lines[i], in_comment)
+    i += 1
+    if "#" not in line:
+      continue
+
+    # Join continuation lines of the directive.
+    while line.endswith("\\") and i < len(lines):
+      more, in_comment = strip_comments(lines[i], in_comment)
+      line = line[:-1] + more
+      i += 1
+
+    m = DIRECTIVE_RE.match(line)
+    if not m:
+      continue
+    name, rest = m.group(1), m.group(2).strip()
+
+    if name in ("if", "ifdef", "ifndef"):
+      cond: Optional[bool]
+      if name == "if":
+        cond = evaluate_condition(rest, macros) if active else False
+      else:
+        macro = rest.split()[0] if rest else ""
+        cond = (macro in macros) == (name == "ifdef")
+      if cond is None:
+        stack.append([active, active, False, True])
+      else:
+        stack.append([active, active and cond, cond, False])
+
+    elif name == "elif" and stack:
+      frame = stack[-1]
+      parent, _, taken, unknown = frame
+      if unknown:
+        frame[1] = parent
+      elif taken:
+        frame[1] = False
+      else:
+        cond = evaluate_condition(rest, macros) if parent else False
+        if cond is None:
+          frame[1] = parent
+          frame[3] = True
+        else:
+          frame[1] = parent and cond
+          frame[2] = cond
+
+    elif name == "else" and stack:
+      frame = stack[-1]
+      parent, _, taken, unknown = frame
+      frame[1] = parent if unknown else parent and not taken
+      frame[2] = True
+
+    elif name == "endif" and stack:
+      stack.pop()
+
+    elif not active:
+      continue
+
+    elif name == "include":
+      inc = QUOTED_INCLUDE_RE.match(rest)
+      if inc:
+        results.append(inc.group(1))
+
+    elif name == "define":
+      dm = DEFINE_RE.match(rest)
+      if dm:
+        # Function-like macros cannot be used by `evaluate_condition`,
+        # but they still count for `defined`.
+        macros[dm.group(1)] = "F()" if dm.group(2) else (dm.group(3) or "")
+
+    elif name == "undef":
+      macros.pop(rest.split()[0] if rest else "", None)
+
+    active = stack[-1][1] if stack else True
+
+  return results
+
+
+def test_parse_includes_conditional() -> None:
+  """Unit test for parse_includes_conditional."""
+  txt = """\
+#ifndef GUARD_H
+#define GUARD_H
+#include "always.h"
+#if 0
+#include "never.h"
+#else
+#include "else.h"
+#endif
+/* #include "commented.h"
+#include "commented2.h" */
+// #include "commented3.h"
+#ifdef WINDOWS
+#include "windows.h"
+#elif defined(LINUX) && \\
+      VERSION >= 2
+#include "linux.h"
+#else
+#include "other.h"
+#endif
+#if UNKNOWN_FN(1)
+#include "unknown-if.h"
+#else
+#include "unknown-else.h"
+#endif
+#define LOCAL 1
+#if LOCAL
+#include "local.h"
+#endif
+#endif
+"""
+  assert parse_includes_conditional(txt, {}) == [
+    "always.h", "else.h", "other.h", "unknown-if.h", "unknown-else.h",
+    "local.h"]
+  macros = parse_macro_definitions(["LINUX", "VERSION=2"])
+  assert parse_includes_conditional(txt, macros) == [
+    "always.h", "else.h", "linux.h", "unknown-if.h", "unknown-else.h",
+    "local.h"]
+  assert "windows.h" in parse_includes_conditional(txt, {"WINDOWS": "1"})
+
+  # Nested inside an inactive block, even unknown conditions are off.
+  txt = '#if 0\n#if FN(1)\n#include "a.h"\n#endif\n#endif\n#include "b.h"\n'
+  assert parse_includes_conditional(txt, {}) == ["b.h"]
+
+
+def extract_includes(text: str, macros: Optional[Macros]) -> List[str]:
+  """
+  Return the quoted includes in `text`: all of them if `macros` is None,
+  otherwise only those `parse_includes_conditional` finds.
+  """
+  if macros is None:
+    return parse_includes(text)
+  return parse_includes_conditional(text, macros)
+
+
+# ----------------------------------------------------------------------
+# Include cache
+
+# What is known about one scanned file: (modification time in ns, size,
+# content hash, includes found by `parse_includes`).
+CacheEntry = Tuple[int, int, str, List[str]]
+
+
+def content_hash(text: str) -> str:
+  """Return the hash of file contents `text` stored in the cache."""
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def scan_file(
+  fs: FileSystem,
+  fname: str,
+  old: Optional[CacheEntry],
+  macros: Optional[Macros] = None,
+) -> CacheEntry:
+  """
+  Return the cache entry for `fname`, reusing `old` (the previous entry,
+  if any) when the file has not changed.  The file is not read when its
+  time and size match `old`, and is not re-parsed when its contents
+  hash the same.  `macros` is passed to `extract_includes`.
+  """
+  # Stat before reading, so a change made while we read is seen as a
+  # change on the next run.
+  mtime_ns, size = fs.stat(fname)
+  if old is not None and old[0] == mtime_ns and old[1] == size:
+    return old
+
+  with profile_phase("reading"):
+    text = fs.read(fname)
+    digest = content_hash(text)
+  if old is not None and old[2] == digest:
+    return (mtime_ns, size, digest, old[3])
+  with profile_phase("parsing"):
+    return (mtime_ns, size, digest, extract_includes(text, macros))
+
+
+class IncludeCache:
+  """
+  Persistent map from file name to `CacheEntry`, stored as JSON.  File
+  names are relative to the analyzed directory, so each directory gets
+  its own cache file.
+  """
+
+  # Version of the file format.  A file with a different version is
+  # ignored.
+  VERSION = 1
+
+  def __init__(
+    self, cache_file: Optional[str] = None, macros: Optional[Macros] = None
+  ):
+    # Where `load` and `save` read and write, or None to keep the cache
+    # only in memory.
+    self.cache_file = cache_file
+
+    # The `macros` the includes were extracted with.  A cache file made
+    # with different macros is ignored.
+    self.macros = macros
+
+    self.entries: Dict[str, CacheEntry] = {}
+
+  @staticmethod
+  def default_file(path: str) -> str:
+    """Return the default cache file name for analyzing `path`."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or \
+      os.path.join(os.path.expanduser("~"), ".cache")
+    abspath = os.path.abspath(path)
+    key = hashlib.sha256(abspath.encode("utf-8")).hexdigest()[:16]
+    name = f"{os.path.basename(abspath) or 'root'}-{key}.json"
+    return os.path.join(cache_home, "analyze-cpp-module-deps", name)
+
+  def load(self) -> None:
+    """
+    Read the cache file, if it exists and has the right version and
+    macros.
+    """
+    if self.cache_file is None:
+      return
+    try:
+      with open(self.cache_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return
+    if data.get("version") != self.VERSION or \
+       data.get("macros") != self.macros:
+      return
+    self.entries = {
+      fname: (e[0], e[1], e[2], e[3]) for fname, e in data["files"].items()
+    }
+
+  def save(self) -> None:
+    """Write the cache file, replacing it atomically."""
+    if self.cache_file is None:
+      return
+    os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)),
+                exist_ok=True)
+    tmp = f"{self.cache_file}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+      json.dump({"version": self.VERSION, "macros": self.macros,
+                 "files": self.entries}, f, separators=(",", ":"))
+    os.replace(tmp, self.cache_file)
+
+
+def test_include_cache() -> None:
+  """Unit test for scan_file and IncludeCache."""
+  import tempfile
+
+  fs = FakeFileSystem({"a.cc": '#include "a.h"\n', "a.h": ""})
+  e1 = scan_file(fs, "a.cc", None)
+  assert e1[3] == ["a.h"] and fs.read_count == 1
+
+  # Unchanged: not read again.
+  assert scan_file(fs, "a.cc", e1) is e1
+  assert fs.read_count == 1
+
+  # Touched but same contents: read, entry updated, includes kept.
+  fs.write("a.cc", '#include "a.h"\n')
+  e2 = scan_file(fs, "a.cc", e1)
+  assert fs.read_count == 2 and e2[0] == 1 and e2[3] is e1[3]
+
+  # Changed contents: re-parsed.
+  fs.write("a.cc", '#include "b.h"\n')
+  assert scan_file(fs, "a.cc", e2)[3] == ["b.h"]
+
+  # Round trip through the cache file.
+  with tempfile.TemporaryDirectory() as tmpdir:
+    cache_file = os.path.join(tmpdir, "sub", "cache.json")
+    cache = IncludeCache(cache_file)
+    cache.load()
+    assert cache.entries == {}
+    cache.entries["a.cc"] = e1
+    cache.save()
+    cache2 = IncludeCache(cache_file)
+    cache2.load()
+    assert cache2.entries == {"a.cc": e1}
+
+    # Not used with different macros.
+    cache3 = IncludeCache(cache_file, {"A": "1"})
+    cache3.load()
+    assert cache3.entries == {}
+
+
+# ----------------------------------------------------------------------
+# Parallel scanning
+
+# File system and macros used by the worker processes of a scanning
+# pool.  They are set once per worker by `_init_scan_worker` so that
+# they do not have to be sent along with every task.
+_worker_fs: Optional[FileSystem] = None
+_worker_macros: Optional[Macros] = None
+
+
+def _init_scan_worker(fs: FileSystem, macros: Optional[Macros]) -> None:
+  """Pool initializer: remember the file system to read from, and close
+  it when the worker exits."""
+  global _worker_fs, _worker_macros
+  _worker_fs = fs
+  _worker_macros = macros
+  multiprocessing.util.Finalize(fs, fs.close, exitpriority=10)
+
+
+def _scan_worker(fname: str) -> List[str]:
+  """Pool task: read `fname` and return its quoted includes."""
+  assert _worker_fs is not None
+  return read_and_parse(_worker_fs, fname, _worker_macros)
+
+
+def _scan_cached_worker(task: Tuple[str, Optional[CacheEntry]]) -> CacheEntry:
+  """Pool task: `scan_file` for a file that missed the cache."""
+  assert _worker_fs is not None
+  return scan_file(_worker_fs, task[0], task[1], _worker_macros)
+
+
+def _run_pool(
+  fs: FileSystem,
+  macros: Optional[Macros],
+  jobs: int,
+  fn: Any,
+  tasks: List[Any],
+) -> List[Any]:
+  """Apply `fn` to each of `tasks` in a pool of `jobs` processes."""
+  # Use a few chunks per worker so that one slow chunk does not leave
+  # the other workers idle at the end.
+  chunksize = max(1, len(tasks) // (jobs * 4))
+  with concurrent.futures.ProcessPoolExecutor(
+    max_workers=jobs,
+    initializer=_init_scan_worker,
+    initargs=(fs, macros),
+  ) as executor:
+    # `map` yields results in the order of `tasks`.
+    return list(executor.map(fn, tasks, chunksize=chunksize))
+
+
+def scan_includes(
+  fs: FileSystem,
+  fnames: List[str],
+  jobs: int = 1,
+  cache: Optional[IncludeCache] = None,
+  macros: Optional[Macros] = None,
+) -> Dict[str, List[str]]:
+  """
+  Read each file in `fnames` and return a map from file name to the
+  list of quoted includes `extract_includes` found in it, given
+  `macros`.  When `jobs` is greater than 1, the files are scanned by
+  that many worker processes.
+
+  If `cache` is provided, files it has current entries for are not
+  read, and its entries are replaced with those for `fnames`.
+  """
+  # The workers of a pool are not profiled individually, so for them
+  # only the elapsed time is recorded.
+  pool_phase = "reading and parsing (parallel)"
+
+  if cache is None:
+    if jobs <= 1 or len(fnames) <= 1:
+      return {f: read_and_parse(fs, f, macros) for f in fnames}
+    with profile_phase(pool_phase):
+      return dict(zip(fnames, _run_pool(fs, macros, jobs, _scan_worker,
+                                        fnames)))
+
+  entries: Dict[str, CacheEntry] = {}
+  misses: List[Tuple[str, Optional[CacheEntry]]] = []
+  with profile_phase("cache lookup"):
+    for f in fnames:
+      old = cache.entries.get(f)
+      if old is not None and fs.stat(f) == (old[0], old[1]):
+        entries[f] = old
+      else:
+        misses.append((f, old))
+
+  if jobs <= 1 or len(misses) <= 1:
+    scanned = [scan_file(fs, f, old, macros) for f, old in misses]
+  else:
+    with profile_phase(pool_phase):
+      scanned = _run_pool(fs, macros, jobs, _scan_cached_worker, misses)
+  for (f, _), entry in zip(misses, scanned):
+    entries[f] = entry
+
+  # Dropping entries for files not in `fnames` keeps the cache from
+  # growing as files are deleted.
+  cache.entries = entries
+  return {f: entries[f][3] for f in fnames}
+
+
+def test_scan_includes() -> None:
+  """Unit test for scan_includes."""
+  fs = FakeFileSystem({
+    "a.cc": '#include "a.h"\n#include "b.h"\n',
+    "a.h": "",
+    "b.h": '#include "a.h"\n',
+  })
+  fnames = ["a.cc", "a.h", "b.h"]
+  serial = scan_includes(fs, fnames)
+  assert serial == {"a.cc": ["a.h", "b.h"], "a.h": [], "b.h": ["a.h"]}
+  assert scan_includes(fs, fnames, jobs=2) == serial
+
+  # With a cache, the second scan reads nothing.
+  cache = IncludeCache()
+  assert scan_includes(fs, fnames, cache=cache) == serial
+  reads = fs.read_count
+  assert scan_includes(fs, fnames, jobs=2, cache=cache) == serial
+  assert fs.read_count == reads
+
+  # Macros reach the workers.
+  fs.write("a.cc", '#ifdef B\n#include "b.h"\n#endif\n')
+  assert scan_includes(fs, fnames, jobs=2, macros={})["a.cc"] == []
+  assert scan_includes(fs, fnames, jobs=2, macros={"B": "1"})["a.cc"] == \
+    ["b.h"]
+
+
 # ----------------------------------------------------------------------
 # Dependency analysis
 def build_file_dependencies(
-  fs: FileSystem, path: str, modules: Dict[str, List[str]]
+  fs: FileSystem,
+  path: str,
+  modules: Dict[str, List[str]],
+  jobs: int = 1,
+  cache: Optional[IncludeCache] = None,
+  macros: Optional[Macros] = None,
 ) -> Dict[str, List[str]]:
-  """Build file-to-file dependency graph."""
+  """
+  Build file-to-file dependency graph.  `jobs`, `cache`, and `macros`
+  control how the files are scanned; see `scan_includes`.
+  """
   file_set = {f for files in modules.values() for f in files}
-  deps: Dict[str, Set[str]] = {f: set() for f in file_set}
-  cwd = os.path.basename(os.path.abspath(path))
-  for f in file_set:
-    contents = fs.read(f)
-    for inc in parse_includes(contents):
-      norm = normalize_include(inc, cwd)
-      if norm and norm in file_set:
-        deps[f].add(norm)
-  return {f: sorted(dests) for f, dests in deps.items()}
+  fnames = sorted(file_set)
+  deps: Dict[str, Set[str]] = {f: set() for f in fnames}
+  index = PathIndex(fnames, path)
+  file_includes = scan_includes(fs, fnames, jobs, cache, macros)
+  with profile_phase("graph building"):
+    for f, includes in file_includes.items():
+      for inc in includes:
+        target = index.resolve(f, inc)
+        if target is not None:
+          deps[f].add(target)
+    return {f: sorted(dests) for f, dests in deps.items()}
 
 
 def test_build_file_dependencies() -> None:
@@ -187,24 +1445,147 @@ def test_build_file_dependencies() -> None:
   assert fdeps["a.cc"] == ["a.h"]
   assert fdeps["b.cc"] == ["a.h"]
 
+  fs = FakeFileSystem({
+    "app/main.cc": '#include "util/str.h"\n#include "main.h"\n',
+    "app/main.h": '#include "app/other.h"\n',
+    "util/str.cc": '#include "str.h"\n',
+    "util/str.h": "",
+  })
+  mods = discover_modules(fs, ".", recursive=True)
+  fdeps = build_file_dependencies(fs, ".", mods)
+  assert fdeps == {
+    "app/main.cc": ["app/main.h", "util/str.h"],
+    "app/main.h": [],
+    "util/str.cc": ["util/str.h"],
+    "util/str.h": [],
+  }
+  assert build_module_dependencies(mods, fdeps) == {
+    "app/main": ["util/str"],
+    "util/str": [],
+  }
+
+
+# ----------------------------------------------------------------------
+# Interned graphs
+class IntGraph:
+  """
+  Directed graph whose nodes are the integers 0 to n-1, stored in
+  compressed sparse row form: the successors of node i are
+  targets[offsets[i]:offsets[i+1]].  `names[i]` is the name of node i.
+
+  This form avoids the per-node dictionaries, sets, and string
+  comparisons of `Dict[str, List[str]]`, so the graph algorithms run on
+  it and the string form is only used at the edges of the program.
+  """
+
+  def __init__(
+    self,
+    names: List[str],
+    offsets: "array.array[int]",
+    targets: "array.array[int]",
+  ):
+    assert len(offsets) == len(names) + 1
+    self.names = names
+    self.offsets = offsets
+    self.targets = targets
+
+  def __len__(self) -> int:
+    return len(self.names)
+
+  @staticmethod
+  def from_adjacency(graph: Dict[str, List[str]]) -> "IntGraph":
+    """
+    Intern `graph`.  Node ids follow the iteration order of `graph`,
+    and successor order is preserved.
+    """
+    names = list(graph)
+    ids = {n: i for i, n in enumerate(names)}.__getitem__
+    offsets = [0]
+    targets: List[int] = []
+    for succs in graph.values():
+      targets.extend(map(ids, succs))
+      offsets.append(len(targets))
+    return IntGraph(names, array.array("i", offsets),
+                    array.array("i", targets))
+
+  def to_adjacency(self) -> Dict[str, List[str]]:
+    """Return the graph with names in place of node ids."""
+    names, offsets, targets = self.names, self.offsets, self.targets
+    return {
+      n: [names[t] for t in targets[offsets[i]:offsets[i + 1]]]
+      for i, n in enumerate(names)}
+
+
+def test_int_graph() -> None:
+  """Unit test for IntGraph."""
+  adj = {"b": ["a", "c"], "a": [], "c": ["a"]}
+  g = IntGraph.from_adjacency(adj)
+  assert g.names == ["b", "a", "c"]
+  assert list(g.offsets) == [0, 2, 2, 3]
+  assert list(g.targets) == [1, 2, 1]
+  assert g.to_adjacency() == adj
+
+
+def int_build_module_dependencies(
+  file_graph: IntGraph, file_module: List[int], module_names: List[str]
+) -> IntGraph:
+  """
+  Compute the module graph from the file graph, where `file_module[f]`
+  is the id of the module, in `module_names`, that file f belongs to.
+  The successors of each module are sorted by id.
+  """
+  nmods = len(module_names)
+  files_of: List[List[int]] = [[] for _ in range(nmods)]
+  for f, m in enumerate(file_module):
+    files_of[m].append(f)
+
+  offsets, targets = file_graph.offsets, file_graph.targets
+
+  # `seen[d] == m` when the edge m -> d has already been recorded, which
+  # takes the place of a set of successors per module.
+  seen = [-1] * nmods
+
+  mod_offsets = array.array("i", [0])
+  mod_targets = array.array("i")
+  for m in range(nmods):
+    succs: List[int] = []
+    for f in files_of[m]:
+      for t in targets[offsets[f]:offsets[f + 1]]:
+        d = file_module[t]
+        if d != m and seen[d] != m:
+          seen[d] = m
+          succs.append(d)
+    succs.sort()
+    mod_targets.extend(succs)
+    mod_offsets.append(len(mod_targets))
+  return IntGraph(module_names, mod_offsets, mod_targets)
+
 
 def build_module_dependencies(
   modules: Dict[str, List[str]], file_deps: Dict[str, List[str]]
 ) -> Dict[str, List[str]]:
   """Compute module-to-module dependencies from file dependencies."""
-  file_to_mod: Dict[str, str] = {}
+  # Module ids in name order, so sorting ids sorts names.
+  mdeps = module_graph(dict(sorted(modules.items())), file_deps).to_adjacency()
+  return {m: mdeps[m] for m in modules}
+
+
+def module_graph(
+  modules: Dict[str, List[str]], file_deps: Dict[str, List[str]]
+) -> IntGraph:
+  """
+  Like `build_module_dependencies`, but return the interned graph.
+  Module ids follow the order of `modules`.
+  """
+  module_names = list(modules)
+  mod_ids = {m: i for i, m in enumerate(module_names)}
+  file_graph = IntGraph.from_adjacency(file_deps)
+  file_to_mod: Dict[str, int] = {}
   for mod, files in modules.items():
     for f in files:
-      file_to_mod[f] = mod
-
-  mdeps: Dict[str, Set[str]] = {m: set() for m in modules}
-  for src, dests in file_deps.items():
-    msrc = file_to_mod[src]
-    for d in dests:
-      mdst = file_to_mod[d]
-      if msrc != mdst:
-        mdeps[msrc].add(mdst)
-  return {m: sorted(ds) for m, ds in mdeps.items()}
+      file_to_mod[f] = mod_ids[mod]
+  file_module = [file_to_mod[f] for f in file_graph.names]
+  return int_build_module_dependencies(file_graph, file_module, module_names)
 
 
 def test_build_module_dependencies() -> None:
@@ -215,51 +1596,110 @@ def test_build_module_dependencies() -> None:
   assert mdeps["a"] == []
   assert mdeps["b"] == ["a"]
 
+  # Successors are sorted and de-duplicated.
+  mods = {"c": ["c.cc", "c.h"], "a": ["a.h"], "b": ["b.h"]}
+  fdeps = {"c.cc": ["b.h", "a.h"], "c.h": ["b.h"], "a.h": [], "b.h": []}
+  assert build_module_dependencies(mods, fdeps) == \
+    {"c": ["a", "b"], "a": [], "b": []}
+
 
 # ----------------------------------------------------------------------
 # Graph algorithms
+def int_strongly_connected_components(g: IntGraph) -> List[List[int]]:
+  """
+  Compute the strongly-connected components of `g`.  Returns the list
+  of SCCs, each a list of node ids, in reverse topological order.
+
+  This is Tarjan's algorithm, using an explicit stack rather than
+  recursion so that long dependency chains cannot exceed the Python
+  recursion limit.  Nodes are started in id order and successors are
+  explored in their stored order, so the result is what the recursive
+  formulation would produce.
+  """
+  n = len(g)
+  offsets, targets = g.offsets, g.targets
+
+  counter = 0
+  index = [-1] * n
+  lowlink = [0] * n
+  onstack = bytearray(n)
+  stack: List[int] = []
+  result: List[List[int]] = []
+
+  # The nodes whose successors are being explored, and for each, the
+  # position in `targets` of the next successor to look at.  This
+  # stands in for the call stack of the recursive algorithm.
+  work_node: List[int] = []
+  work_pos: List[int] = []
+
+  for root in range(n):
+    if index[root] >= 0:
+      continue
+
+    index[root] = lowlink[root] = counter
+    counter += 1
+    stack.append(root)
+    onstack[root] = 1
+    work_node.append(root)
+    work_pos.append(offsets[root])
+
+    while work_node:
+      v = work_node[-1]
+      pos = work_pos[-1]
+      end = offsets[v + 1]
+      descended = False
+      while pos < end:
+        w = targets[pos]
+        pos += 1
+        if index[w] < 0:
+          # "Call" on `w`.
+          work_pos[-1] = pos
+          index[w] = lowlink[w] = counter
+          counter += 1
+          stack.append(w)
+          onstack[w] = 1
+          work_node.append(w)
+          work_pos.append(offsets[w])
+          descended = True
+          break
+        elif onstack[w] and index[w] < lowlink[v]:
+          lowlink[v] = index[w]
+      if descended:
+        continue
+
+      # All successors of `v` are done: "return" from `v`.
+      work_node.pop()
+      work_pos.pop()
+      if lowlink[v] == index[v]:
+        comp = []
+        while True:
+          w = stack.pop()
+          onstack[w] = 0
+          comp.append(w)
+          if w == v:
+            break
+        result.append(comp)
+      if work_node:
+        parent = work_node[-1]
+        if lowlink[v] < lowlink[parent]:
+          lowlink[parent] = lowlink[v]
+
+  return result
+
+
 def strongly_connected_components(
   graph: Dict[str, List[str]]
 ) -> List[List[str]]:
   """
   Compute strongly-connected components of `graph` (module graph).
   Returns list of SCCs, each a list of nodes.
-  """
-  index = 0
-  indices: Dict[str, int] = {}
-  lowlink: Dict[str, int] = {}
-  stack: List[str] = []
-  onstack: Set[str] = set()
-  result: List[List[str]] = []
-
-  def strongconnect(v: str) -> None:
-    nonlocal index
-    indices[v] = index
-    lowlink[v] = index
-    index += 1
-    stack.append(v)
-    onstack.add(v)
-    for w in graph[v]:
-      if w not in indices:
-        strongconnect(w)
-        lowlink[v] = min(lowlink[v], lowlink[w])
-      elif w in onstack:
-        lowlink[v] = min(lowlink[v], indices[w])
-    if lowlink[v] == indices[v]:
-      comp = []
-      while True:
-        w = stack.pop()
-        onstack.remove(w)
-        comp.append(w)
-        if w == v:
-          break
-      result.append(sorted(comp))
 
-  for v in graph:
-    if v not in indices:
-      strongconnect(v)
-
-  return result
+  The SCCs are in reverse topological order; see
+  `int_strongly_connected_components`.
+  """
+  g = IntGraph.from_adjacency(graph)
+  return [sorted(g.names[v] for v in comp)
+          for comp in int_strongly_connected_components(g)]
 
 
 def test_strongly_connected_components() -> None:
@@ -269,53 +1709,87 @@ def test_strongly_connected_components() -> None:
   assert any(set(c) == {"a", "b"} for c in sccs)
   assert any(set(c) == {"c"} for c in sccs)
 
+  # Output order: successors' SCCs come first.
+  g = {"a": ["b", "d"], "b": ["c"], "c": ["a", "e"], "d": [], "e": ["e"]}
+  assert strongly_connected_components(g) == [["e"], ["d"], ["a", "b", "c"]]
 
-def topo_sort_sccs(
-  graph: Dict[str, List[str]], sccs: List[List[str]]
-) -> List[List[str]]:
-  """Topologically sort SCCs."""
+  # A chain far longer than the recursion limit.
+  n = 20000
+  g = {f"m{i}": ([f"m{i+1}"] if i + 1 < n else []) for i in range(n)}
+  sccs = strongly_connected_components(g)
+  assert len(sccs) == n
+  assert sccs[0] == [f"m{n-1}"] and sccs[-1] == ["m0"]
+
+  # A cycle just as long.
+  g[f"m{n-1}"] = ["m0"]
+  assert len(strongly_connected_components(g)) == 1
+
+
+def int_topo_sort_sccs(g: IntGraph, sccs: List[List[int]]) -> List[int]:
+  """
+  Topologically sort the SCCs `sccs` of `g`.  Returns the indices into
+  `sccs` in bottom-up order, i.e., each SCC after those it depends on.
+  """
+  offsets, targets = g.offsets, g.targets
+  nsccs = len(sccs)
 
   # Map from a node to the index in `sccs` where that node is found.
   # Assumes that each node appears in exactly one SCC.
-  node_to_scc: Dict[str, int] = {}
+  node_to_scc = [0] * len(g)
+  for i, comp in enumerate(sccs):
+    for v in comp:
+      node_to_scc[v] = i
+
+  # `g` modded by the `sccs` equivalence relation, as successor lists,
+  # along with the in-degree of each SCC.  `seen[d] == i` when the edge
+  # i -> d has already been recorded.
+  scc_succs: List[List[int]] = [[] for _ in range(nsccs)]
+  indeg = [0] * nsccs
+  seen = [-1] * nsccs
   for i, comp in enumerate(sccs):
-    for n in comp:
-      node_to_scc[n] = i
-
-  # Map from index in `sccs` to the set of other indices in `sccs` for
-  # which at least one member of the source SCC is connected to at least
-  # one menber of the dest SCC.  That is, this is `graph` modded by the
-  # `sccs` equivalence relation.
-  scc_graph: Dict[int, Set[int]] = {i: set() for i in range(len(sccs))}
-  for src, dests in graph.items():
-    for d in dests:
-      si, di = node_to_scc[src], node_to_scc[d]
-      if si != di:
-        scc_graph[si].add(di)
-
-  # Map from index in `sccs` to the number of indices in `sccs` that
-  # have an edge going to it, i.e., its in-degree.
-  indeg: Dict[int, int] = {i: 0 for i in scc_graph}
-  for i, ds in scc_graph.items():
-    for di in ds:
-      indeg[di] += 1
+    succs = scc_succs[i]
+    for v in comp:
+      for t in targets[offsets[v]:offsets[v + 1]]:
+        d = node_to_scc[t]
+        if d != i and seen[d] != i:
+          seen[d] = i
+          succs.append(d)
+          indeg[d] += 1
 
   order: List[int] = []
-  q = [i for i in scc_graph if indeg[i] == 0]
+  q = [i for i in range(nsccs) if indeg[i] == 0]
   while q:
     i = q.pop()
     order.append(i)
-    for di in scc_graph[i]:
-      indeg[di] -= 1
-      if indeg[di] == 0:
-        q.append(di)
-
-  ret = [sccs[i] for i in order]
+    for d in scc_succs[i]:
+      indeg[d] -= 1
+      if indeg[d] == 0:
+        q.append(d)
 
   # I want them in bottom-up order.
-  ret.reverse()
+  order.reverse()
 
-  return ret
+  return order
+
+
+def topo_sort_sccs(
+  graph: Dict[str, List[str]], sccs: List[List[str]]
+) -> List[List[str]]:
+  """Topologically sort SCCs."""
+  g = IntGraph.from_adjacency(graph)
+  ids = {n: i for i, n in enumerate(g.names)}
+  int_sccs = [[ids[n] for n in comp] for comp in sccs]
+  return [sccs[i] for i in int_topo_sort_sccs(g, int_sccs)]
+
+
+def sorted_sccs(g: IntGraph) -> List[List[str]]:
+  """
+  Return the SCCs of `g` in bottom-up order, as `topo_sort_sccs`
+  would, with each SCC's members sorted by id.
+  """
+  sccs = int_strongly_connected_components(g)
+  return [[g.names[v] for v in sorted(sccs[i])]
+          for i in int_topo_sort_sccs(g, sccs)]
 
 
 def test_topo_sort_sccs() -> None:
@@ -326,6 +1800,1782 @@ def test_topo_sort_sccs() -> None:
   flat = [n for comp in topo for n in comp]
   assert flat == ["c", "b", "a"]
 
+  # Each SCC comes after those it depends on, whatever order `sccs` is in.
+  g = {"a": ["b", "c"], "b": ["d"], "c": ["d", "e"], "d": ["c"], "e": []}
+  sccs = [["a"], ["c", "d"], ["e"], ["b"]]
+  topo = topo_sort_sccs(g, sccs)
+  assert sorted(topo) == sorted(sccs)
+  pos = {n: i for i, comp in enumerate(topo) for n in comp}
+  assert all(pos[d] <= pos[n] for n, ds in g.items() for d in ds)
+
+
+# ----------------------------------------------------------------------
+# Benchmark
+def make_synthetic_graph(
+  num_nodes: int, num_edges: int, seed: int = 1
+) -> Dict[str, List[str]]:
+  """
+  Return a random module graph with `num_nodes` nodes and about
+  `num_edges` edges.  Most edges go from a node to one with a lower
+  number, as in a layered code base, but a few go the other way to a
+  nearby node, creating cycles.  Node 0 has a long dependency chain
+  below it.
+  """
+  rng = random.Random(seed)
+  names = [f"m{i}" for i in range(num_nodes)]
+  succs: List[Set[int]] = [set() for _ in range(num_nodes)]
+
+  # A chain through all nodes, the worst case for recursion depth.
+  for i in range(num_nodes - 1):
+    succs[i + 1].add(i)
+
+  for _ in range(max(0, num_edges - (num_nodes - 1))):
+    src = rng.randrange(1, num_nodes)
+    if rng.random() < 0.01:
+      dst = min(num_nodes - 1, src + rng.randrange(1, 10))
+    else:
+      dst = rng.randrange(0, src)
+    succs[src].add(dst)
+
+  return {names[i]: sorted(names[j] for j in succs[i])
+          for i in range(num_nodes)}
+
+
+def benchmark_graph_algorithms(
+  num_nodes: int = 100000, num_edges: int = 1000000
+) -> None:
+  """
+  Time `strongly_connected_components` and `topo_sort_sccs` on a
+  synthetic graph, and their interned counterparts, and print the
+  results.
+  """
+  start = time.perf_counter()
+  g = make_synthetic_graph(num_nodes, num_edges)
+  actual_edges = sum(len(ds) for ds in g.values())
+  print(f"graph: {num_nodes} nodes, {actual_edges} edges, "
+        f"built in {time.perf_counter() - start:.3f}s")
+
+  start = time.perf_counter()
+  ig = IntGraph.from_adjacency(g)
+  print(f"IntGraph.from_adjacency: {time.perf_counter() - start:.3f}s")
+
+  start = time.perf_counter()
+  int_sccs = int_strongly_connected_components(ig)
+  print(f"int_strongly_connected_components: {len(int_sccs)} SCCs, "
+        f"{time.perf_counter() - start:.3f}s")
+
+  start = time.perf_counter()
+  order = int_topo_sort_sccs(ig, int_sccs)
+  print(f"int_topo_sort_sccs: {len(order)} SCCs, "
+        f"{time.perf_counter() - start:.3f}s")
+
+  start = time.perf_counter()
+  sccs = strongly_connected_components(g)
+  print(f"strongly_connected_components: {len(sccs)} SCCs, "
+        f"{time.perf_counter() - start:.3f}s")
+
+  start = time.perf_counter()
+  topo = topo_sort_sccs(g, sccs)
+  print(f"topo_sort_sccs: {len(topo)} SCCs, "
+        f"{time.perf_counter() - start:.3f}s")
+
+
+# ----------------------------------------------------------------------
+# Complete analysis
+def analyze(
+  fs: FileSystem,
+  path: str,
+  jobs: int = 1,
+  cache: Optional[IncludeCache] = None,
+  recursive: bool = False,
+  macros: Optional[Macros] = None,
+) -> Dict[str, Any]:
+  """
+  Analyze the modules in `path` and return the result object that
+  `main` prints as JSON.
+  """
+  with profile_phase("discovery"):
+    modules = discover_modules(fs, path, recursive)
+  fdeps = build_file_dependencies(fs, path, modules, jobs, cache, macros)
+
+  # The module graph algorithms run on the interned form.  Module ids
+  # are in name order, so each SCC's members come out sorted.
+  with profile_phase("graph building"):
+    mgraph = module_graph(modules, fdeps)
+    return {
+      "files": sorted(f for flist in modules.values() for f in flist),
+      "file_dependencies": fdeps,
+      "module_files": {m: sorted(fl) for m, fl in modules.items()},
+      "module_dependencies": mgraph.to_adjacency(),
+      "module_sccs": sorted_sccs(mgraph),
+    }
+
+
+# ----------------------------------------------------------------------
+# Output formats
+OUTPUT_FORMATS = ["json", "compact", "jsonl", "binary"]
+
+
+def write_json(out: TextIO, result: Dict[str, Any], compact: bool) -> None:
+  """Write `result` to `out` as JSON, indented unless `compact`."""
+  # `json.dump` always uses the pure Python encoder, and writes each
+  # piece separately; `json.dumps` uses the C encoder when not indenting.
+  if compact:
+    out.write(json.dumps(result, separators=(",", ":")))
+  else:
+    out.write(json.dumps(result, indent=2))
+  out.write("\n")
+
+
+def stream_jsonl(
+  out: TextIO,
+  fs: FileSystem,
+  path: str,
+  jobs: int = 1,
+  cache: Optional[IncludeCache] = None,
+  recursive: bool = False,
+  macros: Optional[Macros] = None,
+) -> None:
+  """
+  Analyze `path` like `analyze`, but write the result to `out` as JSON
+  Lines, one record per line:
+
+    {"type": "file", "name": F, "module": M, "dependencies": [...]}
+    {"type": "module", "name": M, "files": [...], "dependencies": [...]}
+    {"type": "scc", "modules": [...]}
+
+  The file records are written once the whole file graph is built,
+  before the module graph and SCCs are computed, and so on.  Each group
+  is held in memory until it is written, but the complete result is
+  never held as one string.
+  """
+  with profile_phase("discovery"):
+    modules = discover_modules(fs, path, recursive)
+  fdeps = build_file_dependencies(fs, path, modules, jobs, cache, macros)
+  with profile_phase("serialization"):
+    _write_file_records(out, modules, fdeps)
+
+  with profile_phase("graph building"):
+    mgraph = module_graph(modules, fdeps)
+    mdeps = mgraph.to_adjacency()
+  with profile_phase("serialization"):
+    _write_module_records(out, modules, mdeps)
+
+  with profile_phase("graph building"):
+    sccs = sorted_sccs(mgraph)
+  with profile_phase("serialization"):
+    _write_scc_records(out, sccs)
+
+
+def write_jsonl(out: TextIO, result: Dict[str, Any]) -> None:
+  """Write an already computed `result` in the `stream_jsonl` format."""
+  _write_file_records(out, result["module_files"],
+                      result["file_dependencies"])
+  _write_module_records(out, result["module_files"],
+                        result["module_dependencies"])
+  _write_scc_records(out, result["module_sccs"])
+
+
+def _write_file_records(
+  out: TextIO, modules: Dict[str, List[str]], fdeps: Dict[str, List[str]]
+) -> None:
+  """Write the "file" records of the JSON Lines format."""
+  file_to_mod = {f: m for m, files in modules.items() for f in files}
+  for f in sorted(fdeps):
+    out.write(json.dumps({"type": "file", "name": f,
+                          "module": file_to_mod[f],
+                          "dependencies": fdeps[f]}) + "\n")
+  out.flush()
+
+
+def _write_module_records(
+  out: TextIO, modules: Dict[str, List[str]], mdeps: Dict[str, List[str]]
+) -> None:
+  """Write the "module" records of the JSON Lines format."""
+  for m in sorted(mdeps):
+    out.write(json.dumps({"type": "module", "name": m,
+                          "files": modules[m],
+                          "dependencies": mdeps[m]}) + "\n")
+  out.flush()
+
+
+def _write_scc_records(out: TextIO, sccs: List[List[str]]) -> None:
+  """Write the "scc" records of the JSON Lines format."""
+  for comp in sccs:
+    out.write(json.dumps({"type": "scc", "modules": comp}) + "\n")
+  out.flush()
+
+
+def read_jsonl(text: str) -> Dict[str, Any]:
+  """Decode JSON Lines output into the result object `analyze` returns."""
+  result: Dict[str, Any] = {
+    "files": [],
+    "file_dependencies": {},
+    "module_files": {},
+    "module_dependencies": {},
+    "module_sccs": [],
+  }
+  for line in text.splitlines():
+    rec = json.loads(line)
+    if rec["type"] == "file":
+      result["files"].append(rec["name"])
+      result["file_dependencies"][rec["name"]] = rec["dependencies"]
+    elif rec["type"] == "module":
+      result["module_files"][rec["name"]] = rec["files"]
+      result["module_dependencies"][rec["name"]] = rec["dependencies"]
+    elif rec["type"] == "scc":
+      result["module_sccs"].append(rec["modules"])
+  return result
+
+
+# Binary format: magic, format version, and count fields.
+BINARY_MAGIC = b"CPPDEPS\0"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<8s6I")
+
+
+def _u32_array(values: Iterable[int]) -> "array.array[int]":
+  """Return `values` as an array of little-endian 32-bit integers."""
+  a = array.array("I", values)
+  assert a.itemsize == 4
+  if sys.byteorder != "little":
+    a.byteswap()
+  return a
+
+
+def _csr(
+  names: List[str], ids: Dict[str, int], adj: Dict[str, List[str]]
+) -> Tuple["array.array[int]", "array.array[int]"]:
+  """
+  Return (offsets, targets) arrays encoding `adj`: the successors of
+  node i are targets[offsets[i]:offsets[i+1]].
+  """
+  offsets = [0]
+  targets: List[int] = []
+  for n in names:
+    targets.extend(ids[d] for d in adj[n])
+    offsets.append(len(targets))
+  return _u32_array(offsets), _u32_array(targets)
+
+
+def write_binary(out: BinaryIO, result: Dict[str, Any]) -> None:
+  """
+  Write `result` to `out` in the binary adjacency format.  All integers
+  are unsigned 32-bit little-endian.  After the header:
+
+    names          each file name, then each module name, as a u32
+                   length followed by that many bytes of UTF-8
+    file_module    num_files module ids
+    file_offsets   num_files+1 offsets into file_targets
+    file_targets   num_file_edges file ids
+    mod_offsets    num_modules+1 offsets into mod_targets
+    mod_targets    num_module_edges module ids
+    scc_offsets    num_sccs+1 offsets into scc_members
+    scc_members    num_modules module ids, SCCs in bottom-up order
+
+  File ids and module ids are indices into the sorted lists of names.
+  The header is the magic string, the format version, and the numbers
+  of files, modules, file edges, module edges, and SCCs.
+  """
+  files: List[str] = result["files"]
+  mods = sorted(result["module_files"])
+  file_ids = {f: i for i, f in enumerate(files)}
+  mod_ids = {m: i for i, m in enumerate(mods)}
+
+  file_to_mod = {f: m for m, fl in result["module_files"].items()
+                 for f in fl}
+  file_offsets, file_targets = _csr(
+    files, file_ids, result["file_dependencies"])
+  mod_offsets, mod_targets = _csr(
+    mods, mod_ids, result["module_dependencies"])
+  sccs: List[List[str]] = result["module_sccs"]
+  scc_offsets = [0]
+  for comp in sccs:
+    scc_offsets.append(scc_offsets[-1] + len(comp))
+
+  out.write(BINARY_HEADER.pack(
+    BINARY_MAGIC, BINARY_VERSION, len(files), len(mods),
+    len(file_targets), len(mod_targets), len(sccs)))
+  for name in files + mods:
+    b = name.encode("utf-8")
+    out.write(struct.pack("<I", len(b)))
+    out.write(b)
+  for a in [
+    _u32_array(mod_ids[file_to_mod[f]] for f in files),
+    file_offsets, file_targets,
+    mod_offsets, mod_targets,
+    _u32_array(scc_offsets),
+    _u32_array(mod_ids[m] for comp in sccs for m in comp),
+  ]:
+    out.write(a.tobytes())
+
+
+def read_binary(data: bytes) -> Dict[str, Any]:
+  """
+  Decode the output of `write_binary` into the result object `analyze`
+  returns.
+  """
+  magic, version, nfiles, nmods, nfedges, nmedges, nsccs = \
+    BINARY_HEADER.unpack_from(data, 0)
+  if magic != BINARY_MAGIC or version != BINARY_VERSION:
+    raise ValueError("not a module dependency file of a known version")
+  pos = BINARY_HEADER.size
+
+  names: List[str] = []
+  for _ in range(nfiles + nmods):
+    (n,) = struct.unpack_from("<I", data, pos)
+    names.append(data[pos + 4:pos + 4 + n].decode("utf-8"))
+    pos += 4 + n
+  files, mods = names[:nfiles], names[nfiles:]
+
+  def take(count: int) -> "array.array[int]":
+    nonlocal pos
+    a = array.array("I", data[pos:pos + 4 * count])
+    if sys.byteorder != "little":
+      a.byteswap()
+    pos += 4 * count
+    return a
+
+  file_module = take(nfiles)
+  file_offsets, file_targets = take(nfiles + 1), take(nfedges)
+  mod_offsets, mod_targets = take(nmods + 1), take(nmedges)
+  scc_offsets, scc_members = take(nsccs + 1), take(nmods)
+
+  module_files: Dict[str, List[str]] = {m: [] for m in mods}
+  for i, f in enumerate(files):
+    module_files[mods[file_module[i]]].append(f)
+  return {
+    "files": files,
+    "file_dependencies": {
+      f: [files[t] for t in file_targets[file_offsets[i]:file_offsets[i+1]]]
+      for i, f in enumerate(files)},
+    "module_files": module_files,
+    "module_dependencies": {
+      m: [mods[t] for t in mod_targets[mod_offsets[i]:mod_offsets[i+1]]]
+      for i, m in enumerate(mods)},
+    "module_sccs": [
+      [mods[t] for t in scc_members[scc_offsets[i]:scc_offsets[i+1]]]
+      for i in range(nsccs)],
+  }
+
+
+def write_result(result: Dict[str, Any], fmt: str) -> None:
+  """Write `result` to stdout in format `fmt`."""
+  if fmt == "binary":
+    sys.stdout.flush()
+    write_binary(sys.stdout.buffer, result)
+  elif fmt == "jsonl":
+    write_jsonl(sys.stdout, result)
+  else:
+    write_json(sys.stdout, result, fmt == "compact")
+
+
+def load_result(fname: str) -> Dict[str, Any]:
+  """
+  Read a result previously written by this script, in any of the output
+  formats.
+  """
+  with open(fname, "rb") as f:
+    data = f.read()
+  if data.startswith(BINARY_MAGIC):
+    return read_binary(data)
+  text = data.decode("utf-8")
+  if text.lstrip().startswith('{"type"'):
+    return read_jsonl(text)
+  result: Dict[str, Any] = json.loads(text)
+  return result
+
+
+def test_output_formats() -> None:
+  """Unit test for write_json, stream_jsonl, and the binary format."""
+  import io
+
+  fs = FakeFileSystem({
+    "a.cc": '#include "a.h"\n#include "b.h"\n',
+    "a.h": "",
+    "b.cc": '#include "b.h"\n',
+    "b.h": '#include "a.h"\n',
+  })
+  result = analyze(fs, ".")
+
+  text = io.StringIO()
+  write_json(text, result, compact=False)
+  assert text.getvalue() == json.dumps(result, indent=2) + "\n"
+  text = io.StringIO()
+  write_json(text, result, compact=True)
+  assert "\n" not in text.getvalue().rstrip("\n")
+  assert json.loads(text.getvalue()) == result
+
+  text = io.StringIO()
+  stream_jsonl(text, fs, ".")
+  records = [json.loads(line) for line in text.getvalue().splitlines()]
+  assert [r["type"] for r in records] == \
+    ["file"] * 4 + ["module"] * 2 + ["scc"]
+  assert records[0] == {"type": "file", "name": "a.cc", "module": "a",
+                        "dependencies": ["a.h", "b.h"]}
+  assert records[5] == {"type": "module", "name": "b",
+                        "files": ["b.cc", "b.h"], "dependencies": ["a"]}
+  assert [r["modules"] for r in records[6:]] == result["module_sccs"]
+  assert read_jsonl(text.getvalue()) == result
+  text2 = io.StringIO()
+  write_jsonl(text2, result)
+  assert text2.getvalue() == text.getvalue()
+
+  data = io.BytesIO()
+  write_binary(data, result)
+  assert read_binary(data.getvalue()) == result
+
+  # `load_result` recognizes each format.
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fname = os.path.join(tmpdir, "result")
+    for contents in [data.getvalue(), text.getvalue().encode("utf-8"),
+                     json.dumps(result).encode("utf-8")]:
+      with open(fname, "wb") as f:
+        f.write(contents)
+      assert load_result(fname) == result
+
+
+# ----------------------------------------------------------------------
+# Incremental analysis
+class DependencyGraph:
+  """
+  The result of analyzing a directory, kept up to date as files change.
+
+  Construction performs the same analysis as `analyze`.  Afterward,
+  `update` accepts lists of changed, added, and removed files, and
+  adjusts the file graph, module graph, and SCC order by re-scanning
+  and re-resolving only the affected files and re-ordering only the
+  affected part of the SCC order.
+
+  The SCC order maintained by `update` is a valid bottom-up order, but
+  is not necessarily the one `topo_sort_sccs` would choose.
+  """
+
+  def __init__(
+    self,
+    fs: FileSystem,
+    path: str,
+    recursive: bool = False,
+    jobs: int = 1,
+    cache: Optional[IncludeCache] = None,
+    macros: Optional[Macros] = None,
+  ):
+    self.fs = fs
+    self.path = path
+    self.recursive = recursive
+    self.macros = macros
+
+    # All files in the analyzed directory, whether or not they belong
+    # to a module.
+    self.all_files: Set[str] = set(
+      fs.walk(path) if recursive else fs.listdir(path))
+
+    # Map from module name to its sorted files.
+    self.modules = discover_modules(fs, path, recursive)
+
+    # Map from analyzed file to the module it belongs to.
+    self.file_to_mod: Dict[str, str] = {
+      f: m for m, files in self.modules.items() for f in files}
+
+    fnames = sorted(self.file_to_mod)
+    self.index = PathIndex(fnames, path)
+
+    # Map from analyzed file to the quoted includes found in it.
+    self.includes = scan_includes(fs, fnames, jobs, cache, macros)
+
+    # Map from the last component of an include name to the files that
+    # include it.  When a file with that name appears or disappears,
+    # those are the files whose includes might resolve differently.
+    self.includers: Dict[str, Set[str]] = defaultdict(set)
+    for f, incs in self.includes.items():
+      self._add_includers(f, incs)
+
+    # File-to-file dependencies.
+    self.file_deps: Dict[str, Set[str]] = {}
+
+    # Module-to-module dependencies.
+    self.mod_deps: Dict[str, Set[str]] = {m: set() for m in self.modules}
+
+    # Number of file dependencies that make up each module dependency.
+    self.mod_edge_count: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    for f in fnames:
+      self.file_deps[f] = set()
+      self._add_file_edges(f, None)
+
+    # SCCs of the module graph in bottom-up order, and the map from each
+    # module to the index of its SCC in `sccs`.
+    mdeps = {m: sorted(ds) for m, ds in self.mod_deps.items()}
+    self.sccs = topo_sort_sccs(mdeps, strongly_connected_components(mdeps))
+    self.scc_index: Dict[str, int] = {}
+    self._renumber(0)
+
+  # ---- queries ----
+  def result(self) -> Dict[str, Any]:
+    """Return the result object, in the same form `analyze` returns."""
+    return {
+      "files": sorted(self.file_to_mod),
+      "file_dependencies": {
+        f: sorted(self.file_deps[f]) for f in sorted(self.file_deps)},
+      "module_files": dict(sorted(self.modules.items())),
+      "module_dependencies": {
+        m: sorted(self.mod_deps[m]) for m in sorted(self.mod_deps)},
+      "module_sccs": [list(c) for c in self.sccs],
+    }
+
+  # ---- updates ----
+  def update(
+    self,
+    changed: Iterable[str] = (),
+    added: Iterable[str] = (),
+    removed: Iterable[str] = (),
+  ) -> None:
+    """
+    Update the analysis after the files in `changed` have been
+    modified, those in `added` created, and those in `removed` deleted.
+    File names are relative to the analyzed directory.
+
+    The files are re-scanned before anything else is changed, so if
+    reading one fails, the exception propagates and the graph is left
+    as it was.
+    """
+    added = [f for f in added if self._in_scope(f)]
+    removed = [f for f in removed if f in self.all_files]
+    all_files = (self.all_files | set(added)) - set(removed)
+
+    # Recompute the membership of the modules the added and removed
+    # files could belong to.
+    new_membership: Dict[str, List[str]] = {}
+    for f in added + removed:
+      for m in module_candidates(f):
+        if m not in new_membership:
+          new_membership[m] = module_files_in(m, all_files)
+    entering: Set[str] = set()
+    leaving: Set[str] = set()
+    for m, files in new_membership.items():
+      old = self.modules.get(m, [])
+      entering.update(f for f in files if f not in old)
+      leaving.update(f for f in old if f not in files)
+
+    # Files whose includes must be re-resolved: those with an include
+    # naming a file that entered or left the analysis.
+    reresolve: Set[str] = set()
+    for f in entering | leaving:
+      reresolve.update(self.includers.get(posixpath.basename(f), ()))
+    rescan = ({f for f in changed if f in self.file_to_mod} | entering) - \
+      leaving
+    reresolve = (reresolve | rescan) - leaving
+
+    rescanned = scan_includes(self.fs, sorted(rescan), macros=self.macros)
+    self.all_files = all_files
+
+    # Module dependencies as they were, for those that are touched.
+    before: Dict[Tuple[str, str], bool] = {}
+
+    # Remove the dependencies of everything that is leaving or will be
+    # re-resolved, while `file_to_mod` still has the old modules.
+    for f in (reresolve - entering) | leaving:
+      self._remove_file_edges(f, before)
+    for f in leaving:
+      self._remove_includers(f, self.includes.pop(f))
+      del self.file_deps[f]
+      del self.file_to_mod[f]
+      self.index.remove(f)
+
+    # Apply the new module membership.
+    new_mods: List[str] = []
+    gone_mods: List[str] = []
+    for m, files in new_membership.items():
+      if files:
+        if m not in self.modules:
+          new_mods.append(m)
+          self.mod_deps[m] = set()
+        self.modules[m] = files
+        for f in files:
+          self.file_to_mod[f] = m
+      elif m in self.modules:
+        gone_mods.append(m)
+        del self.modules[m]
+    for f in entering:
+      self.file_deps[f] = set()
+      self.index.add(f)
+
+    # Apply the re-scan and re-resolve.
+    for f, incs in rescanned.items():
+      if f in self.includes:
+        self._remove_includers(f, self.includes[f])
+      self.includes[f] = incs
+      self._add_includers(f, incs)
+    for f in reresolve:
+      self._add_file_edges(f, before)
+
+    # Net changes to the module graph.
+    added_edges = [e for e, had in before.items()
+                   if not had and self.mod_edge_count.get(e, 0) > 0]
+    removed_edges = [e for e, had in before.items()
+                     if had and self.mod_edge_count.get(e, 0) == 0]
+    for e in removed_edges:
+      self.mod_edge_count.pop(e, None)
+    self._update_sccs(new_mods, gone_mods, added_edges, removed_edges)
+    for m in gone_mods:
+      del self.mod_deps[m]
+
+  # ---- implementation ----
+  def _in_scope(self, fname: str) -> bool:
+    """True if `fname` is in the analyzed directory tree."""
+    return self.recursive or "/" not in fname
+
+  def _add_includers(self, f: str, incs: List[str]) -> None:
+    """Record that `f` includes `incs`."""
+    for inc in incs:
+      self.includers[posixpath.basename(inc)].add(f)
+
+  def _remove_includers(self, f: str, incs: List[str]) -> None:
+    """Undo `_add_includers(f, incs)`."""
+    for inc in incs:
+      name = posixpath.basename(inc)
+      self.includers[name].discard(f)
+      if not self.includers[name]:
+        del self.includers[name]
+
+  def _touch_edge(
+    self, e: Tuple[str, str], before: Optional[Dict[Tuple[str, str], bool]]
+  ) -> None:
+    """Remember whether module edge `e` existed before this update."""
+    if before is not None and e not in before:
+      before[e] = self.mod_edge_count.get(e, 0) > 0
+
+  def _add_file_edges(
+    self, f: str, before: Optional[Dict[Tuple[str, str], bool]]
+  ) -> None:
+    """Resolve the includes of `f` and add its dependencies."""
+    msrc = self.file_to_mod[f]
+    deps = self.file_deps[f]
+    for inc in self.includes[f]:
+      target = self.index.resolve(f, inc)
+      if target is None or target in deps:
+        continue
+      deps.add(target)
+      mdst = self.file_to_mod[target]
+      if msrc != mdst:
+        e = (msrc, mdst)
+        self._touch_edge(e, before)
+        self.mod_edge_count[e] += 1
+        self.mod_deps[msrc].add(mdst)
+
+  def _remove_file_edges(
+    self, f: str, before: Dict[Tuple[str, str], bool]
+  ) -> None:
+    """Remove the dependencies of `f`."""
+    msrc = self.file_to_mod[f]
+    for target in self.file_deps[f]:
+      mdst = self.file_to_mod[target]
+      if msrc != mdst:
+        e = (msrc, mdst)
+        self._touch_edge(e, before)
+        self.mod_edge_count[e] -= 1
+        if self.mod_edge_count[e] == 0:
+          self.mod_deps[msrc].discard(mdst)
+    self.file_deps[f] = set()
+
+  def _renumber(self, start: int) -> None:
+    """Refresh `scc_index` for the SCCs at `start` and later."""
+    for i in range(start, len(self.sccs)):
+      for m in self.sccs[i]:
+        self.scc_index[m] = i
+
+  def _resort(self, lo: int, hi: int) -> None:
+    """
+    Recompute the SCCs and their order for the SCCs in positions
+    `lo` through `hi`, inclusive, of `sccs`.  This is valid as long as
+    any changed edges have both ends in that range.
+    """
+    members = {m for comp in self.sccs[lo:hi + 1] for m in comp}
+    sub = {m: [d for d in sorted(self.mod_deps[m]) if d in members]
+           for m in sorted(members)}
+    self.sccs[lo:hi + 1] = strongly_connected_components(sub)
+    self._renumber(lo)
+
+  def _update_sccs(
+    self,
+    new_mods: List[str],
+    gone_mods: List[str],
+    added_edges: List[Tuple[str, str]],
+    removed_edges: List[Tuple[str, str]],
+  ) -> None:
+    """Update `sccs` for the given module graph changes."""
+    # New modules start as singleton SCCs at the top.
+    for m in new_mods:
+      self.scc_index[m] = len(self.sccs)
+      self.sccs.append([m])
+
+    # Removing an edge between SCCs leaves the order valid.  Removing
+    # one within an SCC may split it, which can be found by looking at
+    # just that SCC.
+    for src, dst in removed_edges:
+      if src in self.scc_index and \
+         self.scc_index[src] == self.scc_index.get(dst) and \
+         len(self.sccs[self.scc_index[src]]) > 1:
+        i = self.scc_index[src]
+        self._resort(i, i)
+
+    # Adding an edge to an SCC that is already below the source leaves
+    # the order valid.  Otherwise, any new cycle, and any part of the
+    # order that must change, lies between the two positions.
+    for src, dst in added_edges:
+      lo, hi = self.scc_index[src], self.scc_index[dst]
+      if lo < hi:
+        self._resort(lo, hi)
+
+    # Removed modules have no edges by now.
+    for m in gone_mods:
+      i = self.scc_index.pop(m)
+      self.sccs[i] = [x for x in self.sccs[i] if x != m]
+      if not self.sccs[i]:
+        del self.sccs[i]
+        self._renumber(i)
+
+
+def check_dependency_graph(g: DependencyGraph) -> None:
+  """
+  Assert that `g` agrees with a fresh analysis of its file system,
+  with the SCCs forming a valid bottom-up order.
+  """
+  expect = analyze(g.fs, g.path, recursive=g.recursive, macros=g.macros)
+  actual = g.result()
+  for key in ["files", "file_dependencies", "module_files",
+              "module_dependencies"]:
+    assert actual[key] == expect[key], key
+  assert sorted(actual["module_sccs"]) == sorted(expect["module_sccs"])
+  seen: Set[str] = set()
+  for comp in actual["module_sccs"]:
+    for m in comp:
+      assert all(d in seen or d in comp for d in g.mod_deps[m])
+    seen.update(comp)
+
+
+def test_dependency_graph() -> None:
+  """Unit test for DependencyGraph."""
+  fs = FakeFileSystem({
+    "a.cc": '#include "a.h"\n',
+    "a.h": "",
+    "b.cc": '#include "b.h"\n',
+    "b.h": '#include "a.h"\n',
+    "c.h": "",
+  })
+  g = DependencyGraph(fs, ".")
+  check_dependency_graph(g)
+  assert g.result() == analyze(fs, ".")
+
+  # Create a cycle between a and b.
+  fs.write("a.h", '#include "b.h"\n')
+  g.update(changed=["a.h"])
+  check_dependency_graph(g)
+  assert ["a", "b"] in g.sccs
+
+  # Break it again.
+  fs.write("a.h", "")
+  g.update(changed=["a.h"])
+  check_dependency_graph(g)
+  assert g.sccs == [["a"], ["b"]]
+
+  # c.h joins the analysis when c.cc is added, and the existing include
+  # of c.h now resolves.
+  fs.write("a.cc", '#include "a.h"\n#include "c.h"\n')
+  g.update(changed=["a.cc"])
+  check_dependency_graph(g)
+  fs.write("c.cc", '#include "b.h"\n')
+  g.update(added=["c.cc"])
+  check_dependency_graph(g)
+  assert g.mod_deps["a"] == {"c"}
+  assert ["a", "b", "c"] in g.sccs
+
+  # Removing c.cc removes module c and breaks the cycle.
+  del fs._files["c.cc"]
+  g.update(removed=["c.cc"])
+  check_dependency_graph(g)
+  assert g.mod_deps["a"] == set()
+  assert "c" not in g.modules
+
+  # A file that cannot be read leaves the graph as it was.
+  fs.write("a.cc", '#include "b.h"\n')
+  g.update(changed=["a.cc"])
+  before = g.result()
+  contents = fs._files.pop("a.cc")
+  try:
+    g.update(changed=["a.cc"])
+    assert False, "update should fail"
+  except KeyError:
+    pass
+  assert g.result() == before and g.mod_deps["a"] == {"b"}
+  fs.write("a.cc", contents)
+  g.update(changed=["a.cc"])
+  check_dependency_graph(g)
+
+  # A random sequence of edits agrees with a fresh analysis each time.
+  rng = random.Random(2)
+  names = [f"{m}{suff}" for m in "pqrstu" for suff in [".h", ".cc"]]
+  fs = FakeFileSystem({})
+  g = DependencyGraph(fs, ".")
+  for _ in range(200):
+    f = rng.choice(names)
+    text = "".join(f'#include "{rng.choice(names)}"\n'
+                   for _ in range(rng.randrange(3)))
+    if f in fs._files and rng.random() < 0.3:
+      del fs._files[f]
+      g.update(removed=[f])
+    elif f in fs._files:
+      fs.write(f, text)
+      g.update(changed=[f])
+    else:
+      fs.write(f, text)
+      g.update(added=[f])
+    check_dependency_graph(g)
+
+
+# ----------------------------------------------------------------------
+# Layering rules
+class LayeringRules:
+  """
+  Rules constraining the module graph, read from a rules file.  Each
+  non-blank line, after removing any "#" comment, is one of:
+
+    deny SRC DST        No module matching SRC may depend on a module
+                        matching DST.
+    layers P1 P2 ...    Modules matching an earlier pattern (a lower
+                        layer) may not depend on modules matching a
+                        later one.  A module is in the first layer it
+                        matches, if any.
+    acyclic PATTERN     Modules matching PATTERN may not be in a
+                        dependency cycle with each other.
+
+  Patterns are shell-style globs (see `fnmatch`) on module names, such
+  as "util/*".
+  """
+
+  def __init__(self, fname: str = "<rules>"):
+    self.fname = fname
+
+    # (line number, rule text, source pattern, destination pattern).
+    self.deny: List[Tuple[int, str, str, str]] = []
+
+    # (line number, rule text, patterns from lowest layer up).
+    self.layers: List[Tuple[int, str, List[str]]] = []
+
+    # (line number, rule text, pattern).
+    self.acyclic: List[Tuple[int, str, str]] = []
+
+  @staticmethod
+  def parse(text: str, fname: str = "<rules>") -> "LayeringRules":
+    """Parse rules file contents `text`; `fname` is for messages."""
+    rules = LayeringRules(fname)
+    for lineno, line in enumerate(text.splitlines(), 1):
+      rule = line.split("#", 1)[0].strip()
+      words = rule.split()
+      if not words:
+        continue
+      if words[0] == "deny" and len(words) == 3:
+        rules.deny.append((lineno, rule, words[1], words[2]))
+      elif words[0] == "layers" and len(words) >= 3:
+        rules.layers.append((lineno, rule, words[1:]))
+      elif words[0] == "acyclic" and len(words) == 2:
+        rules.acyclic.append((lineno, rule, words[1]))
+      else:
+        raise ValueError(f"{fname}:{lineno}: invalid rule: {rule}")
+    return rules
+
+
+# A rule violation: (rule line number, rule text, source module,
+# destination module).
+Violation = Tuple[int, str, str, str]
+
+
+def check_layering(
+  rules: LayeringRules, result: Dict[str, Any]
+) -> List[Violation]:
+  """
+  Return the module dependencies in `result` that violate `rules`,
+  ordered by rule line, then source and destination module.
+
+  Patterns are matched against each module once, recording the result
+  as a bit mask per module, one bit per rule.  Then a single pass over
+  the dependency edges tests each edge with a few mask operations, and
+  the SCCs of `result` say which edges are in cycles.
+  """
+  mdeps: Dict[str, List[str]] = result["module_dependencies"]
+
+  def masks(patterns: List[str]) -> Dict[str, int]:
+    """Map each module to the mask of `patterns` that match it."""
+    regexes = [re.compile(fnmatch.translate(p)) for p in patterns]
+    ret: Dict[str, int] = {}
+    for m in mdeps:
+      mask = 0
+      for i, r in enumerate(regexes):
+        if r.match(m):
+          mask |= 1 << i
+      ret[m] = mask
+    return ret
+
+  deny_src = masks([r[2] for r in rules.deny])
+  deny_dst = masks([r[3] for r in rules.deny])
+  acyclic = masks([r[2] for r in rules.acyclic])
+
+  # For each `layers` rule, the map from module to its layer, or -1.
+  layer_of: List[Dict[str, int]] = []
+  for _, _, patterns in rules.layers:
+    regexes = [re.compile(fnmatch.translate(p)) for p in patterns]
+    layer: Dict[str, int] = {}
+    for m in mdeps:
+      layer[m] = next(
+        (i for i, r in enumerate(regexes) if r.match(m)), -1)
+    layer_of.append(layer)
+
+  scc_of: Dict[str, int] = {}
+  for i, comp in enumerate(result["module_sccs"]):
+    for m in comp:
+      scc_of[m] = i
+
+  def bits(mask: int) -> Iterator[int]:
+    while mask:
+      low = mask & -mask
+      yield low.bit_length() - 1
+      mask ^= low
+
+  violations: List[Violation] = []
+  for src, dests in mdeps.items():
+    src_deny, src_acyclic = deny_src[src], acyclic[src]
+    for dst in dests:
+      for i in bits(src_deny & deny_dst[dst]):
+        violations.append(rules.deny[i][:2] + (src, dst))
+      if scc_of[src] == scc_of[dst]:
+        for i in bits(src_acyclic & acyclic[dst]):
+          violations.append(rules.acyclic[i][:2] + (src, dst))
+      for i, layer in enumerate(layer_of):
+        ls, ld = layer[src], layer[dst]
+        if 0 <= ls < ld:
+          violations.append(rules.layers[i][:2] + (src, dst))
+
+  violations.sort()
+  return violations
+
+
+def test_check_layering() -> None:
+  """Unit test for LayeringRules and check_layering."""
+  rules = LayeringRules.parse("""\
+# Comment line.
+deny util/* app/*     # util must not use app
+layers util/* lib/* app/*
+acyclic lib/*
+""")
+  assert rules.deny == [(2, "deny util/* app/*", "util/*", "app/*")]
+  assert rules.layers[0][0] == 3
+  assert rules.acyclic == [(4, "acyclic lib/*", "lib/*")]
+
+  mdeps = {
+    "app/main": ["lib/a", "util/str"],
+    "lib/a": ["lib/b", "util/str"],
+    "lib/b": ["lib/a"],
+    "util/str": ["app/main", "lib/a"],
+    "other": ["app/main"],
+  }
+  result = {
+    "module_dependencies": mdeps,
+    "module_sccs": topo_sort_sccs(mdeps, strongly_connected_components(mdeps)),
+  }
+  assert check_layering(rules, result) == [
+    (2, "deny util/* app/*", "util/str", "app/main"),
+    (3, "layers util/* lib/* app/*", "util/str", "app/main"),
+    (3, "layers util/* lib/* app/*", "util/str", "lib/a"),
+    (4, "acyclic lib/*", "lib/a", "lib/b"),
+    (4, "acyclic lib/*", "lib/b", "lib/a"),
+  ]
+
+  try:
+    LayeringRules.parse("deny x\n", "r.txt")
+    assert False
+  except ValueError as e:
+    assert str(e) == "r.txt:1: invalid rule: deny x"
+
+
+def run_layering_check(result: Dict[str, Any], rules_file: str) -> None:
+  """
+  Check `result` against the rules in `rules_file`, printing each
+  violation.  Exits with status 1 if there are any.
+  """
+  with open(rules_file, "r", encoding="utf-8") as f:
+    text = f.read()
+  try:
+    rules = LayeringRules.parse(text, rules_file)
+  except ValueError as e:
+    sys.exit(str(e))
+  violations = check_layering(rules, result)
+  for lineno, rule, src, dst in violations:
+    print(f"{rules_file}:{lineno}: {src} -> {dst} violates: {rule}")
+  if violations:
+    sys.exit(1)
+
+
+# ----------------------------------------------------------------------
+# Daemon
+class DirectoryWatcher:
+  """
+  Detects changes to the files of a directory by polling.  Each poll
+  lists the directory and stats every file, but only files whose time
+  or size changed are reported, so only those are re-read.
+  """
+
+  def __init__(self, fs: FileSystem, path: str, recursive: bool):
+    self.fs = fs
+    self.path = path
+    self.recursive = recursive
+
+    # Map from file name to its (modification time, size) as of the
+    # last poll.
+    self.snapshot = self._stat_all()
+
+  def _stat_all(self) -> Dict[str, Tuple[int, int]]:
+    """Return the current (time, size) of every file."""
+    files = self.fs.walk(self.path) if self.recursive else \
+      self.fs.listdir(self.path)
+    result: Dict[str, Tuple[int, int]] = {}
+    for f in files:
+      try:
+        result[f] = self.fs.stat(f)
+      except (OSError, KeyError):
+        # Removed since it was listed, or a subdirectory, which
+        # `listdir` also returns in non-recursive mode.
+        pass
+    return result
+
+  def poll(self) -> Tuple[List[str], List[str], List[str]]:
+    """Return the (changed, added, removed) files since the last poll."""
+    current = self._stat_all()
+    old = self.snapshot
+    changed = sorted(f for f, st in current.items()
+                     if f in old and old[f] != st)
+    added = sorted(f for f in current if f not in old)
+    removed = sorted(f for f in old if f not in current)
+    self.snapshot = current
+    return changed, added, removed
+
+
+def test_directory_watcher() -> None:
+  """Unit test for DirectoryWatcher."""
+  fs = FakeFileSystem({"a.cc": "", "a.h": ""})
+  w = DirectoryWatcher(fs, ".", recursive=False)
+  assert w.poll() == ([], [], [])
+  fs.write("a.h", "x")
+  fs.write("b.cc", "")
+  del fs._files["a.cc"]
+  assert w.poll() == (["a.h"], ["b.cc"], ["a.cc"])
+  assert w.poll() == ([], [], [])
+
+  # Subdirectories are not tracked as files.
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    os.mkdir(os.path.join(tmpdir, "d"))
+    with open(os.path.join(tmpdir, "a.cc"), "w"):
+      pass
+    try:
+      FileSystem().stat(os.path.join(tmpdir, "d"))
+      assert False, "stat of a directory should fail"
+    except IsADirectoryError:
+      pass
+
+    old_cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+      w = DirectoryWatcher(FileSystem(), ".", recursive=False)
+      assert sorted(w.snapshot) == ["a.cc"]
+      os.utime("d", ns=(1, 1))
+      assert w.poll() == ([], [], [])
+    finally:
+      os.chdir(old_cwd)
+
+
+def serve(
+  graph: DependencyGraph,
+  watcher: DirectoryWatcher,
+  sock_path: str,
+  poll_interval: float = 1.0,
+  request_timeout: float = 10.0,
+) -> None:
+  """
+  Serve the result of `graph` on the Unix socket `sock_path`, polling
+  `watcher` for changes every `poll_interval` seconds and before each
+  request.
+
+  A client sends one line and receives one reply.  The request
+  "result" (or an empty line) gets the result as compact JSON followed
+  by a newline; "shutdown" stops the server.  Clients are served one at
+  a time, so a client that takes more than `request_timeout` seconds to
+  send its request or read the reply is disconnected.
+
+  If updating the graph fails, for example because a file vanished
+  before it could be read, the error is logged on stderr, requests get
+  an error reply, and the graph is rebuilt from scratch at the next
+  poll.
+
+  A socket left at `sock_path` by a daemon that is no longer running
+  is replaced, but anything else there is an error.
+  """
+  remove_stale_socket(sock_path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    server.bind(sock_path)
+    server.listen()
+    server.settimeout(poll_interval)
+
+    # True if the last update failed, so `graph` must be rebuilt.
+    stale = False
+
+    def refresh() -> None:
+      nonlocal graph, stale
+      try:
+        changed, added, removed = watcher.poll()
+        if stale:
+          graph = DependencyGraph(graph.fs, graph.path, graph.recursive,
+                                  macros=graph.macros)
+          stale = False
+        elif changed or added or removed:
+          graph.update(changed, added, removed)
+      except Exception as e:
+        print(f"{sock_path}: updating the analysis failed, will rebuild "
+              f"it: {type(e).__name__}: {e}", file=sys.stderr)
+        stale = True
+
+    while True:
+      try:
+        conn, _ = server.accept()
+      except socket.timeout:
+        refresh()
+        continue
+
+      with conn:
+        conn.settimeout(request_timeout)
+        try:
+          request = conn.makefile("r", encoding="utf-8").readline().strip()
+          if request == "shutdown":
+            conn.sendall(b"ok\n")
+            break
+          elif request in ("", "result"):
+            refresh()
+            if stale:
+              conn.sendall(b"error: updating the analysis failed\n")
+              continue
+            reply = json.dumps(graph.result(), separators=(",", ":"))
+            conn.sendall(reply.encode("utf-8") + b"\n")
+          else:
+            conn.sendall(f"unknown request: {request}\n".encode("utf-8"))
+        except (socket.timeout, ConnectionError):
+          # Drop the client and go back to serving the others.
+          continue
+
+  finally:
+    server.close()
+    if os.path.exists(sock_path):
+      os.unlink(sock_path)
+
+
+def remove_stale_socket(sock_path: str) -> None:
+  """
+  Remove the Unix socket `sock_path` if nothing is listening on it.
+  Exit with an error if it is not a socket or a daemon is listening.
+  """
+  try:
+    st = os.lstat(sock_path)
+  except FileNotFoundError:
+    return
+  if not stat.S_ISSOCK(st.st_mode):
+    sys.exit(f"{sock_path}: exists and is not a socket")
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+    try:
+      probe.connect(sock_path)
+    except ConnectionRefusedError:
+      os.unlink(sock_path)
+      return
+  sys.exit(f"{sock_path}: a daemon is already listening on it")
+
+
+def request_from_daemon(sock_path: str, request: str = "result") -> str:
+  """Send `request` to the daemon at `sock_path` and return its reply."""
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.connect(sock_path)
+    client.sendall(request.encode("utf-8") + b"\n")
+    chunks: List[bytes] = []
+    while True:
+      chunk = client.recv(1 << 16)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  return b"".join(chunks).decode("utf-8")
+
+
+def test_serve() -> None:
+  """Unit test for serve and request_from_daemon."""
+  import io
+  import tempfile
+  import threading
+
+  class FlakyFileSystem(FakeFileSystem):
+    """`FakeFileSystem` whose reads fail while `fail` is true."""
+    fail = False
+
+    def read(self, path: str) -> str:
+      if self.fail:
+        raise OSError(f"cannot read {path}")
+      return super().read(path)
+
+  fs = FlakyFileSystem({"a.cc": '#include "b.h"\n', "b.cc": "", "b.h": ""})
+  graph = DependencyGraph(fs, ".")
+  watcher = DirectoryWatcher(fs, ".", recursive=False)
+  with tempfile.TemporaryDirectory() as tmpdir:
+    sock_path = os.path.join(tmpdir, "sock")
+
+    # Neither a regular file nor a live socket at the path is replaced.
+    with open(sock_path, "w"):
+      pass
+    try:
+      serve(graph, watcher, sock_path)
+      assert False, "serve should refuse a regular file"
+    except SystemExit:
+      pass
+    assert os.path.isfile(sock_path)
+    os.unlink(sock_path)
+
+    # A socket nobody listens on is stale, and is replaced.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+      stale.bind(sock_path)
+    assert os.path.exists(sock_path)
+
+    thread = threading.Thread(
+      target=serve, args=(graph, watcher, sock_path, 0.05, 0.2))
+    thread.start()
+    try:
+      # Wait for the server to replace the stale socket.
+      for _ in range(100):
+        try:
+          reply = json.loads(request_from_daemon(sock_path))
+          break
+        except (ConnectionRefusedError, FileNotFoundError):
+          time.sleep(0.01)
+      assert reply["module_dependencies"] == {"a": ["b"], "b": []}
+
+      try:
+        serve(graph, watcher, sock_path)
+        assert False, "serve should refuse a live socket"
+      except SystemExit:
+        pass
+
+      # A change is seen by the next request.
+      fs.write("a.cc", "")
+      reply = json.loads(request_from_daemon(sock_path))
+      assert reply["module_dependencies"] == {"a": [], "b": []}
+      assert request_from_daemon(sock_path, "bogus").startswith("unknown")
+
+      # A client that sends nothing is dropped, and does not block the
+      # ones after it.
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle:
+        idle.connect(sock_path)
+        reply = json.loads(request_from_daemon(sock_path))
+        assert reply["module_dependencies"] == {"a": [], "b": []}
+        assert idle.recv(1) == b""
+
+      # A failed update is reported, and the graph is rebuilt once the
+      # files can be read again.
+      fs.fail = True
+      fs.write("a.cc", '#include "b.h"\n')
+      with contextlib.redirect_stderr(io.StringIO()) as log:
+        assert request_from_daemon(sock_path).startswith("error")
+      assert "cannot read a.cc" in log.getvalue()
+      fs.fail = False
+      reply = json.loads(request_from_daemon(sock_path))
+      assert reply["module_dependencies"] == {"a": ["b"], "b": []}
+    finally:
+      request_from_daemon(sock_path, "shutdown")
+      thread.join()
+    assert not os.path.exists(sock_path)
+
+
+# ----------------------------------------------------------------------
+# Reachability queries
+class Reachability:
+  """
+  Index answering "which nodes can node v reach?" in an `IntGraph`.
+
+  The SCCs of the graph are numbered in reverse topological order, and
+  each SCC gets a bitset (a Python int) of the SCCs reachable from it,
+  computed in one pass as its own bit ORed with the bitsets of its
+  successors.  With S SCCs and E edges, building the index takes
+  O(E * S / 64) time and O(S * S) bits of memory, which for a large
+  file graph is a lot.  Then a reachability test is a shift of a
+  bitset, O(S / 64), and listing the reachable nodes costs O(S / 64)
+  plus the size of the answer.  So the index only pays off for many
+  queries on the same graph; a single query is cheaper with
+  `int_reachable`.
+  """
+
+  def __init__(self, g: IntGraph):
+    self.g = g
+    self.sccs = int_strongly_connected_components(g)
+
+    # Map from node id to its index in `sccs`.
+    self.scc_of = [0] * len(g)
+    for i, comp in enumerate(self.sccs):
+      for v in comp:
+        self.scc_of[v] = i
+
+    # `reach[i]` has bit j set if SCC j is reachable from SCC i,
+    # including j == i.  Tarjan's order puts successors first.
+    offsets, targets, scc_of = g.offsets, g.targets, self.scc_of
+    self.reach = [0] * len(self.sccs)
+    for i, comp in enumerate(self.sccs):
+      bits = 1 << i
+      for v in comp:
+        for t in targets[offsets[v]:offsets[v + 1]]:
+          j = scc_of[t]
+          if j != i:
+            bits |= self.reach[j]
+      self.reach[i] = bits
+
+  def reaches(self, u: int, v: int) -> bool:
+    """True if there is a path, possibly empty, from `u` to `v`."""
+    return (self.reach[self.scc_of[u]] >> self.scc_of[v]) & 1 == 1
+
+  def reachable(self, v: int) -> List[int]:
+    """Return the sorted nodes other than `v` reachable from `v`."""
+    result: List[int] = []
+    bits = self.reach[self.scc_of[v]]
+    while bits:
+      low = bits & -bits
+      result.extend(self.sccs[low.bit_length() - 1])
+      bits ^= low
+    result.remove(v)
+    result.sort()
+    return result
+
+
+def int_reachable(g: IntGraph, v: int) -> List[int]:
+  """
+  Return the sorted nodes other than `v` reachable from `v` in `g`, by a
+  breadth-first search, in time linear in the size of the part of `g`
+  reached.
+  """
+  offsets, targets = g.offsets, g.targets
+  seen = {v}
+  queue = [v]
+  for u in queue:
+    for t in targets[offsets[u]:offsets[u + 1]]:
+      if t not in seen:
+        seen.add(t)
+        queue.append(t)
+  seen.remove(v)
+  return sorted(seen)
+
+
+def reverse_graph(g: IntGraph) -> IntGraph:
+  """Return `g` with every edge reversed."""
+  n = len(g)
+  offsets, targets = g.offsets, g.targets
+  preds: List[List[int]] = [[] for _ in range(n)]
+  for v in range(n):
+    for t in targets[offsets[v]:offsets[v + 1]]:
+      preds[t].append(v)
+  rev_offsets = [0]
+  rev_targets: List[int] = []
+  for p in preds:
+    rev_targets.extend(p)
+    rev_offsets.append(len(rev_targets))
+  return IntGraph(g.names, array.array("i", rev_offsets),
+                  array.array("i", rev_targets))
+
+
+class QueryEngine:
+  """
+  Transitive dependency queries over a result object, as returned by
+  `analyze`.
+
+  If `indexed`, queries are answered from `Reachability` indexes, built
+  on first use, which is worthwhile when asking many questions of a
+  graph.  Otherwise each query searches the graph, which is cheaper for
+  a few.
+  """
+
+  def __init__(self, result: Dict[str, Any], indexed: bool = False):
+    self.module_graph = IntGraph.from_adjacency(
+      result["module_dependencies"])
+    self.file_graph = IntGraph.from_adjacency(result["file_dependencies"])
+    self.module_ids = {m: i for i, m in enumerate(self.module_graph.names)}
+    self.file_ids = {f: i for i, f in enumerate(self.file_graph.names)}
+    self.indexed = indexed
+    self._graphs: Dict[str, IntGraph] = {}
+    self._indexes: Dict[str, Reachability] = {}
+
+  def _graph(self, kind: str) -> IntGraph:
+    """Return the "module", "rmodule", or "rfile" graph."""
+    if kind not in self._graphs:
+      g = self.file_graph if kind == "rfile" else self.module_graph
+      if kind.startswith("r"):
+        g = reverse_graph(g)
+      self._graphs[kind] = g
+    return self._graphs[kind]
+
+  def _index(self, kind: str) -> Reachability:
+    """Return the index for the `_graph` of `kind`."""
+    if kind not in self._indexes:
+      self._indexes[kind] = Reachability(self._graph(kind))
+    return self._indexes[kind]
+
+  def _reachable(self, kind: str, v: int) -> List[int]:
+    """Return the nodes other than `v` reachable from `v` in the `_graph`
+    of `kind`."""
+    if self.indexed:
+      return self._index(kind).reachable(v)
+    return int_reachable(self._graph(kind), v)
+
+  def _module_id(self, module: str) -> int:
+    if module not in self.module_ids:
+      raise KeyError(f"unknown module: {module}")
+    return self.module_ids[module]
+
+  def module_deps(self, module: str) -> List[str]:
+    """Return the modules `module` transitively depends on."""
+    names = self.module_graph.names
+    return sorted(names[v] for v in
+                  self._reachable("module", self._module_id(module)))
+
+  def module_dependents(self, module: str) -> List[str]:
+    """Return the modules that transitively depend on `module`."""
+    names = self.module_graph.names
+    return sorted(names[v] for v in
+                  self._reachable("rmodule", self._module_id(module)))
+
+  def depends_on(self, module: str, other: str) -> bool:
+    """True if `module` transitively depends on `other`."""
+    u, v = self._module_id(module), self._module_id(other)
+    if self.indexed:
+      return u != v and self._index("module").reaches(u, v)
+    return v in int_reachable(self._graph("module"), u)
+
+  def impacted_files(self, fname: str) -> List[str]:
+    """
+    Return the files that directly or transitively include `fname`,
+    i.e., what must be rebuilt if it changes, including `fname`.
+    """
+    if fname not in self.file_ids:
+      raise KeyError(f"unknown file: {fname}")
+    names = self.file_graph.names
+    v = self.file_ids[fname]
+    return sorted([fname] + [names[u] for u in self._reachable("rfile", v)])
+
+
+def test_query_engine() -> None:
+  """Unit test for Reachability, int_reachable, and QueryEngine."""
+  g = IntGraph.from_adjacency(
+    {"a": ["b"], "b": ["c"], "c": ["b", "d"], "d": [], "e": ["a"]})
+  r = Reachability(g)
+  assert r.reachable(0) == [1, 2, 3]
+  assert r.reachable(1) == [2, 3]
+  assert r.reachable(3) == []
+  assert r.reaches(4, 3) and not r.reaches(3, 4) and r.reaches(3, 3)
+  for v in range(len(g)):
+    assert int_reachable(g, v) == r.reachable(v)
+  assert reverse_graph(g).to_adjacency() == \
+    {"a": ["e"], "b": ["a", "c"], "c": ["b"], "d": ["c"], "e": []}
+
+  fs = FakeFileSystem({
+    "low.cc": '#include "low.h"\n',
+    "low.h": "",
+    "mid.cc": '#include "mid.h"\n',
+    "mid.h": '#include "low.h"\n',
+    "top.cc": '#include "mid.h"\n',
+  })
+  result = analyze(fs, ".")
+  for indexed in (False, True):
+    q = QueryEngine(result, indexed)
+    assert q.module_deps("top") == ["low", "mid"]
+    assert q.module_deps("low") == []
+    assert q.module_dependents("low") == ["mid", "top"]
+    assert q.depends_on("top", "low") and not q.depends_on("low", "top")
+    assert not q.depends_on("top", "top")
+    assert q.impacted_files("low.h") == \
+      ["low.cc", "low.h", "mid.cc", "mid.h", "top.cc"]
+    assert q.impacted_files("top.cc") == ["top.cc"]
+    assert bool(q._indexes) == indexed
+    try:
+      q.module_deps("nonexist")
+      assert False
+    except KeyError:
+      pass
+
+
+def run_queries(result: Dict[str, Any], args: argparse.Namespace) -> None:
+  """Answer the queries in `args` about `result`, printing JSON."""
+  q = QueryEngine(result)
+  answers: Dict[str, Dict[str, List[str]]] = {}
+  try:
+    if args.deps:
+      answers["deps"] = {m: q.module_deps(m) for m in args.deps}
+    if args.rdeps:
+      answers["rdeps"] = {m: q.module_dependents(m) for m in args.rdeps}
+    if args.impacted:
+      answers["impacted"] = {f: q.impacted_files(f) for f in args.impacted}
+  except KeyError as e:
+    sys.exit(e.args[0])
+  write_json(sys.stdout, answers, compact=False)
+
+
+# ----------------------------------------------------------------------
+# Graph diff
+class GitFileSystem(FileSystem):
+  """
+  Read-only `FileSystem` view of the tree of directory `root` at git
+  revision `rev`.  Paths are relative to `root`.  Call `close` when
+  done with it.
+  """
+
+  def __init__(self, rev: str, root: str = "."):
+    self.rev = rev
+    self.root = root
+
+    # Map from path to (blob id, size), from one `git ls-tree`.
+    self._blobs: Dict[str, Tuple[str, int]] = {}
+    out = subprocess.run(
+      ["git", "ls-tree", "-r", "-z", "--long", rev, "--", "."],
+      cwd=root, check=True, stdout=subprocess.PIPE).stdout
+    for entry in out.decode("utf-8").split("\0"):
+      if not entry:
+        continue
+      info, path = entry.split("\t", 1)
+      _, kind, blob, size = info.split()
+      if kind == "blob":
+        self._blobs[path] = (blob, int(size))
+
+    # `git cat-file --batch` process serving `read`, started on first
+    # use.  It is not pickled, so each pool worker starts its own.
+    self._cat_file: Optional["subprocess.Popen[bytes]"] = None
+
+  def __getstate__(self) -> Dict[str, Any]:
+    state = self.__dict__.copy()
+    state["_cat_file"] = None
+    return state
+
+  def close(self) -> None:
+    """Stop the `git cat-file` process, if it was started."""
+    if self._cat_file is not None:
+      assert self._cat_file.stdin and self._cat_file.stdout
+      self._cat_file.stdin.close()
+      self._cat_file.stdout.close()
+      self._cat_file.wait()
+      self._cat_file = None
+
+  def listdir(self, path: str) -> List[str]:
+    prefix = FakeFileSystem._dir_prefix(path)
+    names = set()
+    for f in self._blobs:
+      if f.startswith(prefix):
+        names.add(f[len(prefix):].split("/")[0])
+    return sorted(names)
+
+  def walk(self, path: str) -> List[str]:
+    prefix = FakeFileSystem._dir_prefix(path)
+    return sorted(
+      f[len(prefix):] for f in self._blobs
+      if f.startswith(prefix) and
+      not any(d.startswith(".") for d in f[len(prefix):].split("/")[:-1]))
+
+  def read(self, path: str) -> str:
+    if self._cat_file is None:
+      self._cat_file = subprocess.Popen(
+        ["git", "cat-file", "--batch"], cwd=self.root,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    assert self._cat_file.stdin and self._cat_file.stdout
+    self._cat_file.stdin.write(self._blobs[path][0].encode() + b"\n")
+    self._cat_file.stdin.flush()
+
+    # The reply is "<id> blob <size>", the contents, and a newline.
+    size = int(self._cat_file.stdout.readline().split()[2])
+    data = self._cat_file.stdout.read(size + 1)[:size]
+    return data.decode("utf-8")
+
+  def stat(self, path: str) -> Tuple[int, int]:
+    # The blob id stands in for the modification time, so cache entries
+    # are reused exactly when the contents are the same.
+    blob, size = self._blobs[path]
+    return int(blob[:15], 16), size
+
+
+def _edge_diff(
+  old: Dict[str, List[str]], new: Dict[str, List[str]]
+) -> Dict[str, List[List[str]]]:
+  """
+  Return the edges of adjacency map `new` that are not in `old`, and
+  vice versa, as sorted [source, target] pairs.  Only the nodes whose
+  lists differ are expanded into edges.
+  """
+  added: List[List[str]] = []
+  removed: List[List[str]] = []
+  empty: List[str] = []
+  for node in old.keys() | new.keys():
+    old_targets = old.get(node, empty)
+    new_targets = new.get(node, empty)
+    if old_targets == new_targets:
+      continue
+    old_set, new_set = set(old_targets), set(new_targets)
+    added.extend([node, t] for t in new_set - old_set)
+    removed.extend([node, t] for t in old_set - new_set)
+  return {"added": sorted(added), "removed": sorted(removed)}
+
+
+def _scc_changes(
+  sccs: List[List[str]], other_sccs: List[List[str]]
+) -> List[Tuple[List[str], List[List[str]]]]:
+  """
+  Return, for each SCC in `sccs` with more than one member that is not
+  contained in a single SCC of `other_sccs`, the pair of it and the
+  sorted list of SCCs in `other_sccs` its members are in.  A member not
+  in `other_sccs` counts as an SCC by itself.
+  """
+  other_of: Dict[str, List[str]] = {}
+  for comp in other_sccs:
+    for m in comp:
+      other_of[m] = comp
+
+  changes = []
+  for comp in sccs:
+    if len(comp) < 2:
+      continue
+    parts: Dict[str, List[str]] = {}
+    for m in comp:
+      other = other_of.get(m, [m])
+      parts[other[0]] = other
+    if len(parts) == 1 and len(next(iter(parts.values()))) >= len(comp):
+      # Contained in (or the same as) one SCC of `other_sccs`.
+      continue
+    changes.append((comp, sorted(parts.values())))
+  return sorted(changes)
+
+
+def diff_results(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+  """
+  Compare result objects `old` and `new`, returning:
+
+    file_edges    {"added": [[src, dst], ...], "removed": [...]} for
+                  file dependencies.
+    module_edges  The same for module dependencies.
+    scc_merges    [{"scc": SCC, "from": [SCC, ...]}, ...]: the cycles in
+                  `new` made by joining modules that were in different
+                  SCCs of `old`.  An SCC from single-member SCCs is a
+                  new cycle.
+    scc_splits    [{"scc": SCC, "into": [SCC, ...]}, ...]: the cycles
+                  in `old` that `new` broke apart, or that lost members.
+
+  Unchanged adjacency lists are skipped after one comparison, and SCCs
+  are matched through a map from module to SCC, so the cost is linear
+  in the size of the two results.
+  """
+  return {
+    "file_edges": _edge_diff(old["file_dependencies"],
+                             new["file_dependencies"]),
+    "module_edges": _edge_diff(old["module_dependencies"],
+                               new["module_dependencies"]),
+    "scc_merges": [
+      {"scc": comp, "from": parts}
+      for comp, parts in _scc_changes(new["module_sccs"], old["module_sccs"])
+    ],
+    "scc_splits": [
+      {"scc": comp, "into": parts}
+      for comp, parts in _scc_changes(old["module_sccs"], new["module_sccs"])
+    ],
+  }
+
+
+def test_diff_results() -> None:
+  """Unit test for diff_results and GitFileSystem."""
+  import shutil
+  import tempfile
+
+  old_files = {
+    "a.cc": '#include "a.h"\n#include "b.h"\n',
+    "a.h": "",
+    "b.cc": '#include "b.h"\n',
+    "b.h": '#include "c.h"\n',
+    "c.cc": "",
+    "c.h": "",
+    "d.cc": '#include "e.h"\n',
+    "d.h": "",
+    "e.cc": '#include "d.h"\n',
+    "e.h": "",
+  }
+  new_files = dict(old_files)
+  new_files["c.h"] = '#include "a.h"\n'     # New cycle a -> b -> c -> a.
+  new_files["e.cc"] = ""                    # Breaks cycle d <-> e.
+  old = analyze(FakeFileSystem(old_files), ".")
+  new = analyze(FakeFileSystem(new_files), ".")
+  d = diff_results(old, new)
+  assert d["file_edges"] == {"added": [["c.h", "a.h"]],
+                             "removed": [["e.cc", "d.h"]]}
+  assert d["module_edges"] == {"added": [["c", "a"]],
+                               "removed": [["e", "d"]]}
+  assert d["scc_merges"] == [
+    {"scc": ["a", "b", "c"], "from": [["a"], ["b"], ["c"]]}]
+  assert d["scc_splits"] == [{"scc": ["d", "e"], "into": [["d"], ["e"]]}]
+
+  assert diff_results(new, new) == {
+    "file_edges": {"added": [], "removed": []},
+    "module_edges": {"added": [], "removed": []},
+    "scc_merges": [],
+    "scc_splits": [],
+  }
+
+  # A cycle losing a member is a split even though nothing is joined.
+  assert _scc_changes([["a", "b", "c"]], [["a", "b"]]) == \
+    [(["a", "b", "c"], [["a", "b"], ["c"]])]
+  assert _scc_changes([["a", "b"]], [["a", "b", "c"]]) == []
+
+  if shutil.which("git") is None:
+    return
+  with tempfile.TemporaryDirectory() as tmpdir:
+    def git(*args: str) -> None:
+      subprocess.run(["git", "-c", "user.name=t", "-c", "user.email=t@t",
+                      *args], cwd=tmpdir, check=True,
+                     stdout=subprocess.DEVNULL)
+    git("init", "-q")
+    for files in (old_files, new_files):
+      for fname, contents in files.items():
+        with open(os.path.join(tmpdir, fname), "w") as f:
+          f.write(contents)
+      git("add", ".")
+      git("commit", "-q", "-m", "x")
+    with contextlib.closing(GitFileSystem("HEAD~", tmpdir)) as gfs:
+      assert gfs.listdir(".") == sorted(old_files)
+      assert gfs.read("a.cc") == old_files["a.cc"]
+      assert gfs.read("c.h") == ""
+      assert analyze(gfs, ".") == old
+      proc = gfs._cat_file
+      assert proc is not None
+    assert gfs._cat_file is None and proc.returncode == 0
+    with contextlib.closing(GitFileSystem("HEAD", tmpdir)) as gfs:
+      assert analyze(gfs, ".", jobs=2) == new
+
+
+def load_or_analyze(
+  source: str, jobs: int, recursive: bool, macros: Optional[Macros]
+) -> Dict[str, Any]:
+  """
+  Return the result in file `source` if it exists, otherwise the
+  analysis of the current directory at git revision `source`.
+  """
+  if os.path.exists(source):
+    return load_result(source)
+  try:
+    fs = GitFileSystem(source)
+  except (OSError, subprocess.CalledProcessError):
+    sys.exit(f"{source}: not a result file or git revision")
+  with contextlib.closing(fs):
+    return analyze(fs, ".", jobs, None, recursive, macros)
+
 
 # ----------------------------------------------------------------------
 # Integration test with provided example
@@ -374,40 +3624,266 @@ def integration_test() -> None:
   assert any(set(c) == {"high1"} for c in topo)
   assert any(set(c) == {"high2"} for c in topo)
 
+  # The complete analysis agrees with the steps above, and scanning in
+  # parallel produces exactly the same output as the serial scan.
+  assert analyze(fs, ".") == result
+  parallel = analyze(fs, ".", jobs=2)
+  assert json.dumps(parallel, indent=2) == json.dumps(result, indent=2)
+
+  # So does the incremental analysis when built from scratch.
+  assert DependencyGraph(fs, ".").result() == result
+
 
 # ----------------------------------------------------------------------
 # Main
 def unit_tests() -> None:
   """Run all unit tests."""
+  test_profiler()
   test_fake_filesystem()
   test_discover_modules()
   test_parse_includes()
+  test_scan_include_bytes()
+  test_evaluate_condition()
+  test_strip_comments()
+  test_parse_includes_conditional()
+  test_include_cache()
+  test_scan_includes()
   test_normalize_include()
+  test_path_index()
   test_build_file_dependencies()
+  test_int_graph()
   test_build_module_dependencies()
   test_strongly_connected_components()
   test_topo_sort_sccs()
+  test_output_formats()
+  test_dependency_graph()
+  test_query_engine()
+  test_check_layering()
+  test_diff_results()
+  test_directory_watcher()
+  test_serve()
+
+
+def parse_args() -> argparse.Namespace:
+  """Parse and return the command-line arguments."""
+  parser = argparse.ArgumentParser(
+    description="Analyze C++ module dependencies in the current directory."
+  )
+  parser.add_argument(
+    "-j", "--jobs",
+    type=int,
+    default=1,
+    metavar="N",
+    help="Scan files for #include lines using N processes.",
+  )
+  parser.add_argument(
+    "-r", "--recursive",
+    action="store_true",
+    help="Also analyze modules in subdirectories.",
+  )
+  parser.add_argument(
+    "--conditional",
+    action="store_true",
+    help="Skip #include lines in comments and in #if/#ifdef blocks "
+         "that are inactive given the -D macros.",
+  )
+  parser.add_argument(
+    "--mmap",
+    action="store_true",
+    help="Scan files by memory-mapping them and searching their bytes.",
+  )
+  parser.add_argument(
+    "--include-region",
+    type=int,
+    default=0,
+    metavar="BYTES",
+    help="With --mmap (implied), stop scanning a file after BYTES bytes "
+         "without an #include.",
+  )
+  parser.add_argument(
+    "-D",
+    dest="defines",
+    action="append",
+    default=[],
+    metavar="NAME[=VALUE]",
+    help="Define macro NAME for --conditional, which -D implies.",
+  )
+  parser.add_argument(
+    "--format",
+    choices=OUTPUT_FORMATS,
+    default="json",
+    help="Output format (default: json).",
+  )
+  parser.add_argument(
+    "--input",
+    metavar="FILE",
+    help="Instead of analyzing the current directory, read the result "
+         "of an earlier run, in any output format, from FILE.",
+  )
+  parser.add_argument(
+    "--deps",
+    action="append",
+    metavar="MODULE",
+    help="Print the modules MODULE transitively depends on, instead of "
+         "the whole result.  May be repeated.",
+  )
+  parser.add_argument(
+    "--rdeps",
+    action="append",
+    metavar="MODULE",
+    help="Print the modules that transitively depend on MODULE.",
+  )
+  parser.add_argument(
+    "--impacted",
+    action="append",
+    metavar="FILE",
+    help="Print the files that must be rebuilt when FILE changes.",
+  )
+  parser.add_argument(
+    "--check",
+    metavar="RULES",
+    help="Instead of printing the result, check it against the layering "
+         "rules in file RULES, printing violations.  Exit status is 1 "
+         "if there are any.",
+  )
+  parser.add_argument(
+    "--diff",
+    nargs=2,
+    metavar=("OLD", "NEW"),
+    help="Instead of analyzing, compare results OLD and NEW, each a file "
+         "written by this script or a git revision to analyze.",
+  )
+  parser.add_argument(
+    "--daemon",
+    metavar="SOCKET",
+    help="Keep running, watching for changes, and serve the current "
+         "result on the Unix socket SOCKET.",
+  )
+  parser.add_argument(
+    "--poll-interval",
+    type=float,
+    default=1.0,
+    metavar="SECONDS",
+    help="How often the daemon polls for changes (default: 1).",
+  )
+  parser.add_argument(
+    "--connect",
+    metavar="SOCKET",
+    help="Print the result served by the daemon on SOCKET.",
+  )
+  parser.add_argument(
+    "--self-test",
+    action="store_true",
+    help="Run the unit tests and integration test, then exit.",
+  )
+  parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Print the time spent in each phase to stderr.",
+  )
+  parser.add_argument(
+    "--benchmark",
+    action="store_true",
+    help="Time the graph algorithms on a synthetic graph of 100k "
+         "modules and 1M dependencies, then exit.",
+  )
+  parser.add_argument(
+    "--cache",
+    action="store_true",
+    help="Cache the includes of each file in a file under "
+         "$XDG_CACHE_HOME, and do not re-read unchanged files.",
+  )
+  parser.add_argument(
+    "--cache-file",
+    metavar="FILE",
+    help="Like --cache, but use FILE as the cache file.",
+  )
+  return parser.parse_args()
 
 
 def main() -> None:
-  """Run unit tests, integration test, then real analysis."""
-  unit_tests()
-  integration_test()
-
-  fs = FileSystem()
-  modules = discover_modules(fs, ".")
-  fdeps = build_file_dependencies(fs, ".", modules)
-  mdeps = build_module_dependencies(modules, fdeps)
-  sccs = strongly_connected_components(mdeps)
-  topo = topo_sort_sccs(mdeps, sccs)
-  result = {
-    "files": sorted(f for flist in modules.values() for f in flist),
-    "file_dependencies": fdeps,
-    "module_files": {m: sorted(fl) for m, fl in modules.items()},
-    "module_dependencies": mdeps,
-    "module_sccs": topo,
-  }
-  print(json.dumps(result, indent=2))
+  """Analyze the current directory, or do what the options say."""
+  args = parse_args()
+
+  if args.self_test:
+    unit_tests()
+    integration_test()
+    print("All tests passed.")
+    return
+
+  global profiler
+  if args.profile:
+    profiler = Profiler()
+  start = time.perf_counter()
+  run(args)
+  if profiler is not None:
+    profiler.report(sys.stderr, time.perf_counter() - start)
+
+
+def run(args: argparse.Namespace) -> None:
+  """Do the work of `main` other than self-testing and profiling."""
+  if args.benchmark:
+    benchmark_graph_algorithms()
+    return
+
+  if args.connect is not None:
+    sys.stdout.write(request_from_daemon(args.connect))
+    return
+
+  macros: Optional[Macros] = None
+  if args.conditional or args.defines:
+    macros = parse_macro_definitions(args.defines)
+
+  if args.diff is not None:
+    old, new = (load_or_analyze(source, args.jobs, args.recursive, macros)
+                for source in args.diff)
+    with profile_phase("diff"):
+      write_json(sys.stdout, diff_results(old, new), compact=False)
+    return
+
+  cache: Optional[IncludeCache] = None
+  if args.cache or args.cache_file is not None:
+    cache = IncludeCache(args.cache_file or IncludeCache.default_file("."),
+                         macros)
+    cache.load()
+
+  queries = bool(args.deps or args.rdeps or args.impacted)
+
+  fs: FileSystem
+  if args.mmap or args.include_region > 0:
+    fs = MappedFileSystem(args.include_region)
+  else:
+    fs = FileSystem()
+  if args.daemon is not None:
+    watcher = DirectoryWatcher(fs, ".", args.recursive)
+    graph = DependencyGraph(fs, ".", args.recursive, args.jobs, cache,
+                            macros)
+    if cache is not None:
+      cache.save()
+    serve(graph, watcher, args.daemon, args.poll_interval)
+    return
+
+  result: Optional[Dict[str, Any]] = None
+  if args.input is not None:
+    result = load_result(args.input)
+  elif args.format == "jsonl" and not queries and args.check is None:
+    stream_jsonl(sys.stdout, fs, ".", args.jobs, cache, args.recursive,
+                 macros)
+  else:
+    result = analyze(fs, ".", args.jobs, cache, args.recursive, macros)
+  if cache is not None:
+    cache.save()
+
+  if result is None:
+    pass
+  elif args.check is not None:
+    with profile_phase("checking"):
+      run_layering_check(result, args.check)
+  elif queries:
+    run_queries(result, args)
+  else:
+    with profile_phase("serialization"):
+      write_result(result, args.format)
 
 
 if __name__ == "__main__":
@@ -6,15 +6,57 @@ each prefix of the list of provided header files, it computes the number
 of lines of preprocessor output when those headers are included in that
 order, thereby assessing the context-dependent incremental cost of each
 header.
+
+The prefixes are independent, so with `--jobs N` up to N of them are
+preprocessed at once.
+
+With `--single-pass`, the preprocessor runs just once, on the whole
+list, and each output line is attributed to the top-level header being
+included when it was produced, as indicated by the linemarkers in the
+output.  Since a header that is already included produces nothing the
+second time, this gives nearly the same incremental costs as the
+prefix runs at the cost of one.
+
+With `--tree`, the preprocessor also runs once, and the report has a
+row for every file reachable from the given headers, with its own cost
+(the output produced while reading it, not counting linemarkers and
+#include lines) and its exclusive cost: the total own cost of the files
+that are only reached through it, and so would no longer be read if it
+were not included.  Rows are sorted by exclusive lines.
+
+With `--cache`, measurements are saved in a cache file, by default
+under $XDG_CACHE_HOME (or ~/.cache), and reused on later runs when the
+include text, include directories, current directory, compiler and its
+version, and the contents of every file the preprocessor read are all
+the same.  `--cache-file FILE` uses FILE instead.  Measurements not
+used in the last 20 runs are dropped.
+
+Besides lines and lines containing "template", each measurement counts
+the bytes and (approximately) the C++ tokens of the output, and the CPU
+time the preprocessor took.  With `--syntax-only`, the CPU time `g++
+-fsyntax-only` takes on each prefix is measured too.  The time metrics
+are not available with `--single-pass`.  `--format csv` and `--format
+json` write the measurements in those formats instead of a table.
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import csv
+import hashlib
+import itertools
+import json
+import os
+import shutil
 import subprocess
 import sys
 import re
+import resource
+import tempfile
 
 from boilerplate import *
-from typing import List, Tuple
+from typing import (Any, Callable, Dict, IO, Iterable, Iterator, List,
+                    Optional, Sequence, Set, Tuple)
 
 
 def parse_args() -> argparse.Namespace:
@@ -29,6 +71,40 @@ def parse_args() -> argparse.Namespace:
     "--expand",
     action="store_true",
     help="Read the contents of the files to get the list of headers.")
+  parser.add_argument(
+    "-j", "--jobs",
+    type=int,
+    default=1,
+    metavar="N",
+    help="Run up to N preprocessors at once.")
+  parser.add_argument(
+    "--single-pass",
+    action="store_true",
+    help="Run the preprocessor once and attribute its output to headers "
+         "using linemarkers.")
+  parser.add_argument(
+    "--tree",
+    action="store_true",
+    help="Report the own and exclusive cost of every file reachable "
+         "from the headers.")
+  parser.add_argument(
+    "--cache",
+    action="store_true",
+    help="Cache measurements in a file under $XDG_CACHE_HOME, and reuse "
+         "them while nothing they depend on has changed.")
+  parser.add_argument(
+    "--cache-file",
+    metavar="FILE",
+    help="Like --cache, but use FILE as the cache file.")
+  parser.add_argument(
+    "--syntax-only",
+    action="store_true",
+    help="Also measure the time `g++ -fsyntax-only` takes on each prefix.")
+  parser.add_argument(
+    "--format",
+    choices=["text", "csv", "json"],
+    default="text",
+    help="Output format.  Default: text.")
   parser.add_argument(
     "-I",
     dest="includes",
@@ -54,74 +130,865 @@ def generate_includes(headers: List[str]) -> str:
   return "".join(f'#include "{hdr}"\n' for hdr in headers)
 
 
+# Names of the metrics of a measurement, and their column labels in
+# the text report.  The "_seconds" metrics are shown in milliseconds.
+METRICS: List[Tuple[str, str]] = [
+  ("lines", "lines"),
+  ("templates", "templates"),
+  ("bytes", "bytes"),
+  ("tokens", "tokens"),
+  ("pp_seconds", "pp.ms"),
+  ("compile_seconds", "cc.ms"),
+]
+
+
+# Values of some of the METRICS for one run of the preprocessor.
+Counts = Dict[str, float]
+
+
+# One row of the report: (header name, counts it added, counts for the
+# prefix that ends with it).
+Measurement = Tuple[str, Counts, Counts]
+
+
+# Size of the blocks of preprocessor output read at a time.
+CHUNK_SIZE = 1 << 20
+
+
 def run_preprocessor(
   include_text: str,
-  include_dirs: List[str]
-) -> Tuple[int, int]:
+  include_dirs: List[str],
+  deps_file: Optional[str] = None
+) -> Counts:
   """
-  Run `g++ -E -xc++ -` with the given include directives and return a
-  tuple: (number of lines of output, number of lines containing the
-  substring "template").
+  Run `g++ -E -xc++ -` with the given include directives and return
+  the "lines", "templates" (lines containing the substring "template"),
+  "bytes", and "tokens" in its output, and the "pp_seconds" of CPU time
+  it took.
+
+  The output is consumed in blocks as it is produced, so memory use
+  does not depend on its size.  If `deps_file` is not None, the
+  preprocessor writes the list of files it read to it.
   """
-  try:
-    command: List[str] = ["g++", "-E", "-xc++", "-"];
-    for dir in include_dirs:
-      command.append(f"-I{dir}")
+  counts: Counts = {"lines": 0, "templates": 0, "bytes": 0, "tokens": 0}
+
+  # Incomplete last line of the previous block.
+  partial = b""
 
-    proc = subprocess.run(
+  start = child_cpu_seconds()
+  with preprocessor_output(include_text, include_dirs, deps_file) as output:
+    while block := output.read(CHUNK_SIZE):
+      end = block.rfind(b"\n") + 1
+      if end == 0:
+        partial += block
+        continue
+      add_counts(counts, partial + block[:end] if partial else block[:end])
+      partial = block[end:]
+  counts["pp_seconds"] = child_cpu_seconds() - start
+
+  if partial:
+    add_counts(counts, partial)
+  return counts
+
+
+def child_cpu_seconds() -> float:
+  """
+  Return the CPU time used so far by the child processes that have been
+  waited for, including their own children.  Unlike elapsed time, this
+  does not depend on how fast we read the output, or on other jobs.
+  """
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+
+def add_counts(counts: Counts, text: bytes) -> None:
+  """
+  Add the "lines", "templates", "bytes", and "tokens" of `text`, one or
+  more lines of preprocessor output, to `counts`.
+  """
+  counts["lines"] += text.count(b"\n") + (not text.endswith(b"\n"))
+  counts["templates"] += count_template_lines(text)
+  counts["bytes"] += len(text)
+  counts["tokens"] += count_tokens(text)
+
+
+def count_template_lines(text: bytes) -> int:
+  """Return the number of lines in `text` containing "template"."""
+  count = 0
+  pos = 0
+  while (i := text.find(b"template", pos)) >= 0:
+    count += 1
+    # Continue on the next line.
+    pos = text.find(b"\n", i) + 1
+    if pos == 0:
+      break
+  return count
+
+
+# A C++ token, more or less.  Raw string literals and some rarely used
+# operators are split into several tokens.
+token_re = re.compile(rb"""
+    (?:u8|[uUL])?"(?:\\.|[^"\\\n])*"      # string literal
+  | (?:u8|[uUL])?'(?:\\.|[^'\\\n])*'      # character literal
+  | [A-Za-z_]\w*                         # identifier or keyword
+  | \.?\d(?:[eEpP][+-]|['\w.])*           # number
+  | ->\*? | \.\.\. | \.\* | :: | \#\#        # multi-character operators
+  | <=> | <<=? | >>=? | \+\+ | -- | && | \|\|
+  | [-+*/%&|^!=<>]=
+  | \S                                   # other punctuation
+""", re.VERBOSE)
+
+
+# Linemarkers and other directives left in preprocessor output.
+directive_line_re = re.compile(rb"^\#.*$", re.MULTILINE)
+
+
+def count_tokens(text: bytes) -> int:
+  """Return the number of C++ tokens in `text`, ignoring directives."""
+  if b"#" in text:
+    text = directive_line_re.sub(b"", text)
+  return sum(1 for _ in token_re.finditer(text))
+
+
+def report_compiler_error(include_text: str, stderr: str) -> None:
+  """Print the input and error output of a failed g++ run."""
+  print("Error invoking g++ with input:", file=sys.stderr)
+  print("-----------------------------", file=sys.stderr)
+  print(include_text, file=sys.stderr)
+  print("-----------------------------", file=sys.stderr)
+  print("g++ stderr output:", file=sys.stderr)
+  print(stderr, file=sys.stderr)
+
+
+@contextlib.contextmanager
+def preprocessor_output(
+  include_text: str,
+  include_dirs: List[str],
+  deps_file: Optional[str] = None,
+  options: Sequence[str] = ()
+) -> Iterator[IO[bytes]]:
+  """
+  Run `g++ -E -xc++ -` with the given include directives, yielding its
+  standard output to read from.  Raise CalledProcessError if it fails.
+  If `deps_file` is not None, write the dependencies to it, in Makefile
+  syntax.  `options` are passed to g++ as well.
+  """
+  command: List[str] = ["g++", "-E", "-xc++", "-"];
+  for dir in include_dirs:
+    command.append(f"-I{dir}")
+  if deps_file is not None:
+    command += ["-MD", "-MF", deps_file]
+  command += options
+
+  # Supply stdin from a file, since with many headers it can be larger
+  # than a pipe holds, and collect stderr in one, so neither pipe can
+  # block the preprocessor while we are reading stdout.
+  with tempfile.TemporaryFile() as stdin, \
+       tempfile.TemporaryFile() as stderr:
+    stdin.write(include_text.encode("utf-8"))
+    stdin.seek(0)
+
+    with subprocess.Popen(
       command,
-      input=include_text,
-      text=True,
+      stdin=stdin,
       stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
-      check=True
-    )
-    lines = proc.stdout.splitlines()
-    total_lines = len(lines)
-    template_lines = sum(1 for line in lines if "template" in line)
-    return total_lines, template_lines
-
-  except subprocess.CalledProcessError as e:
-    print("Error invoking g++ with input:", file=sys.stderr)
-    print("-----------------------------", file=sys.stderr)
-    print(include_text, file=sys.stderr)
-    print("-----------------------------", file=sys.stderr)
-    print("g++ stderr output:", file=sys.stderr)
-    print(e.stderr, file=sys.stderr)
-    raise
+      stderr=stderr
+    ) as proc:
+      assert proc.stdout
+
+      try:
+        yield proc.stdout
+        # Drain anything the caller did not read.
+        while proc.stdout.read(CHUNK_SIZE):
+          pass
+      except BaseException:
+        proc.kill()
+        raise
+
+      if proc.wait() != 0:
+        stderr.seek(0)
+        report_compiler_error(include_text,
+                              stderr.read().decode("utf-8", "replace"))
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def time_syntax_check(include_text: str, include_dirs: List[str]) -> float:
+  """
+  Run `g++ -fsyntax-only -xc++ -` with the given include directives and
+  return the CPU time it took, in seconds.
+  """
+  command: List[str] = ["g++", "-fsyntax-only", "-xc++", "-"]
+  for dir in include_dirs:
+    command.append(f"-I{dir}")
+
+  start = child_cpu_seconds()
+  proc = subprocess.run(
+    command,
+    input=include_text,
+    text=True,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE
+  )
+  elapsed = child_cpu_seconds() - start
+  if proc.returncode != 0:
+    report_compiler_error(include_text, proc.stderr)
+    raise subprocess.CalledProcessError(proc.returncode, command)
+  return elapsed
+
+
+def read_deps_file(deps_file: str) -> List[str]:
+  """
+  Return the prerequisites in `deps_file`, a Makefile rule as written by
+  `g++ -MD`.
+  """
+  with open(deps_file, "r") as file:
+    text = file.read().replace("\\\n", " ")
+  _, _, prereqs = text.partition(": ")
+  return [re.sub(r"\\(.)", r"\1", word).replace("$$", "$")
+          for word in re.findall(r"(?:\\.|[^\s\\])+", prereqs)]
+
+
+def measure_prefix(
+  include_text: str,
+  include_dirs: List[str],
+  with_deps: bool,
+  syntax_only: bool
+) -> Tuple[Counts, List[str]]:
+  """
+  Return `run_preprocessor` of `include_text`, plus the
+  "compile_seconds" of `time_syntax_check` if `syntax_only`, and, if
+  `with_deps`, the files the preprocessor read.
+  """
+  deps: List[str] = []
+  if with_deps:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      deps_file = os.path.join(tmpdir, "deps.d")
+      counts = run_preprocessor(include_text, include_dirs, deps_file)
+      deps = read_deps_file(deps_file)
+  else:
+    counts = run_preprocessor(include_text, include_dirs)
+
+  if syntax_only:
+    counts["compile_seconds"] = time_syntax_check(include_text, include_dirs)
+  return counts, deps
+
+
+class ResultCache:
+  """
+  Persistent map from the inputs of a measurement to its result, stored
+  as JSON.  The inputs are the include text, include directories,
+  current directory, and compiler, which together form the key, and the
+  contents of the files the preprocessor read, which are checked on
+  lookup.
+
+  In the file, each distinct (file, hash) pair is stored once, in a
+  table the results refer to by index, since most results depend on
+  mostly the same system headers.  Keys not used in the last `MAX_AGE`
+  runs are dropped, as are the least recently used beyond `MAX_KEYS`,
+  so the file does not grow without bound.
+  """
+
+  # Version of the file format.  A file with a different version is
+  # ignored.
+  VERSION = 3
+
+  # Maximum number of results kept per key, for different contents of
+  # the files read.
+  MAX_RESULTS = 4
+
+  # Number of runs a key is kept for without being used.
+  MAX_AGE = 20
+
+  # Maximum number of keys kept.
+  MAX_KEYS = 1000
+
+  def __init__(self, cache_file: str, include_dirs: List[str]):
+    self.cache_file = cache_file
+    self.include_dirs = include_dirs
+
+    # Number of this run: one more than that of the run that saved the
+    # cache file.
+    self.run = 1
+
+    # Map from key to {"used": number of the last run that used it,
+    # "results": list of {"deps": [(file, hash)], "value": result}, most
+    # recent first}.
+    self.entries: Dict[str, Dict[str, Any]] = {}
+
+    # Compiler path and `--version` output, computed on first use.
+    self._compiler: Optional[List[str]] = None
+
+    # Hashes of the files read so far, or None for unreadable ones.
+    self._hashes: Dict[str, Optional[str]] = {}
+
+  @staticmethod
+  def default_file() -> str:
+    """Return the default cache file name."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or \
+      os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "count-header-lines", "cache.json")
+
+  def compiler(self) -> List[str]:
+    """Return the path and version of the compiler, `g++`."""
+    if self._compiler is None:
+      path = shutil.which("g++") or "g++"
+      version = subprocess.run(
+        ["g++", "--version"], stdout=subprocess.PIPE, text=True,
+        check=True).stdout
+      self._compiler = [os.path.realpath(path), version]
+    return self._compiler
+
+  def key(self, kind: str, include_text: str) -> str:
+    """
+    Return the key for the measurement of kind `kind` of `include_text`.
+    """
+    data = json.dumps([kind, include_text, self.include_dirs,
+                       os.getcwd(), self.compiler()])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+  def file_hash(self, path: str) -> Optional[str]:
+    """Return the hash of the contents of `path`, or None."""
+    if path not in self._hashes:
+      try:
+        with open(path, "rb") as file:
+          self._hashes[path] = hashlib.sha256(file.read()).hexdigest()
+      except OSError:
+        self._hashes[path] = None
+    return self._hashes[path]
+
+  def lookup(self, kind: str, include_text: str) -> Any:
+    """
+    Return the stored result of the measurement, or None if there is
+    none for the current contents of the files it read.
+    """
+    entry = self.entries.get(self.key(kind, include_text))
+    if entry is None:
+      return None
+    entry["used"] = self.run
+    for result in entry["results"]:
+      if all(self.file_hash(f) == h for f, h in result["deps"]):
+        return result["value"]
+    return None
+
+  def store(
+    self,
+    kind: str,
+    include_text: str,
+    deps: List[str],
+    value: Any
+  ) -> None:
+    """
+    Store `value` as the result of the measurement, which read the
+    files `deps`.
+    """
+    entry = self.entries.setdefault(self.key(kind, include_text),
+                                    {"used": self.run, "results": []})
+    entry["used"] = self.run
+    results = entry["results"]
+    results.insert(0, {"deps": [(f, self.file_hash(f)) for f in deps],
+                       "value": value})
+    del results[self.MAX_RESULTS:]
+
+  def load(self) -> None:
+    """Read the cache file, if it exists and has the right version."""
+    try:
+      with open(self.cache_file, "r") as file:
+        data = json.load(file)
+    except (OSError, ValueError):
+      return
+    if data.get("version") != self.VERSION:
+      return
+    files = [tuple(pair) for pair in data["files"]]
+    self.run = data["run"] + 1
+    self.entries = {
+      key: {"used": entry["used"],
+            "results": [{"deps": [files[i] for i in result["deps"]],
+                         "value": result["value"]}
+                        for result in entry["results"]]}
+      for key, entry in data["entries"].items()}
+
+  def save(self) -> None:
+    """Write the cache file, replacing it atomically, without the keys
+    that have gone unused too long."""
+    keys = sorted((key for key, entry in self.entries.items()
+                   if entry["used"] > self.run - self.MAX_AGE),
+                  key=lambda key: self.entries[key]["used"], reverse=True)
+    del keys[self.MAX_KEYS:]
+
+    # Table of (file, hash) pairs, and the index of each in it.
+    files: List[Tuple[str, Optional[str]]] = []
+    index: Dict[Tuple[str, Optional[str]], int] = {}
+
+    def intern(pair: Tuple[str, Optional[str]]) -> int:
+      i = index.get(pair)
+      if i is None:
+        i = index[pair] = len(files)
+        files.append(pair)
+      return i
+
+    entries = {
+      key: {"used": self.entries[key]["used"],
+            "results": [{"deps": [intern(pair) for pair in result["deps"]],
+                         "value": result["value"]}
+                        for result in self.entries[key]["results"]]}
+      for key in sorted(keys)}
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)),
+                exist_ok=True)
+    tmp = f"{self.cache_file}.tmp{os.getpid()}"
+    with open(tmp, "w") as file:
+      json.dump({"version": self.VERSION, "run": self.run, "files": files,
+                 "entries": entries}, file, separators=(",", ":"))
+    os.replace(tmp, self.cache_file)
+
+
+def map_in_pool(
+  func: Any,
+  include_texts: List[str],
+  jobs: int,
+  *args: Any
+) -> List[Any]:
+  """
+  Return `func(text, *args)` for each `text` in `include_texts`, in
+  order, running up to `jobs` of them at a time in worker processes.
+  """
+  if jobs <= 1 or len(include_texts) <= 1:
+    return [func(text, *args) for text in include_texts]
+
+  # Start the longest inputs, which take the longest, first, so that the
+  # workers finish at about the same time.
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    results = list(executor.map(func,
+                                reversed(include_texts),
+                                *(itertools.repeat(arg) for arg in args)))
+  results.reverse()
+  return results
+
+
+def run_preprocessor_on_all(
+  include_texts: List[str],
+  include_dirs: List[str],
+  jobs: int,
+  syntax_only: bool = False,
+  cache: Optional[ResultCache] = None
+) -> List[Counts]:
+  """
+  Return `measure_prefix` of each element of `include_texts`, in order,
+  running up to `jobs` of them at a time in worker processes.  Results
+  in `cache`, if provided, are used instead of running the compiler,
+  and new ones are added to it.
+  """
+  kind = "prefix+syntax" if syntax_only else "prefix"
+  results: List[Optional[Counts]] = [
+    None if cache is None else cache.lookup(kind, text)
+    for text in include_texts
+  ]
+
+  misses = [i for i, r in enumerate(results) if r is None]
+  measured = map_in_pool(measure_prefix,
+                         [include_texts[i] for i in misses],
+                         jobs, include_dirs, cache is not None, syntax_only)
+  for i, (counts, deps) in zip(misses, measured):
+    if cache is not None:
+      cache.store(kind, include_texts[i], deps, counts)
+    results[i] = counts
+
+  return [r for r in results if r is not None]
+
+
+def accumulate(headers: List[str], counts: List[Counts]) -> List[Measurement]:
+  """
+  Given the `counts` each of `headers` adds, return the measurements,
+  whose totals are the running sums of `counts`.
+  """
+  result: List[Measurement] = []
+  total: Counts = {}
+  for header, added in zip(headers, counts):
+    total = {m: total.get(m, 0) + v for m, v in added.items()}
+    result.append((header, added, total))
+  return result
 
 
 def measure_line_counts(
   headers: List[str],
-  include_dirs: List[str]
-) -> List[Tuple[str, int, int, int, int]]:
+  include_dirs: List[str],
+  jobs: int = 1,
+  syntax_only: bool = False,
+  cache: Optional[ResultCache] = None
+) -> List[Measurement]:
+  """
+  For each prefix of the header list, measure the `run_preprocessor`
+  counts, and with `syntax_only` the time to compile it.  Return the
+  list of measurements, in which each header's added counts are the
+  difference between the totals of its prefix and the previous one.
+
+  Up to `jobs` prefixes are measured in parallel, and those in `cache`
+  are not measured at all.
   """
-  For each prefix of the header list, measure the number of lines of
-  preprocessor output and number of lines containing "template".
-  Return a list of (header name, added lines, total lines,
-  added templates, total templates) tuples.
+  result: List[Measurement] = []
+  prev_total: Counts = {}
+
+  include_texts = [generate_includes(headers[:i])
+                   for i in range(1, len(headers) + 1)]
+  totals = run_preprocessor_on_all(include_texts, include_dirs, jobs,
+                                   syntax_only, cache)
+
+  for header, total in zip(headers, totals):
+    added = {m: v - prev_total.get(m, 0) for m, v in total.items()}
+    result.append((header, added, total))
+    prev_total = total
+
+  return result
+
+
+# Linemarker in preprocessor output: `# <line> "<file>" <flags>`.
+linemarker_re = re.compile(rb'''
+  ^\#\ (\d+)\ "                # 1: line number
+  ((?:[^"\\]|\\.)*)            # 2: file name, with escapes
+  "((?:\ \d+)*)$              # 3: flags
+''', re.VERBOSE)
+
+
+def attribute_lines(
+  lines: Iterable[bytes],
+  num_headers: int
+) -> List[Counts]:
+  """
+  Given the `lines` of preprocessor output for the `generate_includes`
+  of `num_headers` headers, return, for each header, the "lines",
+  "templates", "bytes", and "tokens" attributed to it.
+
+  Lines are attributed to the header whose #include line in "<stdin>"
+  was most recently entered, or to the first header before any is.
   """
-  result: List[Tuple[str, int, int, int, int]] = []
-  prev_total_lines = 0
-  prev_total_templates = 0
+  counts: List[Counts] = [
+    {"lines": 0, "templates": 0, "bytes": 0, "tokens": 0}
+    for _ in range(num_headers)
+  ]
+
+  # Stack of files being read, per the linemarker flags: 1 means a file
+  # was entered, 2 that it was returned to.
+  stack: List[bytes] = [b"<stdin>"]
+
+  # Line number in "<stdin>" of the next line of output from it.
+  stdin_line = 1
 
-  for i in range(1, len(headers) + 1):
-    prefix = headers[:i]
-    include_text = generate_includes(prefix)
-    total_lines, total_templates = run_preprocessor(include_text, include_dirs)
+  # Index of the header the current line is attributed to.
+  current = 0
 
-    added_lines = total_lines - prev_total_lines
-    added_templates = total_templates - prev_total_templates
-    result.append((headers[i - 1],
-                   added_lines, total_lines,
-                   added_templates, total_templates))
+  for line in lines:
+    m = linemarker_re.match(line)
+    if m:
+      lineno, fname, flags = int(m.group(1)), m.group(2), m.group(3).split()
+      if b"1" in flags:
+        if stack == [b"<stdin>"]:
+          # Entering the header #included on line `stdin_line`.
+          current = min(max(stdin_line - 1, 0), num_headers - 1)
+        stack.append(fname)
+      elif b"2" in flags:
+        if len(stack) > 1:
+          stack.pop()
+        stack[-1] = fname
+      else:
+        stack[-1] = fname
+      if stack == [b"<stdin>"]:
+        stdin_line = lineno
+    elif stack == [b"<stdin>"]:
+      stdin_line += 1
 
-    prev_total_lines = total_lines
-    prev_total_templates = total_templates
+    add_counts(counts[current], line)
+
+  return counts
+
+
+def run_attribution(
+  include_text: str,
+  num_headers: int,
+  include_dirs: List[str],
+  deps_file: Optional[str] = None
+) -> List[Counts]:
+  """
+  Return `attribute_lines` of the preprocessor output for
+  `include_text`, the includes of `num_headers` headers.
+  """
+  with preprocessor_output(include_text, include_dirs, deps_file) as output:
+    return attribute_lines(output, num_headers)
+
+
+def measure_line_counts_single_pass(
+  headers: List[str],
+  include_dirs: List[str],
+  cache: Optional[ResultCache] = None
+) -> List[Measurement]:
+  """
+  Like `measure_line_counts`, but run the preprocessor only once, on
+  all of `headers`, and split its output using `attribute_lines`.
+  """
+  include_text = generate_includes(headers)
+  counts: List[Counts] = run_cached(
+    cache, "single-pass", include_text,
+    lambda deps_file: run_attribution(include_text, len(headers),
+                                      include_dirs, deps_file))
+  return accumulate(headers, counts)
+
+
+def run_cached(
+  cache: Optional[ResultCache],
+  kind: str,
+  include_text: str,
+  func: Callable[[Optional[str]], Any]
+) -> Any:
+  """
+  Return the result in `cache`, if provided, of the measurement of kind
+  `kind` of `include_text`, or else `func(deps_file)`, where `func`
+  runs the preprocessor and has it write the files it read to
+  `deps_file` if that is not None.  The result is added to `cache`.
+  """
+  if cache is None:
+    return func(None)
+  value = cache.lookup(kind, include_text)
+  if value is None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      deps_file = os.path.join(tmpdir, "deps.d")
+      value = func(deps_file)
+      cache.store(kind, include_text, read_deps_file(deps_file), value)
+  return value
+
+
+# An #include line, as left in the output by `g++ -E -dI`.
+#   1: The directive.
+#   2: The file name with its delimiters.
+include_directive_re = re.compile(
+  rb'^\#\s*(include|include_next|import)\s*([<"][^>"]*[>"])')
+
+
+# Name used for "<stdin>", and the "<built-in>" and "<command-line>"
+# pseudo-files, in the include graph.
+ROOT = "<stdin>"
+
+
+def include_graph(
+  lines: Iterable[bytes]
+) -> Tuple[Dict[str, Counts], Dict[str, Set[str]]]:
+  """
+  Given the `lines` of output from `g++ -E -dI`, return the own counts
+  of each file read, and the include graph: for each file, the set of
+  files it #includes.  Linemarkers and #include lines are not counted.
+
+  An #include of a file that is not read again, because of its include
+  guard, leaves only the #include line, so that line's file name is
+  resolved to the file that the same spelling led to before from the
+  same file or, as the preprocessor looks it up the same way, from a
+  file whose lookup starts in the same place: for "name", the directory
+  of the including file if name is there, and otherwise the include
+  path, which is also where <name> is looked up.  An #include_next is
+  only resolved from the same file.
+  """
+  own: Dict[str, Counts] = {}
+  graph: Dict[str, Set[str]] = {ROOT: set()}
 
+  # Resolutions of #include file name spellings, by (including file,
+  # spelling) and by `lookup_key`.
+  resolved: Dict[Tuple[str, bytes], str] = {}
+  resolved_shared: Dict[Tuple[str, bytes], str] = {}
+
+  # Memo for `lookup_key`.
+  lookup_keys: Dict[Tuple[str, bytes, bytes], Optional[Tuple[str, bytes]]] = {}
+
+  def lookup_key(
+    includer: str, directive: bytes, spelling: bytes
+  ) -> Optional[Tuple[str, bytes]]:
+    """Return (directory, spelling), where directory is where the lookup
+    of `spelling` from `includer` starts, "" for the include path, or
+    None for an #include_next."""
+    key = (includer, directive, spelling)
+    if key not in lookup_keys:
+      result: Optional[Tuple[str, bytes]] = None
+      if directive != b"include_next":
+        result = ("", spelling)
+        if spelling.startswith(b'"'):
+          d = "" if includer == ROOT else os.path.dirname(includer)
+          name = spelling[1:-1].decode("utf-8", "replace")
+          if os.path.isfile(os.path.join(d, name)):
+            result = ("." if d == "" else d, spelling)
+      lookup_keys[key] = result
+    return lookup_keys[key]
+
+  # Stack of files being read.
+  stack: List[str] = [ROOT]
+
+  # (including file, spelling) and `lookup_key` of an #include line not
+  # yet followed by the file it names being entered.
+  pending: Optional[Tuple[str, bytes]] = None
+  pending_key: Optional[Tuple[str, bytes]] = None
+
+  def resolve_pending() -> None:
+    """Record the edge for `pending`, which was not entered."""
+    nonlocal pending
+    if pending is not None:
+      target = resolved.get(pending)
+      if target is None and pending_key is not None:
+        target = resolved_shared.get(pending_key)
+      if target is not None:
+        graph[pending[0]].add(target)
+      pending = None
+
+  for line in lines:
+    m = linemarker_re.match(line)
+    if m:
+      fname = m.group(2).decode("utf-8", "replace")
+      if fname.startswith("<"):
+        fname = ROOT
+      flags = m.group(3).split()
+      if b"1" in flags:
+        includer = stack[-1]
+        graph[includer].add(fname)
+        graph.setdefault(fname, set())
+        if pending is not None and pending[0] == includer:
+          resolved[pending] = fname
+          if pending_key is not None:
+            resolved_shared[pending_key] = fname
+          pending = None
+        resolve_pending()
+        stack.append(fname)
+      elif b"2" in flags:
+        resolve_pending()
+        if len(stack) > 1:
+          stack.pop()
+        stack[-1] = fname
+      else:
+        # A linemarker without flags also follows each #include line,
+        # before the file is entered, so it does not end `pending`.
+        stack[-1] = fname
+      continue
+
+    resolve_pending()
+    m = include_directive_re.match(line)
+    if m:
+      pending = (stack[-1], m.group(2))
+      pending_key = lookup_key(stack[-1], m.group(1), m.group(2))
+      continue
+
+    counts = own.get(stack[-1])
+    if counts is None:
+      counts = own[stack[-1]] = \
+        {"lines": 0, "templates": 0, "bytes": 0, "tokens": 0}
+    add_counts(counts, line)
+
+  resolve_pending()
+  return own, graph
+
+
+def dominators(root: str, graph: Dict[str, Set[str]]) -> Dict[str, str]:
+  """
+  Return the immediate dominator of each node of `graph` reachable from
+  `root`, with `root` its own.  Uses the algorithm of Cooper, Harvey,
+  and Kennedy, "A Simple, Fast Dominance Algorithm".
+  """
+  # Depth-first postorder, iteratively.
+  order: List[str] = []
+  visited = {root}
+  work: List[Tuple[str, Iterator[str]]] = [(root, iter(sorted(graph[root])))]
+  while work:
+    node, children = work[-1]
+    for child in children:
+      if child not in visited:
+        visited.add(child)
+        work.append((child, iter(sorted(graph[child]))))
+        break
+    else:
+      work.pop()
+      order.append(node)
+  index = {node: i for i, node in enumerate(order)}
+
+  preds: Dict[str, List[str]] = {node: [] for node in order}
+  for node in order:
+    for child in graph[node]:
+      preds[child].append(node)
+
+  idom: Dict[str, str] = {root: root}
+
+  def intersect(a: str, b: str) -> str:
+    while a != b:
+      while index[a] < index[b]:
+        a = idom[a]
+      while index[b] < index[a]:
+        b = idom[b]
+    return a
+
+  changed = True
+  while changed:
+    changed = False
+    for node in reversed(order):
+      if node == root:
+        continue
+      new_idom: Optional[str] = None
+      for p in preds[node]:
+        if p in idom:
+          new_idom = p if new_idom is None else intersect(p, new_idom)
+      assert new_idom is not None
+      if idom.get(node) != new_idom:
+        idom[node] = new_idom
+        changed = True
+  return idom
+
+
+def tree_costs(lines: Iterable[bytes]) -> List[Measurement]:
+  """
+  Given the `lines` of output from `g++ -E -dI`, return a measurement
+  (file name, own counts, exclusive counts) for each file reachable
+  from the root, by decreasing exclusive lines.
+  """
+  own, graph = include_graph(lines)
+  idom = dominators(ROOT, graph)
+
+  # Add each file's counts to those of its dominators, deepest first.
+  zero: Counts = {"lines": 0, "templates": 0, "bytes": 0, "tokens": 0}
+  exclusive = {node: dict(own.get(node, zero)) for node in idom}
+  depth: Dict[str, int] = {ROOT: 0}
+
+  def get_depth(node: str) -> int:
+    path = []
+    while node not in depth:
+      path.append(node)
+      node = idom[node]
+    d = depth[node]
+    for n in reversed(path):
+      d += 1
+      depth[n] = d
+    return d
+
+  for node in sorted(idom, key=get_depth, reverse=True):
+    if node != ROOT:
+      parent = exclusive[idom[node]]
+      for m, v in exclusive[node].items():
+        parent[m] += v
+
+  result = [(node, dict(own.get(node, zero)), exclusive[node])
+            for node in idom if node != ROOT]
+  result.sort(key=lambda r: (-r[2]["lines"], r[0]))
   return result
 
 
+def measure_tree(
+  headers: List[str],
+  include_dirs: List[str],
+  cache: Optional[ResultCache] = None
+) -> List[Measurement]:
+  """
+  Run the preprocessor once on `headers` and return its `tree_costs`.
+  """
+  include_text = generate_includes(headers)
+
+  def run(deps_file: Optional[str]) -> List[Measurement]:
+    with preprocessor_output(include_text, include_dirs, deps_file,
+                             ["-dI"]) as output:
+      return tree_costs(output)
+
+  return [(name, own, excl) for name, own, excl in
+          run_cached(cache, "tree", include_text, run)]
+
+
 include_re = re.compile("""
   ^\s*\#\s*include\s*           # "#include "
   ["<]                          # opening delimiter
@@ -150,22 +1017,80 @@ def expand_files(files: List[str]) -> List[str]:
   return ret
 
 
+def measured_metrics(measurements: List[Measurement]) -> List[Tuple[str, str]]:
+  """Return the elements of METRICS that `measurements` have values for."""
+  present = measurements[0][2].keys() if measurements else {"lines"}
+  return [(m, label) for m, label in METRICS if m in present]
+
+
+def format_metric(metric: str, value: float) -> str:
+  """Format `value` of `metric` for the text report."""
+  if metric.endswith("_seconds"):
+    return f"{value * 1000:.0f}"
+  return str(int(value))
+
+
 def print_report(
-  measurements: List[Tuple[str, int, int, int, int]]
+  measurements: List[Measurement],
+  prefixes: Tuple[str, str] = ("+", "t.")
 ) -> None:
   """
   Print the formatted summary table of header file measurements.
+  `prefixes` go before the metric names in the headings of the columns
+  for the two sets of counts.
   """
   # Compute width of "file name" column based on maximum `name` length.
   name_width = max(17, *(len(name) for name, *_ in measurements))
 
-  name_header = f"{'file name':<{name_width}}"
-  name_separa = "-" * name_width
+  # Column labels and widths: by default "+<metric>" for the added value
+  # and "t.<metric>" for the total.
+  metrics = measured_metrics(measurements)
+  labels = [prefix + label for _, label in metrics for prefix in prefixes]
+  widths = [max(7, len(label)) for label in labels]
 
-  print(f"{name_header}   +lines  t.lines  +templates  t.templates")
-  print(f"{name_separa}  -------  -------  ----------  -----------")
-  for name, added, total, added_tpl, total_tpl in measurements:
-    print(f"{name:<{name_width}}  {added:7}  {total:7}  {added_tpl:10}  {total_tpl:11}")
+  print("  ".join([f"{'file name':<{name_width}}"] +
+                  [f"{label:>{w}}" for label, w in zip(labels, widths)]))
+  print("  ".join(["-" * name_width] + ["-" * w for w in widths]))
+  for name, added, total in measurements:
+    values = [format_metric(m, counts[m])
+              for m, _ in metrics for counts in (added, total)]
+    print("  ".join([f"{name:<{name_width}}"] +
+                    [f"{v:>{w}}" for v, w in zip(values, widths)]))
+
+
+def write_csv(
+  measurements: List[Measurement],
+  kinds: Tuple[str, str] = ("added", "total")
+) -> None:
+  """
+  Write the measurements as CSV: a "header" column, then, by default,
+  "added_M" and "total_M" columns for each metric M.  Times are in
+  seconds.
+  """
+  metrics = [m for m, _ in measured_metrics(measurements)]
+  writer = csv.writer(sys.stdout, lineterminator="\n")
+  writer.writerow(["header"] + [f"{kind}_{m}" for m in metrics
+                                for kind in kinds])
+  for name, added, total in measurements:
+    writer.writerow([name] + [round(counts[m], 6) for m in metrics
+                              for counts in (added, total)])
+
+
+def write_json(
+  measurements: List[Measurement],
+  kinds: Tuple[str, str] = ("added", "total")
+) -> None:
+  """
+  Write the measurements as a JSON array of objects with "header" and,
+  by default, "added" and "total" attributes, the latter two mapping
+  metric names to values.  Times are in seconds.
+  """
+  json.dump([{"header": name,
+              kinds[0]: {m: round(v, 6) for m, v in added.items()},
+              kinds[1]: {m: round(v, 6) for m, v in total.items()}}
+             for name, added, total in measurements],
+            sys.stdout, indent=2)
+  print()
 
 
 def main() -> None:
@@ -175,8 +1100,38 @@ def main() -> None:
   if args.expand:
     files = expand_files(files)
 
-  measurements = measure_line_counts(files, args.includes)
-  print_report(measurements)
+  cache: Optional[ResultCache] = None
+  if args.cache or args.cache_file is not None:
+    cache = ResultCache(args.cache_file or ResultCache.default_file(),
+                        args.includes)
+    cache.load()
+
+  # Column heading prefixes and output names of the two sets of counts.
+  prefixes = ("+", "t.")
+  kinds = ("added", "total")
+
+  if (args.single_pass or args.tree) and args.syntax_only:
+    die("--syntax-only cannot be used with --single-pass or --tree")
+  if args.tree:
+    measurements = measure_tree(files, args.includes, cache)
+    prefixes = ("own.", "excl.")
+    kinds = ("own", "exclusive")
+  elif args.single_pass:
+    measurements = measure_line_counts_single_pass(files, args.includes,
+                                                   cache)
+  else:
+    measurements = measure_line_counts(files, args.includes, args.jobs,
+                                       args.syntax_only, cache)
+
+  if cache is not None:
+    cache.save()
+
+  if args.format == "csv":
+    write_csv(measurements, kinds)
+  elif args.format == "json":
+    write_json(measurements, kinds)
+  else:
+    print_report(measurements, prefixes)
 
 
 if __name__ == "__main__":
@@ -68,6 +68,9 @@ Corresponding output:
   some other line, will be "ignored"
   { eleven, nine,            twenty },
 
+The input is processed as a stream: only the lines of the current table
+are held in memory, and other lines are written out as they are read.
+
 """
 
 import argparse              # argparse
@@ -75,6 +78,7 @@ import os                    # os.getenv
 import re                    # re.compile
 import signal                # signal.signal
 import sys                   # sys.argv, sys.stderr, sys.stdin
+import time                  # time.perf_counter
 import traceback             # traceback.print_exc
 
 
@@ -215,18 +219,85 @@ def testParseColumnDescriptors():
   oneTest("a\\ b \\@2:c", [(None, "a\\ b"), (None, "\\@2:c")])
 
 
-def parseTableRow(rowText, columns):
+# Matches RE syntax that refers to groups by number or name, which
+# would break if the RE were embedded in a larger one.
+groupReferenceRE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?\(')
+
+def compileRowRE(columns):
+  """
+  Combine the column descriptors in 'columns' into a single RE that
+  parses an entire row in one pass, or return None if that is not
+  possible.
+
+  The combined RE has the form
+
+    (?:RE1)(?:(?>.*?(?P<col1>RE2))(?:(?>.*?(?P<col2>RE3))...)?)?
+
+  where each atomic group finds the leftmost match of its column RE
+  after the previous one, exactly like a 'search', and is never
+  revisited when a later column fails to match.  Group 'colK' is the
+  start of entry K+1 (0-based K), or unset if that column RE was not
+  found.
+
+  Column REs that use backreferences, conditionals, or named groups
+  cannot be embedded, nor can those with global inline flags, so for
+  those the caller must parse column by column instead.
+  """
+
+  for col in columns:
+    if groupReferenceRE.search(col[1].pattern):
+      return None
+
+  tail = ""
+  for k in range(len(columns)-1, 0, -1):
+    tail = f"(?:(?>(?s:.)*?(?P<col{k}>{columns[k][1].pattern})){tail})?"
+
+  try:
+    return re.compile(f"(?:{columns[0][1].pattern}){tail}")
+  except re.error:
+    return None
+
+
+def parseTableRow(rowText, columns, rowRE=None):
   """
   Given the text of a row, 'rowText', and a sequence of parsed
   column descriptors, 'columns', yield a sequence of strings
   extracted from 'rowText' that will become table entries.
 
+  If 'rowRE' is not None, it is the result of 'compileRowRE(columns)',
+  and is used to parse the row in one pass.
+
   Alternatively, if 'rowText' does not match the column descriptors,
   return None.
   """
 
   entries = []
 
+  if rowRE is not None:
+    rowMatch = rowRE.match(rowText)
+    if not rowMatch:
+      return None
+
+    prevStartIndex = rowMatch.start(0)
+
+    # The 'colK' groups are the only named ones, in order.
+    for groupIndex in rowRE.groupindex.values():
+      startIndex = rowMatch.start(groupIndex)
+      if startIndex < 0:
+        # This column did not match, so all text from 'prevStartIndex' is
+        # the final entry in this row.
+        entries.append(rowText[prevStartIndex:].rstrip(" "))
+        prevStartIndex = len(rowText)
+        break
+
+      entries.append(rowText[prevStartIndex:startIndex].rstrip(" "))
+      prevStartIndex = startIndex
+
+    if prevStartIndex < len(rowText):
+      entries.append(rowText[prevStartIndex:].rstrip(" "))
+
+    return entries
+
   # First column is special.
   colStartRE = columns[0][1]
   firstEntryMatch = colStartRE.match(rowText)
@@ -237,14 +308,15 @@ def parseTableRow(rowText, columns):
     # Index of the end of the previous match.
     prevEndIndex = firstEntryMatch.end(0)
 
-    # Look match successive column REs.
+    # Look match successive column REs.  Searching from 'prevEndIndex'
+    # rather than in a slice avoids copying the rest of the row.
     for col in columns[1:]:
       colStartRE = col[1]
-      entryMatch = colStartRE.search(rowText[prevEndIndex:])
+      entryMatch = colStartRE.search(rowText, prevEndIndex)
       if entryMatch:
         # Index of start/end for this match.
-        startIndex = prevEndIndex + entryMatch.start(0)
-        endIndex   = prevEndIndex + entryMatch.end(0)
+        startIndex = entryMatch.start(0)
+        endIndex   = entryMatch.end(0)
 
         # Pull out the previous entry text.
         entryText = rowText[prevStartIndex:startIndex].rstrip(" ")
@@ -278,9 +350,71 @@ def parseTableRow(rowText, columns):
     return None
 
 
-def emitTable(leadingWhitespace, rows, columns):
+def testParseTableRow():
+  """Unit tests for 'parseTableRow' and 'compileRowRE'."""
+
+  def oneTest(descriptors, rowText, expect, combinable=True):
+    columns = parseColumnDescriptors(descriptors)
+    rowRE = compileRowRE(columns)
+    assert (rowRE is not None) == combinable
+
+    for actual in (parseTableRow(rowText, columns),
+                   parseTableRow(rowText, columns, rowRE)):
+      if actual != expect:
+        print(f"descriptors: {descriptors}")
+        print(f"rowText: {rowText}")
+        print(f"actual: {actual}")
+        print(f"expect: {expect}")
+      assert actual == expect
+
+  oneTest(r"\{ \S+ \S+ @30:\S+ \}", "{ a, bronze, bar },",
+          ["{", "a,", "bronze,", "bar", "},"])
+
+  # First RE does not match.
+  oneTest(r"\{ \S+", "some other line", None)
+
+  # A column RE that is not found ends the row.
+  oneTest(r"\S+ b+\ c+ \S+", "a bb x", ["a bb x"])
+  oneTest(r"\S+ b+\ c+ \S+", "a bb cc d", ["a", "bb cc", "d"])
+
+  # Later columns must not backtrack into earlier ones.
+  oneTest(r"x b+ b", "x bb", ["x", "bb"])
+
+  # Empty matches at the end of the row.
+  oneTest(r"a $ $", "a", ["a", ""])
+  oneTest(r"a $", "a", ["a"])
+
+  # REs that cannot be combined.
+  oneTest(r"(a)\1 b", "aa b", ["aa", "b"], combinable=False)
+  oneTest(r"(?i)a b", "A b", ["A", "b"], combinable=False)
+
+
+def benchmarkParseTableRow(numRows=100000, repeat=5):
+  """
+  Time 'parseTableRow' over 'numRows' generated rows, both column by
+  column and with the combined row RE, and print the best of 'repeat'
+  runs for each.
+  """
+
+  columns = parseColumnDescriptors(r"\{ \S+ \S+ @30:\S+ \}")
+  rowRE = compileRowRE(columns)
+  rows = [f"{{ name{i}, value{i * 7}, {i % 13}, }}," for i in range(numRows)]
+
+  for label, r in (("per-column search", None), ("combined RE", rowRE)):
+    elapsed = float("inf")
+    for _ in range(repeat):
+      start = time.perf_counter()
+      for rowText in rows:
+        parseTableRow(rowText, columns, r)
+      elapsed = min(elapsed, time.perf_counter() - start)
+    print(f"{label}: {numRows} rows in {elapsed:.3f}s " +
+          f"({elapsed * 1e6 / numRows:.2f} us/row)")
+
+
+def emitTable(leadingWhitespace, rows, columns, out):
   """
-  Format and emit 'rows' according to the 'columns' descriptors.
+  Format and emit 'rows' according to the 'columns' descriptors, writing
+  to the file 'out'.
 
   'leadingWhitespace' is a string consisting entirely of whitespace to
   emit at the start of the line, and which is counted toward meeting the
@@ -360,43 +494,53 @@ def emitTable(leadingWhitespace, rows, columns):
     print(f"maxWidth: {maxWidth}")
 
   # Render rows, taking 'maxWidth' into account for all but the last
-  # data column in each row.
+  # data column in each row.  Each row is assembled into one string so
+  # it can be written with a single call.
   for r in rows:
     if type(r) is list:
-      print(leadingWhitespace, end="")
-
       # None of the row lists should be empty.
       assert len(r) >= 1
 
+      # Pieces of the output line.
+      parts = [leadingWhitespace]
+
       colIndex = 0
       while colIndex < len(r) - 1:
-        entryText = r[colIndex]
-
-        # Add padding to the end of 'entryText'.
-        paddingLen = maxWidth[colIndex] - len(entryText)
-        assert paddingLen >= 0
-        entryText += " " * paddingLen
-
         if colIndex > 0:
           # Space between columns.
-          print(" ", end="")
+          parts.append(" ")
 
-        print(entryText, end="")
+        # Add padding to the end of the entry text.  The widths were
+        # computed above to be at least the entry lengths.
+        parts.append(r[colIndex].ljust(maxWidth[colIndex]))
 
         colIndex += 1
 
       # The last entry is special because no padding is applied, and
       # we follow it with a newline.
-      print(" ", end="")
-      print(r[colIndex])
+      parts.append(" ")
+      parts.append(r[colIndex])
+      parts.append("\n")
+      out.write("".join(parts))
 
     else:
-      # Print strings as they are, followed by a newline.
-      print(r)
+      # Write strings as they are, followed by a newline.
+      out.write(r + "\n")
 
 
 def main():
+  # Parse command line.
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--benchmark", action="store_true",
+    help="Time the row parser on 100k generated rows and exit.")
+  opts = parser.parse_args()
+
   testParseColumnDescriptors()
+  testParseTableRow()
+
+  if opts.benchmark:
+    benchmarkParseTableRow()
+    return
 
   # Line that begins a table.
   tableHeaderRE = re.compile(r'^(\s*)// Columns: (.*)$')
@@ -404,16 +548,26 @@ def main():
   # Table line, just pulling out the leading whitespace.
   tableLineRE = re.compile(r'(\s*)(.*)$')
 
-  # All input lines.
-  inputLines = sys.stdin.readlines()
+  # Input lines, read as they are needed, without line endings.
+  inputLines = (line.rstrip("\r\n") for line in sys.stdin)
+
+  # Output.  When it is not a terminal, `sys.stdout` is block-buffered,
+  # so the many small writes are cheap.
+  out = sys.stdout
 
-  # Index of next input line to parse.
-  inputLineIndex = 0
+  # Line that ended the previous table, and so has been read but not
+  # processed, or None.
+  pendingLine = None
 
   # Scan for the start of a table.
-  while inputLineIndex < len(inputLines):
-    candidateHeaderLine = inputLines[inputLineIndex].rstrip("\r\n")
-    inputLineIndex += 1
+  while True:
+    if pendingLine is not None:
+      candidateHeaderLine = pendingLine
+      pendingLine = None
+    else:
+      candidateHeaderLine = next(inputLines, None)
+      if candidateHeaderLine is None:
+        break
 
     if debug:
       print(f"candidateHeaderLine: {candidateHeaderLine}")
@@ -422,6 +576,7 @@ def main():
     if headerMatch:
       headerLeadingWhitespace = headerMatch.group(1)
       columns = parseColumnDescriptors(headerMatch.group(2))
+      rowRE = compileRowRE(columns)
 
       if debug:
         print("found matching header:")
@@ -439,10 +594,7 @@ def main():
       rows.append(candidateHeaderLine)
 
       # Parse the rows of the table.
-      while inputLineIndex < len(inputLines):
-        tableLine = inputLines[inputLineIndex].rstrip("\r\n")
-        inputLineIndex += 1
-
+      for tableLine in inputLines:
         # Separate the leading whitespace, which should always succeed.
         lineMatch = tableLineRE.match(tableLine)
         assert lineMatch
@@ -452,11 +604,11 @@ def main():
         if len(rowLeadingWhitespace) < len(headerLeadingWhitespace):
           # End of table definition.  Put that line back so it can start a
           # new table.
-          inputLineIndex -= 1
+          pendingLine = tableLine
           break
 
         # Parse the entries of the line.
-        entries = parseTableRow(rowText, columns)
+        entries = parseTableRow(rowText, columns, rowRE)
         if entries is None:
           # Add the line as a string.
           rows.append(tableLine)
@@ -464,11 +616,11 @@ def main():
           rows.append(entries)
 
       # Format and emit the table.
-      emitTable(headerLeadingWhitespace, rows, columns)
+      emitTable(headerLeadingWhitespace, rows, columns, out)
 
     else:
       # Not a recognized header, just emit the line unchanged.
-      print(candidateHeaderLine)
+      out.write(candidateHeaderLine + "\n")
 
 
 call_main()
@@ -15,18 +15,44 @@ the output would be:
   #include "ast/something-in-ast.h"        // bar
   #include "something-else.h"          // other
 
+The directories searched are the immediate subdirectories of the
+current directory or, with `--recursive`, all directories below it, in
+which case the prepended name can have several components and symbolic
+links to directories are not followed.  Directories whose names start
+with "." are skipped.  If a file name is found in
+more than one directory, the #include is left alone and the ambiguity
+is reported on stderr.
+
+With `--snapshot FILE`, the directory listings are saved in FILE and
+reused on the next run for each directory whose modification time has
+not changed, so an unchanged tree costs one stat per directory.
+
+With `--in-place PATH...`, instead of filtering stdin, every #include
+line in the files PATH, and in the C/C++ source files in the directory
+trees PATH, is rewritten the same way.  Files are processed in parallel
+(see `--jobs`), and each changed file is replaced atomically by
+renaming a temporary file over it, except that a file with several hard
+links, or whose owner could not be preserved, is overwritten instead.
+Symbolic links are rewritten through, not replaced.  Unchanged files
+are not written.
+The names of the changed files are printed.
+
 Note that this script does not align the comments.  See
 format-header-comments.py for that capability.
 """
 
 import argparse              # argparse
+import concurrent.futures    # ProcessPoolExecutor
+import json                  # json.load, json.dump
 import os                    # os.getenv
 import re                    # re.compile
+import shutil                # shutil.copymode
 import signal                # signal.signal
 import sys                   # sys.argv, sys.stderr, sys.stdin
+import time                  # time.time
 import traceback             # traceback.print_exc
 
-from typing import Any, Match, Pattern, TextIO
+from typing import Any, Match, Optional, Pattern, TextIO
 
 
 # -------------- BEGIN: boilerplate -------------
@@ -79,70 +105,338 @@ def call_main() -> None:
 # --------------- END: boilerplate --------------
 
 
-filesInDir: dict[str, dict[str, bool]]
+class DirectoryLister:
+  """Lists directories, optionally reusing the listings saved in a
+  snapshot file for directories whose modification times have not
+  changed since."""
+
+  # Version of the snapshot file format.  A file with a different
+  # version is ignored.
+  VERSION = 2
+
+  def __init__(self, snapshot_file: Optional[str] = None):
+    # Where `load` and `save` read and write, or None to not use one.
+    self.snapshot_file = snapshot_file
+
+    # Listings from the snapshot file: map from directory to
+    # [modification time in ns, file names, subdirectory names, names of
+    # symbolic links to directories].
+    self.old: dict[str, list[Any]] = {}
+
+    # The listings made or reused in this run, to save.
+    self.new: dict[str, list[Any]] = {}
+
+    # Directories modified this close (in ns) to when the snapshot was
+    # saved could have changed again within the same mtime tick, so
+    # they are listed again.
+    self.racy_after = 0
+
+  def load(self) -> None:
+    """Read the snapshot file, if it exists and is for the current
+    directory."""
+    if self.snapshot_file is None:
+      return
+    try:
+      with open(self.snapshot_file, "r") as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return
+    if data.get("version") == self.VERSION and \
+       data.get("root") == os.getcwd():
+      self.old = data["dirs"]
+      self.racy_after = data["saved"] - 2_000_000_000
+
+  def save(self) -> None:
+    """Write the snapshot file, replacing it atomically."""
+    if self.snapshot_file is None:
+      return
+    tmp = f"{self.snapshot_file}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+      json.dump({"version": self.VERSION, "root": os.getcwd(),
+                 "saved": time.time_ns(), "dirs": self.new}, f,
+                separators=(",", ":"))
+    os.replace(tmp, self.snapshot_file)
+
+  def list(self, d: str) -> tuple[list[str], list[str], list[str]]:
+    """Return the sorted names of the files, of the subdirectories, and
+    of the symbolic links to directories in directory `d`."""
+    mtime = os.stat(d).st_mtime_ns
+    entry = self.old.get(d)
+    if entry is None or entry[0] != mtime or mtime >= self.racy_after:
+      files: list[str] = []
+      subdirs: list[str] = []
+      linked_subdirs: list[str] = []
+      # The entries' `is_*` methods use the types `scandir` already
+      # got from the directory, without a stat call, except `is_dir`
+      # on a symbolic link, which has to follow it.
+      with os.scandir(d) as it:
+        for e in it:
+          if e.is_dir(follow_symlinks=False):
+            subdirs.append(e.name)
+          elif e.is_dir():
+            linked_subdirs.append(e.name)
+          elif e.is_file():
+            files.append(e.name)
+      entry = [mtime, sorted(files), sorted(subdirs), sorted(linked_subdirs)]
+    self.new[d] = entry
+    return entry[1], entry[2], entry[3]
+
+
+def get_subdirs(recursive: bool, lister: DirectoryLister) -> list[str]:
+  """Return the subdirectories of the current directory, as relative
+  paths, skipping those whose names start with ".".  If `recursive`,
+  include their subdirectories, and so on, but not symbolic links to
+  directories, which could form a cycle, and would otherwise make the
+  files in the directories they point to look ambiguous."""
+
+  result: list[str] = []
+
+  # Directories whose subdirectories are yet to be added.
+  todo = ["."]
+  while todo:
+    parent = todo.pop()
+    _, subdirs, linked_subdirs = lister.list(parent)
+    if not recursive:
+      result.extend(n for n in linked_subdirs if not n.startswith("."))
+    for n in reversed(subdirs):
+      if not n.startswith("."):
+        d = n if parent == "." else os.path.join(parent, n)
+        result.append(d)
+        if recursive:
+          todo.append(d)
+
+  return sorted(result)
+
+
+def get_map_of_file_to_dirs(
+  recursive: bool,
+  lister: Optional[DirectoryLister] = None
+) -> dict[str, list[str]]:
+  """Return a dictionary that maps the name of each file in a directory
+  returned by `get_subdirs` to the list of those directories it is in,
+  in sorted order.  Directories are listed by `lister`."""
+
+  if lister is None:
+    lister = DirectoryLister()
+
+  result: dict[str, list[str]] = {}
+
+  for d in get_subdirs(recursive, lister):
+    files, _, _ = lister.list(d)
+    for f in files:
+      result.setdefault(f, []).append(d)
+
+  return result
+
+
+# An #include line:
+#   1. Optional preceding whitespace.
+#   2. The file name.
+#   3. Optional trailing contents, such as a comment.
+includeLineRE = re.compile(R'^(\s*)#include "([^"]+)"(.*)$')
+
+
+def rewrite_line(line: str, file_to_dirs: dict[str, list[str]],
+                 where: str) -> str:
+  """Return `line`, without its line ending, with the directory of the
+  file it #includes, if any, prepended to the file name.  Ambiguities
+  are reported with the prefix `where`."""
+
+  if m := includeLineRE.match(line):
+    leading = m.group(1)
+    fname = m.group(2)
+    trailing = m.group(3)
+
+    # If `fname` is in exactly one directory, insert its name.
+    dirs = file_to_dirs.get(fname, [])
+    if len(dirs) == 1:
+      return f'{leading}#include "{dirs[0]}/{fname}"{trailing}'
+    elif len(dirs) > 1:
+      print(f'{where}{fname}: ambiguous, found in: {", ".join(dirs)}',
+            file=sys.stderr)
+
+  return line
+
 
+# File name extensions of the files rewritten in directories given to
+# `--in-place`.
+SOURCE_EXTENSIONS = (".h", ".hh", ".hpp", ".hxx",
+                     ".c", ".cc", ".cpp", ".cxx")
 
-def get_map_of_subdir_to_files() -> dict[str, dict[str, bool]]:
-  """Return a dictionary that maps each subdirectory of the current
-  directory to the set of files in it, where each set is a dictionary
-  from the name to True."""
 
-  result: dict[str, dict[str, bool]] = {}
+def get_files_to_rewrite(paths: list[str]) -> list[str]:
+  """Return the files named by `paths`: files themselves, and the source
+  files in directory trees, skipping directories starting with ".".
+  Other names for a file already returned, such as symbolic or hard
+  links to it, are left out so it is not rewritten twice at once."""
 
-  for d in os.listdir("."):
-    if os.path.isdir(d):
-      files: dict[str, bool] = {}
+  result: list[str] = []
 
-      for f in os.listdir(d):
-        if os.path.isfile(os.path.join(d, f)):
-          files[f] = True
+  # Device and inode numbers of the files in `result`.
+  seen: set[tuple[int, int]] = set()
 
-      result[d] = files
+  def add(fname: str) -> None:
+    st = os.stat(fname)
+    if (st.st_dev, st.st_ino) not in seen:
+      seen.add((st.st_dev, st.st_ino))
+      result.append(fname)
+
+  for path in paths:
+    if not os.path.isdir(path):
+      add(path)
+      continue
+
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames[:] = sorted(n for n in dirnames if not n.startswith("."))
+      for f in sorted(filenames):
+        if f.endswith(SOURCE_EXTENSIONS):
+          add(os.path.join(dirpath, f))
 
   return result
 
 
+# The map from file name to directories used by the worker processes of
+# `rewrite_files`, set once per worker by `init_rewrite_worker`.
+worker_file_to_dirs: dict[str, list[str]] = {}
+
+
+def init_rewrite_worker(file_to_dirs: dict[str, list[str]]) -> None:
+  """Pool initializer: remember the map to rewrite with."""
+  global worker_file_to_dirs
+  worker_file_to_dirs = file_to_dirs
+
+
+def rewrite_file(fname: str) -> bool:
+  """Rewrite the #include lines of `fname` using `worker_file_to_dirs`.
+  Return True if it changed."""
+
+  # Preserve line endings and any bytes that are not valid UTF-8.
+  with open(fname, "r", encoding="utf-8", errors="surrogateescape",
+            newline="") as f:
+    text = f.read()
+
+  lines: list[str] = []
+  for num, line in enumerate(text.splitlines(keepends=True), 1):
+    body = line.rstrip("\r\n")
+    lines.append(rewrite_line(body, worker_file_to_dirs, f"{fname}:{num}: ")
+                 + line[len(body):])
+  new_text = "".join(lines)
+
+  if new_text == text:
+    return False
+
+  write_file(fname, new_text)
+  return True
+
+
+def write_file(fname: str, text: str) -> None:
+  """Replace the contents of `fname` with `text`.
+
+  Normally this writes a temporary file and renames it over the file
+  that `fname` names or, if it is a symbolic link, points to, so the
+  file is never seen half written.  But that would detach a file with
+  other hard links from them, and give the file a new owner if we
+  cannot give it the old one, so such a file is overwritten instead."""
+
+  target = os.path.realpath(fname)
+  st = os.stat(target)
+
+  def overwrite() -> None:
+    with open(target, "w", encoding="utf-8", errors="surrogateescape",
+              newline="") as f:
+      f.write(text)
+
+  if st.st_nlink > 1:
+    overwrite()
+    return
+
+  tmp = f"{target}.tmp{os.getpid()}"
+  try:
+    with open(tmp, "w", encoding="utf-8", errors="surrogateescape",
+              newline="") as f:
+      f.write(text)
+    shutil.copymode(target, tmp)
+
+    tmp_st = os.stat(tmp)
+    if (tmp_st.st_uid, tmp_st.st_gid) != (st.st_uid, st.st_gid):
+      try:
+        os.chown(tmp, st.st_uid, st.st_gid)
+      except PermissionError:
+        os.remove(tmp)
+        overwrite()
+        return
+
+    os.replace(tmp, target)
+  except BaseException:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
+
+
+def rewrite_files(fnames: list[str], file_to_dirs: dict[str, list[str]],
+                  jobs: int) -> list[str]:
+  """Rewrite `fnames` in place using `file_to_dirs`, with `jobs` worker
+  processes.  Return the names of the files that changed."""
+
+  if jobs <= 1 or len(fnames) <= 1:
+    init_rewrite_worker(file_to_dirs)
+    changed = [rewrite_file(f) for f in fnames]
+
+  else:
+    # Use a few chunks per worker so that one slow chunk does not leave
+    # the other workers idle at the end.
+    chunksize = max(1, len(fnames) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+      max_workers=jobs,
+      initializer=init_rewrite_worker,
+      initargs=(file_to_dirs,),
+    ) as executor:
+      changed = list(executor.map(rewrite_file, fnames, chunksize=chunksize))
+
+  return [f for f, c in zip(fnames, changed) if c]
+
+
 def main():
   # Parse command line.
   parser = argparse.ArgumentParser(
     description="Read in a set of #includes, write it out with "+
                 "directory names added.")
+  parser.add_argument("-r", "--recursive", action="store_true",
+    help="Look for files in all directories below the current one, "+
+         "not just its immediate subdirectories.")
+  parser.add_argument("--in-place", metavar="PATH", nargs="+",
+    help="Rewrite the files PATH, and the source files in the "+
+         "directories PATH, in place, instead of filtering stdin.")
+  parser.add_argument("--snapshot", metavar="FILE",
+    help="Save the directory listings in FILE, and reuse them for "+
+         "unmodified directories.")
+  parser.add_argument("-j", "--jobs", type=int, metavar="N",
+    default=os.cpu_count() or 1,
+    help="With --in-place, rewrite files using N processes.  "+
+         "Default: the number of CPUs.")
   opts = parser.parse_args()
 
-  # All input lines.
-  inputLines = sys.stdin.readlines()
+  # Directories containing each file name.
+  lister = DirectoryLister(opts.snapshot)
+  lister.load()
+  file_to_dirs = get_map_of_file_to_dirs(opts.recursive, lister)
+  lister.save()
 
-  # An #include line:
-  #   1. Optional preceding whitespace.
-  #   2. The file name.
-  #   3. Optional trailing contents, such as a comment.
-  includeLineRE = re.compile(R'^(\s*)#include "([^"]+)"(.*)$')
+  if opts.in_place:
+    fnames = get_files_to_rewrite(opts.in_place)
+    for fname in rewrite_files(fnames, file_to_dirs, opts.jobs):
+      print(fname)
+    return
 
-  # Files in subdirectories.
-  subdir_to_files = get_map_of_subdir_to_files()
+  # All input lines.
+  inputLines = sys.stdin.readlines()
 
   # Parse lines.
   for line in inputLines:
     # Strip line endings.
     line = line.rstrip("\r\n")
 
-    printed = False
-
-    if m := includeLineRE.match(line):
-      leading = m.group(1)
-      fname = m.group(2)
-      trailing = m.group(3)
-
-      # If `fname` is in the map, insert its directory name.
-      for d, files in subdir_to_files.items():
-        if fname in files:
-          print(f'{leading}#include "{d}/{fname}"{trailing}')
-          printed = True
-          break
-
-    if not printed:
-      # Print the original line.
-      print(line)
+    print(rewrite_line(line, file_to_dirs, ""))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,2 @@
+int a1;
+int a2;
@@ -0,0 +1 @@
+int b1;
@@ -0,0 +1,64 @@
+#!/bin/sh
+# Run tests in current directory.
+
+set -e
+set -x
+
+cp a.h tmp.a.h.orig
+
+# A header following --cache is measured, not taken as the cache file.
+XDG_CACHE_HOME=$(pwd)/tmp.cache \
+  ../../count-header-lines.py --cache a.h b.h > tmp.out
+cmp a.h tmp.a.h.orig
+grep -q '^a\.h ' tmp.out
+grep -q '^b\.h ' tmp.out
+
+# Same with an explicit cache file, which is then used on a second run.
+../../count-header-lines.py --cache-file tmp.cache.json a.h b.h > tmp.out
+test -s tmp.cache.json
+../../count-header-lines.py --cache-file tmp.cache.json a.h b.h > tmp.out2
+diff tmp.out tmp.out2
+
+# A key not used in the last 20 runs is dropped from the cache.
+../../count-header-lines.py --cache-file tmp.cache.json a.h > tmp.out
+for i in $(seq 20); do
+  ../../count-header-lines.py --cache-file tmp.cache.json b.h > tmp.out
+done
+python3 -c '
+import json
+assert len(json.load(open("tmp.cache.json"))["entries"]) == 1
+'
+
+rm -r tmp.a.h.orig tmp.out tmp.out2 tmp.cache tmp.cache.json
+
+# The metrics in CSV and JSON, leaving out the times, which vary.  The
+# JSON is turned into the same form as the CSV.
+../../count-header-lines.py --format csv a.h b.h > tmp.out
+cut -d, -f1-9 tmp.out > tmp.actual
+diff formats.expect tmp.actual
+../../count-header-lines.py --format json a.h b.h > tmp.out
+python3 -c '
+import json, sys
+metrics = ["lines", "templates", "bytes", "tokens"]
+print(",".join(["header"] + [f"{k}_{m}" for m in metrics
+                             for k in ("added", "total")]))
+for r in json.load(sys.stdin):
+  print(",".join([r["header"]] + [str(r[k][m]) for m in metrics
+                                  for k in ("added", "total")]))
+' < tmp.out > tmp.actual
+diff formats.expect tmp.actual
+
+rm tmp.out tmp.actual
+
+# Own and exclusive lines with --tree.  q/q2.h re-includes "config.h",
+# meaning q/config.h, after p/p.h included its own "config.h", and
+# q/q.h and p/p.h both include inc/common.h, so neither q/config.h nor
+# inc/common.h is exclusive to one header.  System headers are left out
+# of the comparison.
+(cd tree && ../../../count-header-lines.py --tree -I inc top.h) > tmp.out
+awk 'NR > 2 && $1 !~ /^\// { print $1, $2, $3 }' tmp.out > tmp.actual
+diff tree.expect tmp.actual
+
+rm tmp.out tmp.actual
+
+# EOF
@@ -0,0 +1,7 @@
+#ifndef COMMON_H
+#define COMMON_H
+int common1;
+int common2;
+int common3;
+int common4;
+#endif
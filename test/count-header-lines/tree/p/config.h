@@ -0,0 +1,4 @@
+#ifndef p_CONFIG_H
+#define p_CONFIG_H
+int p_config;
+#endif
@@ -0,0 +1,6 @@
+#ifndef p_H
+#define p_H
+#include "config.h"
+#include "common.h"
+int p;
+#endif
@@ -0,0 +1,5 @@
+#ifndef q_CONFIG_H
+#define q_CONFIG_H
+int q_config1;
+int q_config2;
+#endif
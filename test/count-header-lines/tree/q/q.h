@@ -0,0 +1,6 @@
+#ifndef q_H
+#define q_H
+#include "config.h"
+#include "common.h"
+int q;
+#endif
@@ -0,0 +1,5 @@
+#ifndef q2_H
+#define q2_H
+#include "config.h"
+int q2;
+#endif
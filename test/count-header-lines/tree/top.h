@@ -0,0 +1,4 @@
+#include "q/q.h"
+#include "p/p.h"
+#include "q/q2.h"
+int top;
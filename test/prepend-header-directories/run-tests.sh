@@ -0,0 +1,38 @@
+#!/bin/sh
+# Run tests in current directory.
+
+set -e
+set -x
+
+# Build a tree in which smbase/sub/up is a symbolic link back up to
+# smbase, forming a cycle.
+rm -rf tmp.tree
+mkdir -p tmp.tree/smbase/sub
+touch tmp.tree/smbase/s.h tmp.tree/smbase/sub/t.h
+ln -s .. tmp.tree/smbase/sub/up
+
+# The recursive search must not follow the link around the cycle, nor
+# report s.h as also being in smbase/sub/up.
+(cd tmp.tree && ../../../prepend-header-directories.py -r) \
+  < t1.in > tmp.out 2> tmp.err
+diff t1.out tmp.out
+if grep ambiguous tmp.err; then
+  exit 1
+fi
+
+# Rewriting in place goes through a symbolic link, and keeps hard
+# links to the file.
+mkdir tmp.tree/src
+cp t1.in tmp.tree/src/x.cc
+ln -s x.cc tmp.tree/src/sym.cc
+ln tmp.tree/src/x.cc tmp.tree/hard.cc
+(cd tmp.tree && ../../../prepend-header-directories.py -r -j 2 \
+                  --in-place src/sym.cc src) > tmp.out
+test -L tmp.tree/src/sym.cc
+test tmp.tree/src/x.cc -ef tmp.tree/hard.cc
+diff t1.out tmp.tree/src/x.cc
+grep -q '^src/sym.cc$' tmp.out
+
+rm -r tmp.tree tmp.out tmp.err
+
+# EOF